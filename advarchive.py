@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: advarchive.py
+"""
+Compact, append-only binary archive of advertisements (.adva).
+
+An archive is a file header followed by blocks of up to block_records
+advertisements. Each block holds fixed-width columns, then the device
+identifiers first seen in that block, then the raw payloads:
+
+  header       BLOCK_HEADER: magic, flags, count, first/last timestamp,
+               byte sizes of the device and payload regions
+  timestamp    float64    seconds since the epoch
+  ad_types     uint64     bit t set if AD type t (< 63) is present;
+                          bit 63 for manufacturer data (0xff)
+  payload_end  uint32     end offset of the payload in the blob region
+  device       uint32     index into the archive's device table
+  company      uint16     manufacturer data company ID (0xffff if none)
+  rssi         int8       dBm (-128 if unknown)
+  apple_type   uint8      first Apple record type (0 if none)
+  devices      the new device identifiers, UTF-8, newline-terminated
+  payloads     the raw AD payloads, back to back
+
+Everything is little-endian and blocks are padded to 8 bytes, so the
+reader casts the columns of a memory-mapped file in place; it needs a
+little-endian host. Payloads written from CoreBluetooth manufacturer
+data are stored as a single 0xff AD structure.
+
+On close, the writer appends a sparse time index: one (offset, count,
+first, last timestamp) entry per block and a trailer pointing to it.
+The reader seeks straight to the blocks that overlap a time range, and
+within a block that is in time order it bisects the timestamp column.
+A writer reopening an archive removes the index, appends, and writes
+it again on close. If a writer died before writing the index, the
+reader rebuilds it by walking the block headers.
+
+    python advarchive.py convert capture.btsnoop out.adva
+    python advarchive.py convert records.ndjson out.adva
+    python advarchive.py read out.adva --start 1500000000 --end 1500000060
+    python advarchive.py info out.adva
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from btleclassifier import DEFAULT_CLASSIFIER,COMPANY_ID,COMPANY_HEX,MANUFACTURER_SPECIFIC
+
+FILE_MAGIC   = b'ADVARCH1'
+FILE_HEADER  = struct.Struct('<8sII')          # magic, version, reserved
+BLOCK_MAGIC  = b'ADVB'
+BLOCK_HEADER = struct.Struct('<4sHHIddIII')    # magic, flags, reserved, count, t_first, t_last,
+                                               # devices bytes, blob bytes, block bytes
+INDEX_ENTRY  = struct.Struct('<QIdd')          # offset, count, t_first, t_last
+TRAILER      = struct.Struct('<QI4s')          # index offset, entries, magic
+TRAILER_MAGIC = b'AIDX'
+VERSION      = 1
+
+BLOCK_SORTED = 0x0001                          # timestamps are non-decreasing
+
+# column name, array typecode / memoryview format, width
+COLUMNS = (('timestamp', 'd', 8), ('ad_types', 'Q', 8), ('payload_end', 'I', 4),
+           ('device', 'I', 4), ('company', 'H', 2), ('rssi', 'b', 1), ('apple_type', 'B', 1))
+
+NO_COMPANY = 0xffff
+NO_RSSI    = -128
+MANUFACTURER_BIT = 63
+APPLE      = 0x004c
+
+BLOCK_RECORDS = 4096
+
+assert sys.byteorder=='little', "advarchive columns are little-endian"
+
+def pad8(n):
+    return (n + 7) & ~7
+
+def summarize(payload):
+    """Return (ad_types bitmap, company ID, first Apple record type) for
+    a raw AD payload, walking it once."""
+    bitmap  = 0
+    company = NO_COMPANY
+    apple_type = 0
+    pos = 0
+    end = len(payload)
+    while pos + 1 < end:
+        ad_len = payload[pos]
+        if ad_len:
+            ad_type = payload[pos+1]
+            if ad_type==0xff:
+                bitmap |= 1<<MANUFACTURER_BIT
+                if ad_len >= 3 and pos + 3 < end:
+                    company = payload[pos+2] | payload[pos+3]<<8
+                    if company==APPLE and ad_len >= 4 and pos + 4 < end and not apple_type:
+                        apple_type = payload[pos+4]
+            elif ad_type < MANUFACTURER_BIT:
+                bitmap |= 1<<ad_type
+        pos += 1 + ad_len
+    return (bitmap, company, apple_type)
+
+def manufacturer_payload(manuf_data):
+    """Wrap CoreBluetooth manufacturer data as one 0xff AD structure."""
+    manuf_data = bytes(manuf_data[:253])
+    return bytes([len(manuf_data) + 1, 0xff]) + manuf_data
+
+
+class AdvArchiveWriter():
+    """Append advertisements to an archive. Not thread-safe: call
+    write() from one thread (e.g. the CoreBluetooth callback)."""
+    def __init__(self, path, block_records=BLOCK_RECORDS):
+        self.path = path
+        self.block_records = block_records
+        self.devices = {}
+        self.index   = []
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with AdvArchiveReader(path) as reader:
+                self.devices = {identifier:i for (i, identifier) in enumerate(reader.devices)}
+                self.index   = list(reader.index)
+                data_end     = reader.data_end
+            self.f = open(path, 'r+b')
+            self.f.truncate(data_end)       # drop the old index; it is rewritten on close
+            self.f.seek(data_end)
+        else:
+            self.f = open(path, 'wb')
+            self.f.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, 0))
+        self.count_written = 0
+        self.new_block()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def new_block(self):
+        self.columns     = {name:array(code) for (name, code, width) in COLUMNS}
+        self.blob        = bytearray()
+        self.new_devices = []
+        self.sorted      = True
+
+    def write(self, timestamp, device, rssi=None, adv_data=None, manuf_data=None):
+        """Append one advertisement. adv_data is a raw AD payload;
+        manuf_data is CoreBluetooth manufacturer data (used if adv_data
+        is not given)."""
+        if adv_data is None:
+            adv_data = manufacturer_payload(manuf_data) if manuf_data is not None else b''
+        index = self.devices.get(device)
+        if index is None:
+            index = self.devices[device] = len(self.devices)
+            self.new_devices.append(device)
+        (bitmap, company, apple_type) = summarize(adv_data)
+        cols = self.columns
+        if cols['timestamp'] and timestamp < cols['timestamp'][-1]:
+            self.sorted = False
+        self.blob += adv_data
+        cols['timestamp'].append(timestamp)
+        cols['ad_types'].append(bitmap)
+        cols['payload_end'].append(len(self.blob))
+        cols['device'].append(index)
+        cols['company'].append(company)
+        cols['rssi'].append(NO_RSSI if rssi is None else max(-128, min(127, int(rssi))))
+        cols['apple_type'].append(apple_type)
+        self.count_written += 1
+        if len(cols['timestamp']) >= self.block_records:
+            self.flush()
+
+    def flush(self):
+        """Write the current block, if it has any records."""
+        cols  = self.columns
+        count = len(cols['timestamp'])
+        if not count:
+            return
+        devices = "".join(identifier + "\n" for identifier in self.new_devices).encode('utf-8')
+        body = [cols[name].tobytes() for (name, code, width) in COLUMNS] + [devices, bytes(self.blob)]
+        size = BLOCK_HEADER.size + sum(len(part) for part in body)
+        block_bytes = pad8(size)
+        timestamps = cols['timestamp']
+        (t_first, t_last) = (min(timestamps), max(timestamps)) if not self.sorted else (timestamps[0], timestamps[-1])
+        offset = self.f.tell()
+        self.f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, BLOCK_SORTED if self.sorted else 0, 0, count,
+                                       t_first, t_last, len(devices), len(self.blob), block_bytes))
+        for part in body:
+            self.f.write(part)
+        self.f.write(bytes(block_bytes - size))
+        self.index.append((offset, count, t_first, t_last))
+        self.new_block()
+
+    def close(self):
+        """Write the last block and the time index."""
+        if self.f is None:
+            return
+        self.flush()
+        index_offset = self.f.tell()
+        for entry in self.index:
+            self.f.write(INDEX_ENTRY.pack(*entry))
+        self.f.write(TRAILER.pack(index_offset, len(self.index), TRAILER_MAGIC))
+        self.f.close()
+        self.f = None
+
+
+class ArchiveBlock():
+    """The columns of one block, as memoryviews into the map."""
+    __slots__ = ('count', 'sorted', 'blob', 'timestamp', 'ad_types', 'payload_end',
+                 'device', 'company', 'rssi', 'apple_type')
+
+    def __init__(self, buf, offset):
+        (magic, flags, reserved, count, t_first, t_last,
+         devices_bytes, blob_bytes, block_bytes) = BLOCK_HEADER.unpack_from(buf, offset)
+        self.count  = count
+        self.sorted = bool(flags & BLOCK_SORTED)
+        pos = offset + BLOCK_HEADER.size
+        for (name, code, width) in COLUMNS:
+            setattr(self, name, buf[pos:pos + count*width].cast(code))
+            pos += count*width
+        pos += devices_bytes
+        self.blob = buf[pos:pos + blob_bytes]
+
+    def payload(self, i):
+        start = self.payload_end[i-1] if i else 0
+        return self.blob[start:self.payload_end[i]]
+
+
+class ArchiveRecord():
+    """One advertisement in an archive. Fields are read from the columns
+    when accessed; payload is a memoryview into the map."""
+    __slots__ = ('reader', 'block', 'i')
+
+    def __init__(self, reader, block, i):
+        self.reader = reader
+        self.block  = block
+        self.i      = i
+
+    def __repr__(self):
+        return f"ArchiveRecord<{self.timestamp} {self.device} {self.rssi}>"
+
+    @property
+    def timestamp(self):
+        return self.block.timestamp[self.i]
+
+    @property
+    def device(self):
+        return self.reader.devices[self.block.device[self.i]]
+
+    @property
+    def rssi(self):
+        rssi = self.block.rssi[self.i]
+        return None if rssi==NO_RSSI else rssi
+
+    @property
+    def company(self):
+        company = self.block.company[self.i]
+        return None if company==NO_COMPANY else company
+
+    @property
+    def ad_types(self):
+        bitmap = self.block.ad_types[self.i]
+        return [0xff if bit==MANUFACTURER_BIT else bit for bit in range(64) if bitmap>>bit & 1]
+
+    @property
+    def apple_type(self):
+        return self.block.apple_type[self.i] or None
+
+    @property
+    def payload(self):
+        return self.block.payload(self.i)
+
+    def classify(self, classifier=None):
+        return (classifier or DEFAULT_CLASSIFIER).classify(self.payload)
+
+
+class AdvArchiveReader():
+    """Memory-mapped archive reader. records(start, end) yields
+    ArchiveRecords, optionally restricted to a time range."""
+    def __init__(self, path):
+        self.path = path
+        self.f    = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"{path}: empty file")
+        self.buf = memoryview(self.mm)
+        (magic, version, reserved) = FILE_HEADER.unpack_from(self.buf, 0)
+        if magic!=FILE_MAGIC:
+            raise ValueError(f"{path}: not an advertisement archive")
+        self.index = self.read_index()
+        if self.index is None:
+            (self.index, self.data_end) = self.scan_blocks()
+        self.devices = []
+        for (offset, count, t_first, t_last) in self.index:
+            self.devices.extend(self.block_devices(offset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return sum(entry[1] for entry in self.index)
+
+    def close(self):
+        self.buf.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            pass        # records still hold views; the map goes when they do
+        self.f.close()
+
+    def read_index(self):
+        buf = self.buf
+        if len(buf) < FILE_HEADER.size + TRAILER.size:
+            return None
+        (index_offset, entries, magic) = TRAILER.unpack_from(buf, len(buf) - TRAILER.size)
+        if magic!=TRAILER_MAGIC or index_offset + entries*INDEX_ENTRY.size + TRAILER.size != len(buf):
+            return None
+        self.data_end = index_offset
+        return [INDEX_ENTRY.unpack_from(buf, index_offset + i*INDEX_ENTRY.size) for i in range(entries)]
+
+    def scan_blocks(self):
+        """Rebuild the index from the block headers (no trailer)."""
+        (buf, pos, index) = (self.buf, FILE_HEADER.size, [])
+        while pos + BLOCK_HEADER.size <= len(buf):
+            header = BLOCK_HEADER.unpack_from(buf, pos)
+            (magic, count, t_first, t_last, block_bytes) = (header[0], header[3], header[4], header[5], header[8])
+            if magic!=BLOCK_MAGIC or pos + block_bytes > len(buf):
+                break           # truncated last block
+            index.append((pos, count, t_first, t_last))
+            pos += block_bytes
+        return (index, pos)
+
+    def block_devices(self, offset):
+        header = BLOCK_HEADER.unpack_from(self.buf, offset)
+        (count, devices_bytes) = (header[3], header[6])
+        start = offset + BLOCK_HEADER.size + count*sum(width for (name, code, width) in COLUMNS)
+        text = bytes(self.buf[start:start + devices_bytes]).decode('utf-8')
+        return text.split("\n")[:-1]
+
+    def blocks(self, start=None, end=None):
+        """Yield the ArchiveBlocks whose time span overlaps [start, end]."""
+        for (offset, count, t_first, t_last) in self.index:
+            if (start is None or t_last >= start) and (end is None or t_first <= end):
+                yield ArchiveBlock(self.buf, offset)
+
+    def records(self, start=None, end=None):
+        """Yield ArchiveRecords with start <= timestamp <= end."""
+        for block in self.blocks(start, end):
+            ts = block.timestamp
+            if block.sorted:
+                lo = 0 if start is None else bisect.bisect_left(ts, start)
+                hi = block.count if end is None else bisect.bisect_right(ts, end)
+                for i in range(lo, hi):
+                    yield ArchiveRecord(self, block, i)
+            else:
+                for i in range(block.count):
+                    if (start is None or ts[i] >= start) and (end is None or ts[i] <= end):
+                        yield ArchiveRecord(self, block, i)
+
+    def info(self):
+        return {'path':self.path, 'records':len(self), 'blocks':len(self.index),
+                'devices':len(self.devices), 'bytes':len(self.buf),
+                'start':self.index[0][2] if self.index else None,
+                'end':max(entry[3] for entry in self.index) if self.index else None}
+
+
+def ndjson_reports(path):
+    """Yield (timestamp, device, rssi, adv_data, manuf_data) from NDJSON
+    written by hcireplay.py, batchclassify.py or an NDJSONSink."""
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            adv_data = bytes.fromhex(rec.get('hex', ''))
+            manuf_data = None
+            manuf = rec.get(MANUFACTURER_SPECIFIC)
+            if not adv_data and manuf:
+                manuf_data = struct.pack('<H', manuf[COMPANY_ID]) + bytes.fromhex(manuf[COMPANY_HEX])
+            yield (rec.get('timestamp', 0.0), rec.get('address') or rec.get('identifier') or '',
+                   rec.get('rssi'), adv_data or None, manuf_data)
+
+def convert(src, dst, block_records=BLOCK_RECORDS):
+    """Convert a btsnoop/pcap capture or an NDJSON file to an archive.
+    Returns the number of advertisements written."""
+    from hcireplay import CaptureReader,BTSNOOP_MAGIC,PCAP_MAGICS
+    with open(src, 'rb') as f:
+        head = f.read(8)
+    with AdvArchiveWriter(dst, block_records) as writer:
+        if head==BTSNOOP_MAGIC or head[0:4] in PCAP_MAGICS:
+            with CaptureReader(src) as reader:
+                for report in reader.reports():
+                    writer.write(report.timestamp, report.address, report.rssi, bytes(report.payload))
+        else:
+            for (timestamp, device, rssi, adv_data, manuf_data) in ndjson_reports(src):
+                writer.write(timestamp, device, rssi, adv_data, manuf_data)
+        return writer.count_written
+
+
+if __name__ == "__main__":
+    import argparse
+    from advjson import ResultEncoder
+    parser = argparse.ArgumentParser(description='Convert to and read advertisement archives')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('convert', help='convert a btsnoop/pcap capture or NDJSON file to an archive')
+    p.add_argument("input")
+    p.add_argument("output")
+    p.add_argument("--block-records", type=int, default=BLOCK_RECORDS)
+    p = sub.add_parser('read', help='classify the records in a time range and print NDJSON')
+    p.add_argument("archive")
+    p.add_argument("--start", type=float, help="first timestamp (seconds since the epoch)")
+    p.add_argument("--end", type=float, help="last timestamp")
+    p.add_argument("--quiet", action='store_true', help="read and classify, but do not print")
+    p = sub.add_parser('info', help='print a summary of an archive')
+    p.add_argument("archive")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    if args.command=='convert':
+        count = convert(args.input, args.output, args.block_records)
+        elapsed = time.perf_counter() - t0
+        print(f"{count} advertisements, {os.path.getsize(args.input):,} -> {os.path.getsize(args.output):,} bytes "
+              f"in {elapsed:.3f}s", file=sys.stderr)
+    elif args.command=='read':
+        count = 0
+        encoder = ResultEncoder()
+        with AdvArchiveReader(args.archive) as reader:
+            for record in reader.records(args.start, args.end):
+                rec = {'timestamp':record.timestamp, 'address':record.device, 'rssi':record.rssi}
+                rec.update(record.classify())
+                if not args.quiet:
+                    print(encoder.dumps(rec))
+                count += 1
+        elapsed = time.perf_counter() - t0
+        print(f"{count} records in {elapsed:.3f}s: {count/elapsed if elapsed else 0:,.0f} records/sec",
+              file=sys.stderr)
+    else:
+        with AdvArchiveReader(args.archive) as reader:
+            print(json.dumps(reader.info(), indent=2))
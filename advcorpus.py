@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: advcorpus.py
+"""
+Seeded generator of synthetic advertisement payloads, for benchmarks
+and load tests. The same (count, seed, mix) always gives the same
+corpus.
+
+Each advertisement is a flags structure (most of the time) followed by
+one or two structures drawn from MIX: service data, Apple Handoff /
+Nearby / Instant Hotspot / Wi-Fi Settings / iBeacon records, Microsoft
+CDP beacons, other AD types (UUID lists, local names, TX power,
+appearance, mesh messages), and malformed payloads (truncated
+structures, zero lengths, lengths that run past the end, truncated
+Apple records).
+"""
+
+import random
+import struct
+
+# kind -> relative weight
+MIX = {
+    'service_data':    10,
+    'apple_handoff':   15,
+    'apple_nearby':    25,
+    'apple_hotspot':    3,
+    'apple_wifi':       3,
+    'apple_ibeacon':    5,
+    'microsoft':       10,
+    'unknown':         15,
+    'malformed':        4,
+}
+
+SERVICE_UUIDS = [0xfd6f, 0xfe9f, 0xfeaa, 0x180f, 0x181a, 0xfe2c]
+UNKNOWN_TYPES = [0x02, 0x03, 0x08, 0x09, 0x0a, 0x19, 0x2a]
+
+def ad_structure(ad_type, data):
+    return bytes([len(data)+1, ad_type]) + data
+
+def apple(records):
+    return ad_structure(0xff, b'\x4c\x00' + b''.join(bytes([t, len(d)]) + d for (t, d) in records))
+
+class CorpusGenerator():
+    def __init__(self, seed=0, mix=None):
+        self.rnd   = random.Random(seed)
+        self.mix   = mix or MIX
+        self.kinds = list(self.mix.keys())
+        self.weights = list(self.mix.values())
+
+    def randbytes(self, n):
+        return bytes(self.rnd.getrandbits(8) for _ in range(n))
+
+    def flags(self):
+        return ad_structure(0x01, bytes([self.rnd.choice([0x06, 0x1a, 0x02, 0x1e])]))
+
+    def service_data(self):
+        uuid = self.rnd.choice(SERVICE_UUIDS)
+        return ad_structure(0x16, struct.pack('<H', uuid) + self.randbytes(self.rnd.randint(2, 20)))
+
+    def handoff_record(self):
+        return (0x0c, bytes([self.rnd.randrange(2)]) + struct.pack('<H', self.rnd.randrange(1<<16))
+                + self.randbytes(11))
+
+    def nearby_record(self):
+        status = (self.rnd.randrange(2)<<4) | self.rnd.choice([1, 3, 7, 10, 11, 13, 14])
+        return (0x10, bytes([status]) + self.randbytes(self.rnd.choice([2, 4])))
+
+    def apple_handoff(self):
+        return apple([self.handoff_record(), self.nearby_record()])
+
+    def apple_nearby(self):
+        return apple([self.nearby_record()])
+
+    def apple_hotspot(self):
+        return apple([(0x0e, self.randbytes(4) + bytes([self.rnd.randrange(101), 0,
+                                                         self.rnd.randrange(8), self.rnd.randrange(5)]))])
+
+    def apple_wifi(self):
+        return apple([(0x0d, self.randbytes(6))])
+
+    def apple_ibeacon(self):
+        return apple([(0x02, self.randbytes(16) + self.randbytes(4) + b'\xc5')])
+
+    def microsoft(self):
+        return ad_structure(0xff, b'\x06\x00' + bytes([0x01, 0x09, 0x20, 0x02]) + self.randbytes(23))
+
+    def unknown(self):
+        return ad_structure(self.rnd.choice(UNKNOWN_TYPES), self.randbytes(self.rnd.randint(1, 12)))
+
+    def malformed(self):
+        choice = self.rnd.randrange(4)
+        if choice==0:                       # truncated last structure
+            return self.service_data()[:self.rnd.randint(2, 4)]
+        if choice==1:                       # zero-length structure
+            return b'\x00' + self.unknown()
+        if choice==2:                       # length runs past the end
+            return bytes([0x1f, 0xff, 0x4c, 0x00, 0x0c])
+        return apple([(0x0c, b'\x00')])     # truncated Apple record
+
+    def advertisement(self):
+        parts = [self.flags()] if self.rnd.random() < 0.8 else []
+        for kind in self.rnd.choices(self.kinds, self.weights, k=self.rnd.randint(1, 2)):
+            parts.append(getattr(self, kind)())
+        return b''.join(parts)
+
+    def generate(self, count):
+        return [self.advertisement() for _ in range(count)]
+
+def generate(count, seed=0, mix=None):
+    """Return a list of count synthetic advertisement payloads."""
+    return CorpusGenerator(seed, mix).generate(count)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Write a synthetic advertisement corpus, one hex payload per line')
+    parser.add_argument("count", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for adv in generate(args.count, args.seed):
+        print(adv.hex())
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: advdelta.py
+"""
+Change-only decoding of advertisements, per device.
+
+A device that is just sitting there advertises the same few bytes over
+and over; often only a sequence number or an action code moves.
+DeltaDecoder keeps each device's last raw payload split into parts: one
+per AD structure, plus the company ID and each Apple TLV record of the
+manufacturer data. A new advertisement is split the same way and only
+the parts whose bytes changed are decoded, using the classifier's
+decoders. The result is a compact change event:
+
+    {"identifier": "...", "timestamp": ..., "rssi": -52, "repeats": 14,
+     "changes": {"Nearby Message.Action Code": [3, 11]}}
+
+and describe(event) renders it as "Nearby Message.Action Code 3→11".
+An advertisement identical to the last one is a heartbeat: it is
+counted (repeats, in the next event) and produces no event. The first
+advertisement from a device is an event with new=True and every field
+changing from None.
+
+Field names are the classifier's result keys ('tx-power-level',
+'service-data'), 'company_id', and Apple record types ('Handoff
+Message'). Structures too short for their type, and types the
+classifier has no decoder for, are reported as '0x<type>' with their
+hex. The timing and volume against full decoding can be measured with
+'python advdelta.py --bench'.
+"""
+
+import time
+
+from btleclassifier import Classifier,DEFAULT_CLASSIFIER,MALFORMED,as_view
+
+APPLE = 0x004c
+COMPANY = 'company_id'
+MANUFACTURER = 'manufacturer'
+
+class DeviceState():
+    __slots__ = ('adv_data', 'manuf_data', 'parts', 'last_seen', 'repeats')
+
+    def __init__(self):
+        self.adv_data   = None
+        self.manuf_data = None
+        self.parts      = {}        # part key -> (raw bytes, label, value)
+        self.last_seen  = 0.0
+        self.repeats    = 0
+
+
+def split_manufacturer(view, parts):
+    """Add the parts of manufacturer-specific data (company ID first) to
+    parts, a dict of part key -> raw bytes."""
+    if len(view) < 2:
+        parts[MANUFACTURER] = bytes(view)
+        return
+    parts[COMPANY] = bytes(view[0:2])
+    if (view[0] | view[1]<<8) != APPLE:
+        parts[MANUFACTURER] = bytes(view[2:])
+        return
+    seen = {}
+    pos = 2
+    end = len(view)
+    while pos + 1 < end:
+        apple_type = view[pos]
+        start = pos + 2
+        pos   = start + view[pos+1]
+        n = seen.get(apple_type, 0)
+        seen[apple_type] = n + 1
+        parts[(apple_type, n)] = bytes(view[start:min(pos, end)])
+
+def split_parts(adv_data, manuf_data):
+    """Return {part key: raw bytes} for an advertisement. AD structures
+    are keyed by type (the last one of a type wins, as in
+    Classifier.decode()); Apple records by (type, occurrence)."""
+    parts = {}
+    view = as_view(adv_data)
+    pos = 0
+    end = len(view)
+    while pos < end:
+        start = pos + 1
+        pos   = start + view[pos]
+        if start >= end or start >= pos:
+            continue
+        ad_type = view[start]
+        if ad_type==0xff:
+            split_manufacturer(view[start+1:pos], parts)
+        else:
+            parts[ad_type] = bytes(view[start+1:pos])
+    if manuf_data:
+        split_manufacturer(as_view(manuf_data), parts)
+    return parts
+
+
+class DeltaDecoder():
+    def __init__(self, classifier=None, ttl=300.0, evict_interval=1.0):
+        self.classifier = classifier or DEFAULT_CLASSIFIER
+        self.ttl     = ttl
+        self.evict_interval = evict_interval
+        self.next_evict = 0.0
+        self.devices = {}           # identifier -> DeviceState
+        self.count_updates    = 0
+        self.count_heartbeats = 0
+        self.count_events     = 0
+        self.count_decoded    = 0   # parts decoded
+        self.count_reused     = 0   # parts unchanged since the last advertisement
+        self.count_evicted    = 0
+
+    def __len__(self):
+        return len(self.devices)
+
+    def decode_part(self, key, raw):
+        """Return (label, value) for one part."""
+        classifier = self.classifier
+        if key==COMPANY:
+            return (COMPANY, raw[0] | raw[1]<<8)
+        if key==MANUFACTURER:
+            return (MANUFACTURER, raw.hex())
+        if isinstance(key, tuple):
+            (apple_type, n) = key
+            record = None
+            parser = classifier.apple_type_parsers.get(apple_type)
+            if parser is not None:
+                try:
+                    record = parser(raw)
+                except IndexError:
+                    pass        # truncated record
+            if record is None:
+                record = classifier.parse_apple_unknown(apple_type, raw)
+            label = record.pop('type') if isinstance(record, dict) else hex(apple_type)
+            return (f"{label}#{n}" if n else label, record)
+        if key in classifier.ad_type_parsers:
+            (label, parser) = classifier.ad_type_parsers[key]
+            try:
+                return (label, parser(memoryview(raw)))
+            except MALFORMED:
+                pass            # structure too short for its type
+        return (f"0x{key:02x}", raw.hex())
+
+    def update(self, identifier, adv_data=b'', manuf_data=b'', rssi=None, now=None):
+        """Process one advertisement. Returns a change event dict, or None
+        for a heartbeat."""
+        if now is None:
+            now = time.time()
+        if now >= self.next_evict:
+            self.evict(now)
+        self.count_updates += 1
+        adv_data   = bytes(adv_data) if adv_data else b''
+        manuf_data = bytes(manuf_data) if manuf_data else b''
+        state = self.devices.get(identifier)
+        new   = state is None
+        if new:
+            state = self.devices[identifier] = DeviceState()
+        state.last_seen = now
+        if adv_data==state.adv_data and manuf_data==state.manuf_data:
+            state.repeats += 1
+            self.count_heartbeats += 1
+            return None
+        (state.adv_data, state.manuf_data) = (adv_data, manuf_data)
+        old_parts = state.parts
+        parts     = {}
+        changes   = {}
+        for (key, raw) in split_parts(adv_data, manuf_data).items():
+            old = old_parts.pop(key, None)
+            if old is not None and old[0]==raw:
+                parts[key] = old
+                self.count_reused += 1
+                continue
+            (label, value) = self.decode_part(key, raw)
+            self.count_decoded += 1
+            parts[key] = (raw, label, value)
+            if old is None:
+                diff(label, None, value, changes)
+            elif old[1]==label:
+                diff(label, old[2], value, changes)
+            else:
+                diff(old[1], old[2], None, changes)
+                diff(label, None, value, changes)
+        for (raw, label, value) in old_parts.values():
+            diff(label, value, None, changes)       # parts no longer present
+        state.parts = parts
+        if not changes and not new:
+            # only bytes we do not decode changed (e.g. a truncated tail)
+            state.repeats += 1
+            self.count_heartbeats += 1
+            return None
+        event = {'identifier':identifier, 'timestamp':now, 'rssi':rssi,
+                 'repeats':state.repeats, 'changes':changes}
+        if new:
+            event['new'] = True
+        state.repeats = 0
+        self.count_events += 1
+        return event
+
+    def forget(self, identifier):
+        self.devices.pop(identifier, None)
+
+    def evict(self, now=None):
+        """Drop devices not seen for ttl seconds. Returns their identifiers."""
+        if now is None:
+            now = time.time()
+        self.next_evict = now + self.evict_interval
+        cutoff  = now - self.ttl
+        evicted = [identifier for (identifier, state) in self.devices.items() if state.last_seen < cutoff]
+        for identifier in evicted:
+            del self.devices[identifier]
+        self.count_evicted += len(evicted)
+        return evicted
+
+    def stats(self):
+        return {'devices':len(self.devices),
+                'updates':self.count_updates,
+                'heartbeats':self.count_heartbeats,
+                'events':self.count_events,
+                'decoded':self.count_decoded,
+                'reused':self.count_reused,
+                'evicted':self.count_evicted}
+
+
+def diff(label, old, new, changes):
+    """Add the differences between two decoded values to changes, as
+    label -> [old, new]. Dicts are compared field by field."""
+    if isinstance(old, dict) or isinstance(new, dict):
+        old = old if isinstance(old, dict) else {}
+        new = new if isinstance(new, dict) else {}
+        for key in list(new) + [key for key in old if key not in new]:
+            if old.get(key) != new.get(key):
+                changes[f"{label}.{key}"] = [old.get(key), new.get(key)]
+    elif old != new:
+        changes[label] = [old, new]
+
+def describe(event):
+    """One line of text for a change event."""
+    changes = ", ".join(f"{field} {old}→{new}" for (field, (old, new)) in event['changes'].items())
+    return f"{event['identifier']} {'new: ' if event.get('new') else ''}{changes}"
+
+
+def benchmark(count, devices=100, change_every=20, repeat=3):
+    """Feed count advertisements from devices stable devices whose Handoff
+    sequence number changes every change_every advertisements. Returns
+    {name: (advertisements/sec, output bytes)} for full decoding with
+    JSON output against DeltaDecoder with JSON events."""
+    from advjson import ResultEncoder
+    base = bytes.fromhex("4c000c0e00750f812422021c3e213d190f3310050b1c6d9072")
+    stream = []
+    for i in range(count):
+        device = i % devices
+        seq = (i // devices) // change_every
+        payload = bytearray(base)
+        payload[5:7] = ((seq + device) & 0xffff).to_bytes(2, 'big')
+        payload[-6] = 0x03 if (seq // 4) % 2 else 0x0b
+        stream.append((f"device-{device}", bytes(payload)))
+    dumps = ResultEncoder().dumps
+    classifier = Classifier()
+    def full():
+        size = 0
+        for (identifier, manuf_data) in stream:
+            record = {'identifier':identifier}
+            record.update(classifier.classify(manuf_data=manuf_data))
+            size += len(dumps(record))
+        return size
+    def delta():
+        size = 0
+        decoder = DeltaDecoder(classifier)
+        for (identifier, manuf_data) in stream:
+            event = decoder.update(identifier, manuf_data=manuf_data, now=0.0)
+            if event is not None:
+                size += len(dumps(event))
+        return size
+    results = {}
+    for (name, fn) in (('full', full), ('delta', delta)):
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            size = fn()
+            best = min(best, time.perf_counter() - t0)
+        results[name] = (count / best, size)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Print the changes in each device\'s advertisements in a capture')
+    parser.add_argument("capture", nargs='?', help="btsnoop or pcap file")
+    parser.add_argument("--bench", type=int, metavar='N', help="Compare full and delta decoding on N advertisements")
+    args = parser.parse_args()
+
+    if args.bench:
+        for (name, (rate, size)) in benchmark(args.bench).items():
+            print(f"{name:6} {rate:>12,.0f} ads/sec  {size:>12,} bytes of output")
+        exit(0)
+    if not args.capture:
+        parser.error("a capture file or --bench is required")
+
+    from hcireplay import read_reports
+    decoder = DeltaDecoder()
+    for report in read_reports(args.capture):
+        event = decoder.update(report.address, report.payload, rssi=report.rssi, now=report.timestamp)
+        if event is not None:
+            print(describe(event))
+    print(decoder.stats())
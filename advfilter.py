@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: advfilter.py
+"""
+Filter expressions evaluated on raw advertisement bytes, so that
+uninteresting traffic is dropped before it is classified. For example:
+
+    company==0x004c and apple_type in {0x0c, 0x10} and rssi > -70
+
+Expressions use Python syntax: and, or, not, parentheses, comparisons
+and in / not in against literals. The fields are:
+
+  rssi        signal strength in dBm (None if unknown)
+  address     device address or identifier string (None if unknown)
+  length      payload length in bytes
+  company     company ID of the manufacturer-specific data (None if absent)
+  apple_type  set of Apple record types in Apple manufacturer data
+  uuid        set of 16-bit service UUIDs, from service data (0x16)
+              and the 16-bit UUID lists (0x02, 0x03)
+  ad_type     set of AD types present
+
+For the set fields, `apple_type==0x10` means "has a 0x10 record" and
+`apple_type in {0x0c,0x10}` means "has any of them". An ordering
+comparison with a field that is None is false. Literals must match the
+field: numbers for rssi and length, a string for address, and integers
+for company and the set fields; `in` takes a set, list or tuple of them.
+A mismatch is a FilterError when the filter is compiled.
+
+Each top-level `and` term is compiled into a separate check (a stage).
+The checks on metadata (rssi, address, length) run first. The payload
+is walked once, only if a check needs it, to extract just the fields
+that are used. dropped counts the packets each stage rejects.
+"""
+
+import ast
+
+META_FIELDS = ('rssi', 'address', 'length')
+SCALAR_FIELDS = META_FIELDS + ('company',)
+SET_FIELDS  = ('apple_type', 'uuid', 'ad_type')
+FIELDS      = SCALAR_FIELDS + SET_FIELDS
+ARGS        = ', '.join(FIELDS)
+
+# field -> (literal types, description); the rest take integers
+LITERAL_TYPES = {'rssi':((int, float), 'number'), 'length':((int, float), 'number'),
+                 'address':((str,), 'string')}
+
+APPLE = 0x004c
+ORDERING = {ast.Lt:'<', ast.LtE:'<=', ast.Gt:'>', ast.GtE:'>='}
+EQUALITY = {ast.Eq:'==', ast.NotEq:'!=', ast.In:'in', ast.NotIn:'not in'}
+
+class FilterError(ValueError):
+    pass
+
+
+class CheckCompiler():
+    """Turn one expression node into the source of a Python expression
+    over the FIELDS, with literals bound as constants."""
+    def __init__(self, consts):
+        self.consts = consts
+        self.names  = set()
+
+    def literal(self, node):
+        try:
+            return ast.literal_eval(node)
+        except (ValueError, TypeError, SyntaxError):
+            raise FilterError(f"expected a literal, got {ast.unparse(node)!r}")
+
+    def check_type(self, name, op, val, text):
+        """Raise FilterError unless val can be compared with field name by op."""
+        (types, kind) = LITERAL_TYPES.get(name, ((int,), 'integer'))
+        ok = lambda v: isinstance(v, types) and not isinstance(v, bool)
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not (isinstance(val, (set, frozenset, list, tuple)) and all(ok(v) for v in val)):
+                raise FilterError(f"{text!r}: {name} in needs a set, list or tuple of {kind}s")
+        elif not ok(val) and not (val is None and type(op) in EQUALITY and name in SCALAR_FIELDS):
+            raise FilterError(f"{text!r}: {name} must be compared with a {kind}, not {val!r}")
+
+    def const(self, val):
+        if isinstance(val, (set, list, tuple)):
+            val = frozenset(val)
+        name = f"_c{len(self.consts)}"
+        self.consts[name] = val
+        return name
+
+    def field(self, node):
+        if not isinstance(node, ast.Name) or node.id not in FIELDS:
+            raise FilterError(f"unknown field {ast.unparse(node)!r}; fields are {', '.join(FIELDS)}")
+        self.names.add(node.id)
+        return node.id
+
+    def emit(self, node):
+        if isinstance(node, ast.BoolOp):
+            op = ' and ' if isinstance(node.op, ast.And) else ' or '
+            return '(' + op.join(self.emit(v) for v in node.values) + ')'
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return f"(not {self.emit(node.operand)})"
+        if isinstance(node, ast.Name):
+            name = self.field(node)
+            return f"(not not {name})" if name in SET_FIELDS else f"({name} is not None)"
+        if isinstance(node, ast.Compare):
+            if len(node.ops) != 1:
+                raise FilterError(f"chained comparisons are not supported: {ast.unparse(node)!r}")
+            return self.compare(node.left, node.ops[0], node.comparators[0])
+        raise FilterError(f"unsupported expression {ast.unparse(node)!r}")
+
+    def compare(self, left, op, right):
+        name = self.field(left)
+        lit  = self.literal(right)
+        if name in SET_FIELDS and type(op) in ORDERING:
+            raise FilterError(f"{name} is a set of values; use ==, != or in")
+        self.check_type(name, op, lit, ast.unparse(ast.Compare(left, [op], [right])))
+        val  = self.const(lit)
+        if name in SET_FIELDS:
+            if isinstance(op, ast.Eq):
+                return f"({val} in {name})"
+            if isinstance(op, ast.NotEq):
+                return f"({val} not in {name})"
+            if isinstance(op, ast.In):
+                return f"(not {name}.isdisjoint({val}))"
+            if isinstance(op, ast.NotIn):
+                return f"{name}.isdisjoint({val})"
+            raise FilterError(f"{name} is a set of values; use ==, != or in")
+        if type(op) in ORDERING:
+            return f"({name} is not None and {name} {ORDERING[type(op)]} {val})"
+        return f"({name} {EQUALITY[type(op)]} {val})"
+
+
+def scan_payload(adv_data, manuf_data, uuids, names):
+    """Walk the AD structures once and return (company, apple_type,
+    uuid, ad_type), computing only the fields in names."""
+    want_apple = 'apple_type' in names
+    want_uuid  = 'uuid' in names
+    want_types = 'ad_type' in names
+    company    = None
+    apple_view = None
+    apple_types = set()
+    uuid_set   = set(uuids) if uuids else set()
+    ad_types   = set()
+    buf = memoryview(adv_data) if adv_data else b''
+    pos = 0
+    end = len(buf)
+    while pos + 1 < end:
+        ad_len  = buf[pos]
+        stop    = min(pos + 1 + ad_len, end)
+        if ad_len:
+            ad_type = buf[pos+1]
+            if want_types:
+                ad_types.add(ad_type)
+            if ad_type==0xff and stop - pos >= 4:
+                company = buf[pos+2] | buf[pos+3]<<8
+                apple_view = (buf, pos+4, stop) if company==APPLE else None
+            elif want_uuid and ad_type in (0x02, 0x03, 0x16):
+                last = stop - 1 if ad_type!=0x16 else min(pos + 3, stop - 1)
+                for i in range(pos+2, last, 2):
+                    uuid_set.add(buf[i] | buf[i+1]<<8)
+        pos += 1 + ad_len
+    if manuf_data and len(manuf_data) >= 2:
+        buf = memoryview(manuf_data)
+        company = buf[0] | buf[1]<<8
+        apple_view = (buf, 2, len(buf)) if company==APPLE else None
+        if want_types:
+            ad_types.add(0xff)
+    if want_apple and apple_view is not None:
+        (buf, pos, end) = apple_view
+        while pos + 1 < end:
+            apple_types.add(buf[pos])
+            pos += 2 + buf[pos+1]
+    return (company, apple_types, uuid_set, ad_types)
+
+
+class AdvFilter():
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise FilterError(f"cannot parse filter {expression!r}: {e.msg}")
+        body  = tree.body
+        terms = body.values if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And) else [body]
+        consts = {'__builtins__': {}}
+        self.names  = set()
+        self.stages = []
+        for term in terms:
+            compiler = CheckCompiler(consts)
+            source   = compiler.emit(term)
+            payload  = not compiler.names.issubset(META_FIELDS)
+            self.names |= compiler.names
+            text = ast.get_source_segment(expression.strip(), term) or ast.unparse(term)
+            self.stages.append((text, source, payload))
+        # metadata checks first; otherwise keep the order written
+        self.stages.sort(key=lambda stage: stage[2])
+        self.stages = [(text, eval(f"lambda {ARGS}: {source}", consts), payload)
+                       for (text, source, payload) in self.stages]
+        self.count_seen   = 0
+        self.count_passed = 0
+        self.dropped = {text: 0 for (text, check, payload) in self.stages}
+
+    def __repr__(self):
+        return f"AdvFilter<{self.expression}>"
+
+    def needs(self, name):
+        return name in self.names
+
+    def match(self, adv_data=b'', manuf_data=b'', rssi=None, address=None, uuids=None):
+        """True if the advertisement passes. adv_data is a raw AD
+        structure payload; manuf_data is manufacturer-specific data
+        without its length and type (as CoreBluetooth reports it);
+        uuids are extra 16-bit service UUIDs known from metadata."""
+        self.count_seen += 1
+        length = len(adv_data) + len(manuf_data)
+        fields = None
+        for (text, check, payload) in self.stages:
+            if payload and fields is None:
+                fields = scan_payload(adv_data, manuf_data, uuids, self.names)
+            (company, apple_type, uuid, ad_type) = fields or (None, None, None, None)
+            if not check(rssi, address, length, company, apple_type, uuid, ad_type):
+                self.dropped[text] += 1
+                return False
+        self.count_passed += 1
+        return True
+
+    def stats(self):
+        return {'expression':self.expression,
+                'seen':self.count_seen,
+                'passed':self.count_passed,
+                'dropped':dict(self.dropped)}
+
+    def merge(self, stats):
+        """Add counts from another filter's stats() (e.g. from a worker process)."""
+        self.count_seen   += stats['seen']
+        self.count_passed += stats['passed']
+        for (text, n) in stats['dropped'].items():
+            self.dropped[text] = self.dropped.get(text, 0) + n
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Filter hex-encoded advertisements, one per line, from stdin')
+    parser.add_argument("expression", help="filter expression, e.g. 'company==0x004c and apple_type==0x10'")
+    args = parser.parse_args()
+
+    adv_filter = AdvFilter(args.expression)
+    for line in sys.stdin:
+        line = line.strip()
+        if line and adv_filter.match(bytes.fromhex(line)):
+            print(line)
+    print(adv_filter.stats(), file=sys.stderr)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: advjson.py
+"""
+JSON serialization of classifier results.
+
+The generic encoder cannot serialize the raw bytes the classifier puts
+in service data ({'uuid':..., 'data':b'...'}), and falling back to a
+default= hook for them goes through the encoder's type dispatch for every
+unrecognized object. ResultEncoder knows from Classifier.AD_TYPES which
+result keys hold service data, converts just those bytes (to hex, or
+base64) and hands everything else to the backend as is:
+
+  json    the standard library's C encoder, built once and reused
+  orjson  used if it is installed (pip install orjson); it returns
+          UTF-8 bytes rather than escaping non-ASCII text
+
+Bytes anywhere else still go through the default hook, so unusual
+records serialize correctly, just more slowly. Neither backend changes
+the record it is given.
+
+    encoder = ResultEncoder()
+    encoder.dumps(record)                   # one compact JSON document
+    encoder.write(f, records)               # NDJSON into a text or binary file
+
+'python advjson.py --bench N' compares the backends with json.dumps().
+"""
+
+import base64
+import io
+import json
+
+from btleclassifier import Classifier
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Decoders in Classifier.AD_TYPES whose result is {'uuid':..., 'data':bytes}
+SERVICE_DATA_DECODERS = ('parse_ad_type_0x16', 'decode_service_data')
+
+BYTES_FORMATS = {
+    'hex':    bytes.hex,
+    'base64': lambda data: base64.b64encode(data).decode('ascii'),
+}
+
+BACKENDS = ('json', 'orjson')
+
+def service_data_keys(ad_types=Classifier.AD_TYPES):
+    """Return the result keys whose values hold raw service data."""
+    return tuple(key for (key, name, layout) in ad_types.values() if name in SERVICE_DATA_DECODERS)
+
+
+class ResultEncoder():
+    """Serialize classifier results (and records built on them). backend
+    is 'json', 'orjson' or None for orjson when available. Output is
+    compact unless indent is given; orjson only supports indent=2. With
+    compact=False the json backend produces exactly what json.dumps()
+    does, apart from serializing bytes."""
+    def __init__(self, bytes_format='hex', backend=None, indent=None, classifier=Classifier, compact=True):
+        if bytes_format not in BYTES_FORMATS:
+            raise ValueError(f"bytes_format must be one of {', '.join(BYTES_FORMATS)}")
+        if backend is None:
+            backend = 'orjson' if orjson is not None and indent in (None, 2) and compact else 'json'
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {', '.join(BACKENDS)}")
+        if backend=='orjson':
+            if orjson is None:
+                raise ValueError("orjson is not installed")
+            if indent not in (None, 2):
+                raise ValueError("orjson only supports indent=2")
+            if not compact:
+                raise ValueError("orjson only produces compact output")
+        self.bytes_format = bytes_format
+        self.backend  = backend
+        self.indent   = indent
+        self.compact  = compact
+        self.keys     = service_data_keys(classifier.AD_TYPES)
+        self.to_text  = BYTES_FORMATS[bytes_format]
+        if backend=='json':
+            separators = None if not compact else (',', ':') if indent is None else (',', ': ')
+            self.encode = json.JSONEncoder(indent=indent, separators=separators, default=self.default).encode
+        else:
+            self.option = orjson.OPT_INDENT_2 if indent else 0
+
+    def __repr__(self):
+        return f"ResultEncoder<{self.backend}, {self.bytes_format}>"
+
+    def default(self, o):
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            return self.to_text(bytes(o))
+        raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+    def prepare(self, record):
+        """Return record with its service data bytes converted to text,
+        copying only what has to change."""
+        out = record
+        for key in self.keys:
+            val = record.get(key)
+            if val is not None and not isinstance(val['data'], str):
+                if out is record:
+                    out = dict(record)
+                out[key] = {'uuid':val['uuid'], 'data':self.to_text(bytes(val['data']))}
+        return out
+
+    def dumps(self, record):
+        """Return record as a JSON string."""
+        if self.backend=='json':
+            return self.encode(self.prepare(record))
+        return orjson.dumps(self.prepare(record), default=self.default, option=self.option).decode('utf-8')
+
+    def dumps_lines(self, records):
+        """Return records as NDJSON text, one line per record."""
+        if self.backend=='json':
+            (encode, prepare) = (self.encode, self.prepare)
+            return "".join([encode(prepare(record)) + "\n" for record in records])
+        return self.dumps_lines_bytes(records).decode('utf-8')
+
+    def dumps_lines_bytes(self, records):
+        """Return records as UTF-8 NDJSON bytes."""
+        if self.backend=='json':
+            return self.dumps_lines(records).encode('utf-8')
+        (dumps, prepare, default) = (orjson.dumps, self.prepare, self.default)
+        option = self.option | orjson.OPT_APPEND_NEWLINE
+        return b"".join([dumps(prepare(record), default=default, option=option) for record in records])
+
+    def write(self, f, records, chunk=1000):
+        """Write records to f as NDJSON, chunk records at a time, so a
+        long stream never has to be held in memory. f may be a text or a
+        binary file. Returns the number of records written."""
+        binary = not isinstance(f, io.TextIOBase)
+        encode = self.dumps_lines_bytes if binary else self.dumps_lines
+        count  = 0
+        batch  = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= chunk:
+                f.write(encode(batch))
+                count += len(batch)
+                batch = []
+        if batch:
+            f.write(encode(batch))
+            count += len(batch)
+        return count
+
+
+ENCODERS = {}
+
+def dumps(record, indent=None, bytes_format='hex', compact=True):
+    """Serialize one record with a shared ResultEncoder."""
+    key = (indent, bytes_format, compact)
+    if key not in ENCODERS:
+        ENCODERS[key] = ResultEncoder(bytes_format=bytes_format, indent=indent, compact=compact)
+    return ENCODERS[key].dumps(record)
+
+
+def benchmark(count, repeat=5, seed=0):
+    """Time json.dumps() with a default= hook against each available
+    backend on count classified synthetic advertisements, best of
+    repeat runs. Returns {name: records/sec}."""
+    import time
+    import advcorpus
+    from hcireplay import json_default
+    records = Classifier().classify_many(advcorpus.generate(count, seed))
+    records = list(records)
+    candidates = {'json.dumps': lambda: "".join([json.dumps(record, default=json_default) + "\n"
+                                                 for record in records])}
+    for backend in BACKENDS:
+        if backend=='json' or orjson is not None:
+            for bytes_format in BYTES_FORMATS:
+                encoder = ResultEncoder(bytes_format, backend)
+                candidates[f"{backend}/{bytes_format}"] = lambda encoder=encoder: encoder.dumps_lines(records)
+    results = {}
+    for (name, fn) in candidates.items():
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+        results[name] = count / best
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Classify hex advertisements from stdin as NDJSON, or time the serializer')
+    parser.add_argument("--bench", type=int, metavar='N', help="Time N records through each backend")
+    parser.add_argument("--bytes", choices=sorted(BYTES_FORMATS), default='hex', help="encoding for service data")
+    parser.add_argument("--backend", choices=BACKENDS)
+    args = parser.parse_args()
+
+    if args.bench:
+        for (name, rate) in benchmark(args.bench).items():
+            print(f"{name:16} {rate:>12,.0f} records/sec")
+        exit(0)
+
+    # Re-encode hex advertisements from stdin, one per line
+    encoder = ResultEncoder(args.bytes, args.backend)
+    classifier = Classifier()
+    encoder.write(sys.stdout, (classifier.classify(bytes.fromhex(line)) for line in sys.stdin if line.strip()))
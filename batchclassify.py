@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: batchclassify.py
+"""
+Classify large inputs across a pool of processes.
+
+Input files are either text with one hex-encoded advertisement per line,
+or btsnoop/pcap captures (see hcireplay.py). Each file is split into
+byte ranges -- on line boundaries for hex files, on record boundaries
+for captures -- and the ranges are handed to the workers, which read
+the file themselves. Each worker returns one NDJSON text block per
+range, so the parent only writes strings and the output is in input
+order regardless of the number of workers.
+
+With --filter, each worker compiles the filter expression (see
+advfilter.py) and drops non-matching advertisements before classifying
+them; the per-stage drop counts are added up in the parent.
+"""
+
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from advfilter import AdvFilter
+from advjson import ResultEncoder
+from btleclassifier import DEFAULT_CLASSIFIER
+from hcireplay import CaptureReader,BTSNOOP_MAGIC,PCAP_MAGICS,report_record
+
+HEX_CHUNK_BYTES       = 1<<20
+CAPTURE_CHUNK_RECORDS = 20000
+
+HEX     = 'hex'
+CAPTURE = 'capture'
+
+def input_kind(path):
+    """Return CAPTURE for btsnoop/pcap files and HEX for anything else."""
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if head==BTSNOOP_MAGIC or head[0:4] in PCAP_MAGICS:
+        return CAPTURE
+    return HEX
+
+def hex_chunks(path, chunk_bytes=HEX_CHUNK_BYTES):
+    """Yield (start,end) byte ranges of about chunk_bytes, ending on a newline."""
+    size = os.path.getsize(path)
+    if size==0:
+        return
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                end = mm.find(b'\n', min(start + chunk_bytes, size) - 1)
+                end = size if end<0 else end + 1
+                yield (start, end)
+                start = end
+
+def make_tasks(path, chunk_bytes=HEX_CHUNK_BYTES, chunk_records=CAPTURE_CHUNK_RECORDS, expression=None):
+    """Return the list of (kind, path, start, end, filter expression)
+    tasks for one input file."""
+    kind = input_kind(path)
+    if kind==CAPTURE:
+        with CaptureReader(path) as reader:
+            return [(kind, path, start, end, expression) for (start, end) in reader.chunk_offsets(chunk_records)]
+    return [(kind, path, start, end, expression) for (start, end) in hex_chunks(path, chunk_bytes)]
+
+def classify_hex_range(path, start, end, classify, dumps, adv_filter=None):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines  = []
+    errors = 0
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line.startswith(b'#'):
+            continue
+        try:
+            payload = bytes.fromhex(line.decode('ascii'))
+        except ValueError:
+            errors += 1
+            continue
+        if adv_filter is not None and not adv_filter.match(payload):
+            continue
+        lines.append(dumps(classify(payload)))
+    return (lines, errors)
+
+def classify_capture_range(path, start, end, classify, dumps, adv_filter=None):
+    lines = []
+    with CaptureReader(path) as reader:
+        for report in reader.reports(start, end):
+            if adv_filter is not None and not adv_filter.match(report.payload, rssi=report.rssi,
+                                                               address=report.address):
+                continue
+            lines.append(dumps(report_record(report, classify(report.payload))))
+    return (lines, 0)
+
+def run_task(task):
+    """Worker entry point. Returns (count, errors, ndjson text, filter
+    stats or None)."""
+    (kind, path, start, end, expression) = task
+    classify = DEFAULT_CLASSIFIER.classify
+    adv_filter = AdvFilter(expression) if expression else None
+    dumps = ResultEncoder().dumps
+    if kind==CAPTURE:
+        (lines, errors) = classify_capture_range(path, start, end, classify, dumps, adv_filter)
+    else:
+        (lines, errors) = classify_hex_range(path, start, end, classify, dumps, adv_filter)
+    text = "\n".join(lines) + "\n" if lines else ""
+    return (len(lines), errors, text, adv_filter.stats() if adv_filter else None)
+
+def run(paths, out, workers=1, chunk_bytes=HEX_CHUNK_BYTES, chunk_records=CAPTURE_CHUNK_RECORDS,
+        adv_filter=None):
+    """Classify every advertisement in paths, writing NDJSON to out in
+    input order. Returns (count, errors). If adv_filter is given, only
+    matching advertisements are classified, and the workers' drop
+    counts are merged into it."""
+    expression = adv_filter.expression if adv_filter else None
+    tasks = []
+    for path in paths:
+        tasks.extend(make_tasks(path, chunk_bytes, chunk_records, expression))
+    if workers <= 1:
+        return write_results(map(run_task, tasks), out, adv_filter)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return write_results(executor.map(run_task, tasks), out, adv_filter)
+
+def write_results(results, out, adv_filter=None):
+    count = errors = 0
+    for (n, e, text, filter_stats) in results:
+        out.write(text)
+        count  += n
+        errors += e
+        if adv_filter is not None and filter_stats:
+            adv_filter.merge(filter_stats)
+    return (count, errors)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Classify hex-per-line or capture files in parallel')
+    parser.add_argument("inputs", nargs='+', help="hex-per-line, btsnoop or pcap files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), metavar='N',
+                        help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--chunk-bytes", type=int, default=HEX_CHUNK_BYTES,
+                        help="bytes of hex input per task (default: %(default)s)")
+    parser.add_argument("--chunk-records", type=int, default=CAPTURE_CHUNK_RECORDS,
+                        help="capture records per task (default: %(default)s)")
+    parser.add_argument("--output", "-o", help="write NDJSON here instead of stdout")
+    parser.add_argument("--filter", help="only classify advertisements matching this expression (see advfilter.py)")
+    args = parser.parse_args()
+
+    adv_filter = AdvFilter(args.filter) if args.filter else None
+    out = open(args.output, 'w') if args.output else sys.stdout
+    t0  = time.perf_counter()
+    (count, errors) = run(args.inputs, out, workers=args.workers,
+                          chunk_bytes=args.chunk_bytes, chunk_records=args.chunk_records,
+                          adv_filter=adv_filter)
+    elapsed = time.perf_counter() - t0
+    if args.output:
+        out.close()
+    print(f"{count} records ({errors} bad lines) in {elapsed:.3f}s with {args.workers} workers: "
+          f"{count/elapsed if elapsed else 0:,.0f} records/sec", file=sys.stderr)
+    if adv_filter:
+        print(f"filter: {adv_filter.stats()}", file=sys.stderr)
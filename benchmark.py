@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: benchmark.py
+"""
+Throughput benchmarks for the classifier, with a regression gate.
+
+Each stage is timed over a synthetic corpus from advcorpus.py at
+several sizes, best of --repeat runs (a stage that finishes in under
+MIN_TIME is called as many times as it takes), and reported in
+items/second. Results are written as JSON. Given a --baseline, the run
+fails (exit status 1) if any stage is more than --threshold slower
+than the baseline figure for the same stage and size, and is still
+that slow when timed again.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.25
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --reference /tmp/old.py
+
+--reference compares classify_many, with metrics off, against the
+Classifier from another copy of btleclassifier.py, e.g. one from before
+a change (git show REV:btleclassifier.py > /tmp/old.py). The runs of
+the two alternate, so both see the same machine load.
+
+The baseline is machine-specific; regenerate it with --save-baseline
+when the benchmark host changes. Every stage run alternates with a
+fixed loop that uses none of this package, and the gate scales each
+baseline figure by how fast that loop ran next to the stage then and
+now, so a host that is busier or slower at the time does not read as a
+regression.
+"""
+
+import json
+import platform
+import sys
+import time
+
+import advcorpus
+from advfilter import AdvFilter
+from advjson import ResultEncoder
+from btleclassifier import (BTLEAdvClassifier,Classifier,LengthRuns,
+                            MALFORMED,DEFAULT_VENDORS,VendorRegistry)
+from instrumentation import Metrics
+
+SIZES  = (1000, 10000, 100000)
+REPEAT = 5
+THRESHOLD = 0.25
+MIN_TIME  = 0.02    # seconds; shorter stages are run several times per timing
+FILTER = "company==0x004c and apple_type in {0x0c, 0x10}"
+
+def run_calibration(items):
+    """Interpreter work that touches none of this package."""
+    for i in items:
+        d = {'n': i, 'text': str(i)}
+        d['len'] = len(d['text'])
+
+CALIBRATION = range(20000)
+
+def loops(fn, items):
+    """How many calls of fn(items) take at least MIN_TIME."""
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn(items)
+        if time.perf_counter() - t0 >= MIN_TIME:
+            return number
+        number *= 2
+
+def best_rate(fn, items, repeat):
+    """Time fn(items) repeat times, each right after a run of
+    run_calibration(); return (items/sec, calibration items/sec), each
+    from its best run."""
+    timed = ((run_calibration, CALIBRATION), (fn, items))
+    numbers = [loops(f, x) for (f, x) in timed]
+    best = [float('inf'), float('inf')]
+    for _ in range(repeat):
+        for (i, (f, x)) in enumerate(timed):
+            t0 = time.perf_counter()
+            for _ in range(numbers[i]):
+                f(x)
+            best[i] = min(best[i], (time.perf_counter() - t0) / numbers[i])
+    return (len(items) / best[1], len(CALIBRATION) / best[0])
+
+def structures_by_type(corpus):
+    """Map AD type -> list of structure data views in the corpus."""
+    by_type = {}
+    for adv in corpus:
+        with LengthRuns(adv) as lr:
+            for data in lr.get_data():
+                if len(data):
+                    by_type.setdefault(data[0], []).append(data[1:])
+    return by_type
+
+def run_lengthruns(corpus):
+    for adv in corpus:
+        with LengthRuns(adv) as lr:
+            for data in lr.get_data():
+                pass
+
+def run_classifier(corpus):
+    for adv in corpus:
+        BTLEAdvClassifier(adv)
+
+def make_vendor_registry(extra=500):
+    """The default vendor patterns plus `extra` made-up company IDs and
+    service UUIDs, so matching is timed with hundreds of vendors."""
+    registry = VendorRegistry()
+    for token in DEFAULT_VENDORS.patterns:
+        registry.register(*token)
+    for i in range(extra):
+        registry.register(f'vendor-{i}', 0x1000 + i, ad_type=0xff if i%2 else 0x16)
+    return registry
+
+def make_parser_stage(parser):
+    def run(structures):
+        for data in structures:
+            try:
+                parser(data)
+            except MALFORMED:
+                pass
+    return run
+
+def make_json_stage():
+    def run(objs):
+        for obj in objs:
+            obj.json()
+    return run
+
+def stages(corpus):
+    """Yield (name, fn, items) for every stage to time on corpus."""
+    classifier = Classifier()
+    yield ('LengthRuns', run_lengthruns, corpus)
+    by_type = structures_by_type(corpus)
+    for (ad_type, (key, parser)) in sorted(classifier.ad_type_parsers.items()):
+        if by_type.get(ad_type):
+            yield (f'parse_ad_type_0x{ad_type:02x}', make_parser_stage(parser), by_type[ad_type])
+    yield ('BTLEAdvClassifier', run_classifier, corpus)
+    yield ('classify_many', lambda items: sum(1 for d in classifier.classify_many(items)), corpus)
+    registry = make_vendor_registry()
+    yield ('VendorRegistry.match', lambda items: [registry.match(adv) for adv in items], corpus)
+    adv_filter = AdvFilter(FILTER)
+    yield ('AdvFilter.match', lambda items: [adv_filter.match(adv) for adv in items], corpus)
+    yield ('classify_lazy', lambda items: [classifier.classify_lazy(adv) for adv in items], corpus)
+    # the same engine with instrumentation on, to show what it costs
+    instrumented = Classifier(metrics=Metrics())
+    yield ('classify_many+metrics', lambda items: sum(1 for d in instrumented.classify_many(items)), corpus)
+    objs = [BTLEAdvClassifier(adv) for adv in corpus]
+    yield ('json', make_json_stage(), objs)
+    encoder = ResultEncoder()
+    yield ('ResultEncoder.dumps_lines', encoder.dumps_lines, [obj.dict() for obj in objs])
+
+def load_reference(path):
+    """Import another copy of btleclassifier.py under its own name."""
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('btleclassifier_reference', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def compare_reference(corpus, reference, repeat=REPEAT):
+    """Return the classify_many rates (this engine, reference's engine)
+    on corpus, best of repeat alternating runs."""
+    engines = (Classifier(), reference.Classifier())
+    best = [float('inf')] * len(engines)
+    for _ in range(repeat):
+        for (i, engine) in enumerate(engines):
+            t0 = time.perf_counter()
+            sum(1 for d in engine.classify_many(corpus))
+            best[i] = min(best[i], time.perf_counter() - t0)
+    return tuple(len(corpus) / t for t in best)
+
+def run_suite(sizes=SIZES, seed=0, repeat=REPEAT, verbose=False, only=None):
+    """Return ({stage@size: rate}, {stage@size: calibration rate}), for
+    just the stage@size keys in only if it is given."""
+    (results, calibration) = ({}, {})
+    for size in sizes:
+        if only is not None and not any(key.endswith(f"@{size}") for key in only):
+            continue
+        corpus = advcorpus.generate(size, seed)
+        for (name, fn, items) in stages(corpus):
+            key = f"{name}@{size}"
+            if only is not None and key not in only:
+                continue
+            (results[key], calibration[key]) = best_rate(fn, items, repeat)
+            if verbose:
+                print(f"{key:40} {results[key]:>14,.0f} /sec", file=sys.stderr)
+    return (results, calibration)
+
+def compare(results, baseline, threshold=THRESHOLD, calibration=None, base_calibration=None):
+    """Return a list of (key, baseline rate, rate) for stages more than
+    threshold slower than baseline. With both calibrations, each baseline
+    rate is first scaled by this run's calibration rate for that stage
+    over the baseline's."""
+    regressions = []
+    for (key, base_rate) in baseline.items():
+        rate = results.get(key)
+        if calibration and base_calibration and key in calibration and key in base_calibration:
+            base_rate *= calibration[key] / base_calibration[key]
+        if rate is not None and rate < base_rate * (1 - threshold):
+            regressions.append((key, base_rate, rate))
+    return regressions
+
+def report(results, seed, repeat, calibration):
+    return {'python':platform.python_version(),
+            'platform':platform.platform(),
+            'time':time.time(),
+            'seed':seed,
+            'repeat':repeat,
+            'calibration':calibration,
+            'results':results}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Classifier throughput benchmarks')
+    parser.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(',')], default=SIZES,
+                        help="comma-separated corpus sizes (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="compare against this results JSON")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed fractional slowdown against the baseline (default: %(default)s)")
+    parser.add_argument("--save-baseline", metavar='FILE', help="write results JSON as the new baseline")
+    parser.add_argument("--reference", metavar='FILE',
+                        help="compare classify_many against the Classifier in this copy of btleclassifier.py")
+    args = parser.parse_args()
+
+    if args.reference:
+        reference = load_reference(args.reference)
+        for size in args.sizes:
+            (rate, ref_rate) = compare_reference(advcorpus.generate(size, args.seed), reference, args.repeat)
+            print(f"classify_many@{size}: {rate:,.0f}/sec, {args.reference} {ref_rate:,.0f}/sec "
+                  f"({rate/ref_rate-1:+.1%})", file=sys.stderr)
+        exit(0)
+
+    (results, calibration) = run_suite(args.sizes, args.seed, args.repeat, verbose=True)
+    for size in args.sizes:
+        (off, on) = (results[f'classify_many@{size}'], results[f'classify_many+metrics@{size}'])
+        print(f"instrumentation overhead @{size}: {1 - on/off:.1%}", file=sys.stderr)
+    doc = report(results, args.seed, args.repeat, calibration)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(doc, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold,
+                              calibration, baseline.get('calibration'))
+        if regressions:
+            # a real regression shows up again; a burst of host load does not
+            only = {key for (key, base_rate, rate) in regressions}
+            print(f"re-timing {len(only)} slow stage(s)", file=sys.stderr)
+            (results, calibration) = run_suite(args.sizes, args.seed, args.repeat, True, only)
+            regressions = compare(results, baseline['results'], args.threshold,
+                                  calibration, baseline.get('calibration'))
+        for (key, base_rate, rate) in regressions:
+            print(f"REGRESSION {key}: {rate:,.0f}/sec vs scaled baseline {base_rate:,.0f}/sec "
+                  f"({rate/base_rate-1:+.0%})", file=sys.stderr)
+        if regressions:
+            exit(1)
+        print(f"no regressions beyond {args.threshold:.0%} against {args.baseline}", file=sys.stderr)
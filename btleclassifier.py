@@ -4,6 +4,12 @@
 
 import codecs
 import json
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+from companies import company_name
 
 """
 Advertising Data Type (AD Type) Definitions here:
@@ -17,54 +23,6 @@ https://support.kontakt.io/hc/en-gb/articles/201492492-iBeacon-advertising-packe
 def hexdump(s):
     return " ".join([hex(ch)[2:] for ch in s])
 
-class BTLEAdvIDToken(object):
-    """This isn't being used. Not sure what it's for."""
-    def __init__(self, token_key):
-        self.type    = str(token_key)
-        self.parser  = BTLEAdvIDToken.tokens[self.type]['parser']
-        self.pattern = BTLEAdvIDToken.tokens[self.type]['pattern']
-        self.tokens  = BTLEAdvIDToken.tokens[self.type]['tokens']
-
-    @classmethod 
-    def get_matched_tokens(cls, data):
-        for vendor in BTLEAdvIDToken.tokens.keys():
-            token = BTLEAdvIDToken(vendor)
-            if token.pattern in data['raw']:
-                return token
-        return None
-
-    TOKENS = {
-        'Apple': { 'parser': 'parse_token_apple',      
-                   'pattern': "ff4c00",
-                   'tokens': ["handoff", "nearby"] },
-        'Microsoft': { 'parser': 'parse_token_microsoft',  
-                       'pattern': "ff0600",
-                       'tokens': ["msdata"] }
-    }
-
-#    @classmethod
-#    def parse_token_apple(cls, data):
-#        result = {}
-#        id_tokens = ['handoff', 'nearby']
-#        if 'manufacturer-specific' in data.keys() \
-#            and isinstance(data['manufacturer-specific'], dict):
-#            for t in id_tokens:
-#                if t in data['manufacturer-specific'].keys() \
-#                    and isinstance(data['manufacturer-specific'][t], str):
-#                    result[t] = data['manufacturer-specific'][t]
-#                else:
-#                    result[t] = None
-#        return result
-
-#    @classmethod
-#    def parse_token_microsoft(cls, data):
-#        print "Parsing Microsoft", data
-#        return [] 
-
-#    @classmethod
-#    def get_token_type(cls, data):
-#        return
-
 
 RAW = 'raw'
 HEX = 'hex'
@@ -76,6 +34,7 @@ UNKNOWN = 'unknown'
 COMPANY_ID = 'company_id'
 COMPANY_NAME = 'company_name'
 COMPANY_HEX  = 'company_raw'
+TX_POWER_LEVEL = 'tx-power-level'
 IBEACON='ibeacon'
 
 FLAG_LEL = 'LE Limited Discoverable Mode'
@@ -84,6 +43,37 @@ FLAG_BR  = 'BR/EDR Not Supported (i.e. bit 37 of LMP Extended Feature bits Page
 FLAG_SLEBR = 'Simultaneous LE and BR/EDR to Same Device Capable (Controller) (i.e. bit 49 of LMP Extended Feature bits Page 0)'
 FLAG_LEBRS = 'Simultaneous LE and BR/EDR to Same Device Capable (Host) (i.e. bit 66 of LMP Extended Feature bits Page 1)'
 
+# Precompiled layouts for the AD type table (all little-endian)
+U8      = struct.Struct('<B')
+S8      = struct.Struct('<b')
+U16     = struct.Struct('<H')
+U32     = struct.Struct('<I')
+UUID128 = struct.Struct('<QQ')
+ADDRESS = struct.Struct('<6s')
+U24     = struct.Struct('<BH')
+LE_ADDRESS  = struct.Struct('<6sB')
+CONN_INTERVAL = struct.Struct('<HH')
+CHANNEL_MAP = struct.Struct('<5sH')
+
+# A structure too short for its layout raises one of these
+MALFORMED = (IndexError, struct.error)
+
+# BTLEAdvResult caches this for keys that have no decodable structure
+ABSENT = object()
+
+def json_default(o):
+    """json default= hook: the raw bytes in service data, as hex."""
+    if isinstance(o,(bytes,bytearray,memoryview)):
+        return bytes(o).hex()
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+# Built once: json.dumps(default=...) would build a new encoder per call
+JSON_ENCODER = json.JSONEncoder(default=json_default)
+
+# URI scheme name string mapping (Bluetooth assigned numbers); the
+# scheme is the first code point of a URI AD structure.
+URI_SCHEMES = {0x01: '', 0x16: 'http:', 0x17: 'https:'}
+
 FLAG_OOB = "OOB data present"
 FLAG_NO_OOB = "OOB data not present"
 FLAG_LE  = "LE supported (Host) (i.e. bit 65 of LMP Extended Feature bits Page 1"
@@ -95,11 +85,33 @@ def word16be(data):
     """return data[0] and data[1] as a 16-bit Big Ended Word"""
     return (data[1] << 8) | data[0]
 
+def uuid128(data_lo, data_hi):
+    """Format a 128-bit UUID read as two little-endian 64-bit halves."""
+    h = f"{data_hi:016x}{data_lo:016x}"
+    return f"{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+
+def address(data):
+    """Format a little-endian 6-byte device address as aa:bb:cc:dd:ee:ff."""
+    return bytes(reversed(data)).hex(':')
+
+def as_view(buf):
+    """Return a flat, unsigned-byte memoryview over buf without copying.
+    Accepts bytes, bytearray, mmap, memoryview, etc."""
+    view = memoryview(buf)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
 class AbstractContextManager():
-    def __init__(self, buf):
-        assert type(buf)==bytes
-        self.buf = buf
-        self.pos = 0
+    """Base for the run walkers. buf may be any object supporting the
+    buffer protocol; start and end restrict the walk to a region of it,
+    so many advertisements packed into one bytearray can be walked in
+    place. Everything yielded is a memoryview into buf; nothing is
+    copied until the caller asks for bytes() or .hex()."""
+    def __init__(self, buf, start=0, end=None):
+        self.buf = as_view(buf)
+        self.pos = start
+        self.end = len(self.buf) if end is None else end
     def __enter__(self):
         return self
     def __exit__(self, type, value, traceback):
@@ -109,14 +121,22 @@ class LengthRuns(AbstractContextManager):
     """Given a buffer, return a series of (dtaa) fields. Assumes
     that data contains a set of (length,data) fields. Used by BLE header."""
     def get_data(self, lensize=1):
-        while self.pos < len(self.buf):
-            try:
-                ad_len  = self.buf[self.pos]
-                ad_data = self.buf[self.pos+1:self.pos+ad_len+1]
-                self.pos += 1 + ad_len
-                yield ad_data
-            except IndexError as e:
-                pass
+        buf = self.buf
+        while self.pos < self.end:
+            ad_len  = buf[self.pos]
+            start   = self.pos + 1
+            self.pos = start + ad_len
+            yield buf[start:min(self.pos, self.end)]
+
+    def get_spans(self):
+        """Like get_data(), but yield (start,end) offsets into the
+        buffer instead of views."""
+        buf = self.buf
+        while self.pos < self.end:
+            ad_len  = buf[self.pos]
+            start   = self.pos + 1
+            self.pos = start + ad_len
+            yield (start, min(self.pos, self.end))
     
 
 class AppleTypeLengthRuns(AbstractContextManager):
@@ -127,51 +147,275 @@ class AppleTypeLengthRuns(AbstractContextManager):
 
     """
     def get_type_data(self, lensize=1):
-        while self.pos < len(self.buf):
+        buf = self.buf
+        while self.pos + 1 < self.end:
+            ad_type = buf[self.pos]
+            ad_len  = buf[self.pos+1]
+            start   = self.pos + 2
+            self.pos = start + ad_len
+            yield (ad_type, buf[start:min(self.pos, self.end)])
+
+class Classifier():
+    """Reusable classification engine. The AD type and Apple record
+    dispatch tables are built once, when the engine is created, instead
+    of on every AD structure. classify() returns the same dict as
+    BTLEAdvClassifier(...).dict(); classify_many() streams them.
+    """
+
+    # AD type -> (result key, decoder method name, layout). Decoders
+    # with a layout are called as decoder(layout, data); the rest as
+    # decoder(data). Types not listed here are reported under UNKNOWN.
+    # See btleclassifier.txt for the list.
+    AD_TYPES = {
+        0x01: (FLAGS,                               'parse_ad_type_0x01',  None),
+        0x02: ('incomplete-uuid16',                 'decode_uuid_list',    U16),
+        0x03: ('complete-uuid16',                   'decode_uuid_list',    U16),
+        0x04: ('incomplete-uuid32',                 'decode_uuid_list',    U32),
+        0x05: ('complete-uuid32',                   'decode_uuid_list',    U32),
+        0x06: ('incomplete-uuid128',                'decode_uuid128_list', UUID128),
+        0x07: ('complete-uuid128',                  'decode_uuid128_list', UUID128),
+        0x08: ('shortened-local-name',              'decode_text',         None),
+        0x09: ('complete-local-name',               'decode_text',         None),
+        0x0a: (TX_POWER_LEVEL,                      'decode_scalar',       S8),
+        0x0d: ('class-of-device',                   'parse_ad_type_0x0d',  U24),
+        0x0e: ('simple-pairing-hash-c',             'decode_hex',          None),
+        0x0f: ('simple-pairing-randomizer-r',       'decode_hex',          None),
+        0x10: ('security-manager-tk-value',         'decode_hex',          None),
+        0x11: (SEC_MG_OOB_FLAGS,                    'parse_ad_type_0x11',  None),
+        0x12: ('slave-connection-interval-range',   'decode_fields',       (CONN_INTERVAL, ('min', 'max'))),
+        0x14: ('solicitation-uuid16',               'decode_uuid_list',    U16),
+        0x15: ('solicitation-uuid128',              'decode_uuid128_list', UUID128),
+        0x16: (SERVICE_DATA,                        'parse_ad_type_0x16',  None),
+        0x17: ('public-target-address',             'decode_address_list', ADDRESS),
+        0x18: ('random-target-address',             'decode_address_list', ADDRESS),
+        0x19: ('appearance',                        'decode_scalar',       U16),
+        0x1a: ('advertising-interval',              'decode_scalar',       U16),
+        0x1b: ('le-device-address',                 'parse_ad_type_0x1b',  LE_ADDRESS),
+        0x1c: ('le-role',                           'decode_scalar',       U8),
+        0x1d: ('simple-pairing-hash-c256',          'decode_hex',          None),
+        0x1e: ('simple-pairing-randomizer-r256',    'decode_hex',          None),
+        0x1f: ('solicitation-uuid32',               'decode_uuid_list',    U32),
+        0x20: ('service-data-uuid32',               'decode_service_data', U32),
+        0x21: ('service-data-uuid128',              'decode_service_data', UUID128),
+        0x22: ('le-sc-confirmation-value',          'decode_hex',          None),
+        0x23: ('le-sc-random-value',                'decode_hex',          None),
+        0x24: ('uri',                               'decode_uri',          None),
+        0x25: ('indoor-positioning',                'decode_hex',          None),
+        0x26: ('transport-discovery-data',          'decode_hex',          None),
+        0x27: ('le-supported-features',             'decode_hex',          None),
+        0x28: ('channel-map-update-indication',     'parse_ad_type_0x28',  CHANNEL_MAP),
+        0x29: ('pb-adv',                            'decode_hex',          None),
+        0x2a: ('mesh-message',                      'decode_hex',          None),
+        0x2b: ('mesh-beacon',                       'decode_hex',          None),
+        0x3d: ('3d-information-data',               'decode_hex',          None),
+        0xff: (MANUFACTURER_SPECIFIC,               'parse_ad_type_0xff',  None),
+    }
+
+    # Names that take precedence over the SIG's (see companies.py)
+    COMPANY_ID_MAP = {
+        0x0006: 'Microsoft',
+        0x004c: 'Apple'
+    }
+
+    APPLE_DATA_TYPES = {
+        0x02: 'ibeacon',
+        0x05: 'airdrop',
+        0x07: 'airpods',
+        0x08: '(unknown)',
+        0x09: 'airplay_dest',
+        0x0a: 'airplay_src',
+        0x0c: 'handoff',
+        0x10: 'nearby',
+    }
+
+    # Apple type -> parser method name
+    APPLE_TYPE_PARSERS = {
+        0x0c: 'parse_apple_type_0x0c',
+        0x0d: 'parse_apple_type_0x0d',
+        0x0e: 'parse_apple_type_0x0e',
+        0x0f: 'parse_apple_type_0x0f',
+        0x10: 'parse_apple_type_0x10',
+    }
+
+    NEARBY_ACTION_CODES = {1:"iOS recently updated",
+                           3:"Locked Screen",
+                           7:"Transition Phase",
+                           10:"Locked Screen, Inform Apple Watch",
+                           11:"Active User",
+                           13:"Unknown",
+                           14:"Phone Call or Facetime"}
+
+    def __init__(self, cache=None, metrics=None):
+        self.cache = cache
+        self.metrics = metrics
+        self.ad_type_parsers = {ad_type: (key, self.make_decoder(name, layout))
+                                for (ad_type, (key, name, layout)) in self.AD_TYPES.items()}
+        self.apple_type_parsers = {apple_type: getattr(self, name)
+                                   for (apple_type, name) in self.APPLE_TYPE_PARSERS.items()}
+        if metrics is not None:
+            self.instrument(metrics)
+
+    def make_decoder(self, name, layout):
+        """Bind an AD_TYPES row's decoder to its layout."""
+        decoder = getattr(self, name)
+        return decoder if layout is None else partial(decoder, layout)
+
+    def instrument(self, metrics):
+        """Replace the dispatch tables with timed, counted wrappers (see
+        instrumentation.py). Only called when metrics are requested;
+        'benchmark.py --reference' measures the engine without them
+        against an older copy of this module."""
+        self.decode = metrics.timed(self.decode, 'decode', 'advertisements')
+        self.ad_type_parsers = {ad_type: (key, metrics.timed(parser, f'parse_ad_type_0x{ad_type:02x}',
+                                                             f'ad_type.0x{ad_type:02x}'))
+                                for (ad_type, (key, parser)) in self.ad_type_parsers.items()}
+        self.apple_type_parsers = {apple_type: metrics.timed(parser, f'parse_apple_type_0x{apple_type:02x}',
+                                                             f'apple_type.0x{apple_type:02x}')
+                                   for (apple_type, parser) in self.apple_type_parsers.items()}
+        counters = metrics.counters
+        parse_unknown = self.parse_unknown
+        parse_apple_unknown = self.parse_apple_unknown
+        def counted_unknown(ad_type, data):
+            counters[f'ad_type.0x{ad_type:02x}'] += 1
+            return parse_unknown(ad_type, data)
+        def counted_apple_unknown(apple_type, apple_data):
+            counters[f'apple_type.0x{apple_type:02x}'] += 1
+            return parse_apple_unknown(apple_type, apple_data)
+        self.parse_unknown = metrics.timed(counted_unknown, 'parse_unknown')
+        self.parse_apple_unknown = metrics.timed(counted_apple_unknown, 'parse_apple_unknown')
+
+    def classify(self, adv_data = bytes(), manuf_data=bytes()):
+        """Classify one advertisement and return the result dict.
+        adv_data and manuf_data may be bytes or any buffer (e.g. a
+        memoryview slice of a larger capture buffer). If the engine has
+        a cache, byte-identical advertisements return the same (shared)
+        dict, which callers must not modify."""
+        if self.cache is None:
+            return self.decode(adv_data, manuf_data)
+        key = (bytes(adv_data), bytes(manuf_data))
+        d = self.cache.get(key)
+        if d is None:
+            d = self.decode(adv_data, manuf_data)
+            self.cache.put(key, d)
+        return d
+
+    def decode(self, adv_data = bytes(), manuf_data=bytes()):
+        """Classify one advertisement, bypassing the cache."""
+        view = as_view(adv_data)
+        d = {HEX: view.hex()}
+        parsers = self.ad_type_parsers
+        # Walk the (length,type,data) runs in place; each parser gets a
+        # single view of its data, with the type byte already skipped.
+        pos = 0
+        end = len(view)
+        while pos < end:
+            start = pos + 1
+            pos   = start + view[pos]
+            if start >= end or start >= pos:
+                continue
+            ad_type = view[start]
+            data    = view[start+1:pos]
+            if ad_type in parsers:
+                (key, parser) = parsers[ad_type]
+                try:
+                    d[key] = parser(data)
+                    continue
+                except MALFORMED:
+                    pass        # structure too short for its type
+            d.setdefault(UNKNOWN, []).append(self.parse_unknown(ad_type, data))
+
+        if manuf_data:
+            try:
+                # through the table, so an instrumented engine counts and times it
+                d[MANUFACTURER_SPECIFIC] = parsers[0xff][1](as_view(manuf_data))
+            except MALFORMED:
+                d.setdefault(UNKNOWN, []).append(self.parse_unknown(0xff, as_view(manuf_data)))
+        return d
+
+    def classify_many(self, iterable_of_bytes):
+        """Generator that classifies each advertisement in turn."""
+        classify = self.classify
+        for adv_data in iterable_of_bytes:
+            yield classify(adv_data)
+
+    def classify_spans(self, buf, spans):
+        """Classify advertisements packed into a single buffer. spans is
+        an iterable of (offset,length) pairs; each advertisement is
+        parsed in place through a memoryview."""
+        view = as_view(buf)
+        classify = self.classify
+        for (offset, length) in spans:
+            yield classify(view[offset:offset+length])
+
+    def classify_lazy(self, adv_data = bytes(), manuf_data=bytes()):
+        """Like classify(), but only locate the AD structures. Returns a
+        BTLEAdvResult that decodes each field when it is first read."""
+        view  = as_view(adv_data)
+        spans = []
+        pos = 0
+        end = len(view)
+        while pos < end:
+            start = pos + 1
+            pos   = start + view[pos]
+            if start >= end or start >= pos:
+                continue
+            spans += (view[start], start+1, min(pos, end))
+        return BTLEAdvResult(self, adv_data, tuple(spans), manuf_data or None)
+
+    def parse_ad_structure(self, d, data):
+        """Decode a single (type,data) AD structure into d."""
+        ad_type = data[0]
+        if ad_type in self.ad_type_parsers:
+            (key, parser) = self.ad_type_parsers[ad_type]
             try:
-                ad_type = self.buf[self.pos]
-                ad_len  = self.buf[self.pos+1]
-                ad_data = self.buf[self.pos+2:self.pos+ad_len+2]
-                self.pos += 2 + ad_len
-                yield (ad_type,ad_data)
-            except IndexError as e:
+                d[key] = parser(data[1:])
+                return
+            except MALFORMED:
                 pass
+        d.setdefault(UNKNOWN, []).append(self.parse_unknown(ad_type, data[1:]))
 
-class BTLEAdvClassifier():
-    def __init__(self, adv_data = bytes(), manuf_data=bytes()):
-        self.d      = {}
-        self.d[HEX] =  adv_data.hex()
+    def parse_unknown(self, ad_type, data):
+        return {'type':ad_type, 'hex':data.hex()}
 
-        with LengthRuns(adv_data) as lr:
-            for data in lr.get_data():
-                self.parse_ad_structure( data)
+    # Generic decoders used by the AD_TYPES table
 
-        if manuf_data:
-            self.parse_ad_type_0xff(manuf_data)
+    def decode_scalar(self, layout, data):
+        return layout.unpack_from(data)[0]
 
-    def __repr__(self):
-        return f"BTLEAdvClassifier<{self.d}>"
+    def decode_fields(self, layout, data):
+        (fmt, names) = layout
+        return dict(zip(names, fmt.unpack_from(data)))
 
-    def json(self,indent=None):
-        return json.dumps(self.d,indent=indent)
+    def decode_hex(self, data):
+        return data.hex()
 
-    def dict(self):
-        return self.d
+    def decode_text(self, data):
+        return bytes(data).decode('utf-8', 'replace')
 
-    def parse_ad_structure(self, data):
-        AD_TYPE_PARSERS = {
-            0x01: self.parse_ad_type_0x01,
-            0x11: self.parse_ad_type_0x11,
-            0x16: self.parse_ad_type_0x16,
-            0xff: self.parse_ad_type_0xff}
+    def decode_uuid_list(self, layout, data):
+        usable = len(data) - len(data) % layout.size
+        return [uuid for (uuid,) in layout.iter_unpack(data[:usable])]
 
+    def decode_uuid128_list(self, layout, data):
+        usable = len(data) - len(data) % layout.size
+        return [uuid128(lo, hi) for (lo, hi) in layout.iter_unpack(data[:usable])]
 
-        ad_type = data[0]
-        ad_data = data[1:]
-        if ad_type in AD_TYPE_PARSERS:
-            AD_TYPE_PARSERS[ad_type](ad_data)
-        else:
-            self.d[UNKNOWN] = {'type':ad_type, 'hex':ad_data.hex()}
+    def decode_address_list(self, layout, data):
+        usable = len(data) - len(data) % layout.size
+        return [address(addr) for (addr,) in layout.iter_unpack(data[:usable])]
+
+    def decode_service_data(self, layout, data):
+        uuid = layout.unpack_from(data)
+        uuid = uuid[0] if len(uuid)==1 else uuid128(*uuid)
+        return {'uuid':uuid, 'data':bytes(data[layout.size:])}
+
+    def decode_uri(self, data):
+        """Core Specification Supplement, Part A, 1.18: the scheme is
+        encoded as a single code point from the URI scheme name mapping."""
+        text = bytes(data).decode('utf-8', 'replace')
+        if text and ord(text[0]) in URI_SCHEMES:
+            return URI_SCHEMES[ord(text[0])] + text[1:]
+        return text
 
     def parse_ad_type_0x01(self, data):
         """ Implementation of Bluetooth Specification Version 4.0 [Vol 3] Table 18.1: Flags
@@ -188,7 +432,7 @@ class BTLEAdvClassifier():
             ad_flags.append(FLAG_SLEBR)
         if val & 0x01<<4:
             ad_flags.append(FLAG_LEBRS)
-        self.d[FLAGS] = ad_flags
+        return ad_flags
 
     def parse_ad_type_0x11(self, data):
         """ Implementation of Bluetooth Specification Version 4.0 [Vol 3] 
@@ -208,7 +452,7 @@ class BTLEAdvClassifier():
             ad_flags.append( FLAG_RANDOM_ADDRESS )
         else:
             ad_flags.append( FLAG_PUBLIC_ADDRESS )
-        self.d[SEC_MG_OOB_FLAGS] = ad_flags
+        return ad_flags
 
     def parse_ad_type_0x16(self, data):
         """Implementation of Bluetooth Specification Version 4.0 [Vol 3]
@@ -216,24 +460,24 @@ class BTLEAdvClassifier():
             https://www.bluetooth.com/specifications/gatt/services
         """
         service_uuid = word16be(data[0:2])
-        service_data = data[2:] 
-        self.d[SERVICE_DATA] = {'uuid':service_uuid, 'data':service_data}
+        service_data = bytes(data[2:])
+        return {'uuid':service_uuid, 'data':service_data}
 
-    COMPANY_ID_MAP = {
-        0x0006: 'Microsoft',
-        0x004c: 'Apple'
-    }
+    def parse_ad_type_0x0d(self, layout, data):
+        """Class of Device: 24 bits, service classes in the top 11."""
+        (lo, hi) = layout.unpack_from(data)
+        cod = lo | hi<<8
+        return {'service_classes':cod>>13, 'major':(cod>>8) & 0x1f, 'minor':(cod>>2) & 0x3f}
 
-    APPLE_DATA_TYPES = {
-        0x02: 'ibeacon',
-        0x05: 'airdrop',
-        0x07: 'airpods',
-        0x08: '(unknown)',
-        0x09: 'airplay_dest',
-        0x0a: 'airplay_src',
-        0x0c: 'handoff',
-        0x10: 'nearby',
-    }
+    def parse_ad_type_0x1b(self, layout, data):
+        """LE Bluetooth Device Address: address, then 0 (public) or 1 (random)."""
+        (addr, addr_type) = layout.unpack_from(data)
+        return {'address':address(addr), 'random':bool(addr_type & 0x01)}
+
+    def parse_ad_type_0x28(self, layout, data):
+        """Channel Map Update Indication: 5-octet channel map, then the instant."""
+        (channel_map, instant) = layout.unpack_from(data)
+        return {'channel_map':channel_map.hex(), 'instant':instant}
 
     def parse_ad_type_0xff(self, data):
         """Implementation of Bluetooth Specification Version 4.0 [Vol 3]
@@ -249,51 +493,475 @@ class BTLEAdvClassifier():
         d = {}
         d[COMPANY_ID]   = company_id
         d[COMPANY_HEX]  = man_data.hex()
-        d[COMPANY_NAME] = self.COMPANY_ID_MAP.get(company_id,'??')
-        if d[COMPANY_NAME]=='Apple':
+        d[COMPANY_NAME] = self.COMPANY_ID_MAP.get(company_id) or company_name(company_id,'??')
+        if company_id==0x004c:
             d['records'] = []
+            apple_parsers = self.apple_type_parsers
             with AppleTypeLengthRuns(man_data) as tr:
                 for (apple_type,apple_data) in tr.get_type_data():
-                    if apple_type==0x0c:
-                        record = {'type':'Handoff Message',
-                                  'Clipboard Status':apple_data[0],
-                                  'Sequence Number':word16be(apple_data[1:3])
-                                  }
-                    elif apple_type==0x0d:
-                        record = {'type':'Wi-Fi Settings',
-                                  'iCloud ID':apple_data[2:].hex()
-                                  }
-                    elif apple_type==0x0e:
-                        record = {'type':'Instant Hotspot',
-                                  'Battery Life': apple_data[4],
-                                  'Cell Service': apple_data[6],
-                                  'Cell Bars': apple_data[7]}
-                    elif apple_type==0x0f:
-                        record = {'type':'Wi-Fi Join Network',
-                                  'data':apple_data.hex()}
-                    elif apple_type==0x10:
-                        actionCode  = apple_data[0]& 0x0f
-                        actionCodeText = {1:"iOS recently updated",
-                               3:"Locked Screen",
-                               7:"Transition Phase",
-                               10:"Locked Screen, Inform Apple Watch",
-                               11:"Active User",
-                               13:"Unknown",
-                               14:"Phone Call or Facetime"}.get(actionCode,'??')
-                        record = {'type': 'Nearby Message',
-                                  'Location Sharing' : apple_data[0]>>4,
-                                  'Action Code' : actionCode,
-                                  'Action Code Text' : actionCodeText}
-                    else:
-                        record = {'type' : hex(apple_type)}
+                    record = None
+                    if apple_type in apple_parsers:
+                        try:
+                            record = apple_parsers[apple_type](apple_data)
+                        except IndexError:
+                            pass        # truncated record
+                    if record is None:
+                        record = self.parse_apple_unknown(apple_type, apple_data)
                     d['records'].append(record)
-        self.d[MANUFACTURER_SPECIFIC] = d
+        return d
+
+    def parse_apple_unknown(self, apple_type, apple_data):
+        return {'type' : hex(apple_type)}
+
+    def parse_apple_type_0x0c(self, apple_data):
+        return {'type':'Handoff Message',
+                'Clipboard Status':apple_data[0],
+                'Sequence Number':word16be(apple_data[1:3])
+                }
+
+    def parse_apple_type_0x0d(self, apple_data):
+        return {'type':'Wi-Fi Settings',
+                'iCloud ID':apple_data[2:].hex()
+                }
+
+    def parse_apple_type_0x0e(self, apple_data):
+        return {'type':'Instant Hotspot',
+                'Battery Life': apple_data[4],
+                'Cell Service': apple_data[6],
+                'Cell Bars': apple_data[7]}
+
+    def parse_apple_type_0x0f(self, apple_data):
+        return {'type':'Wi-Fi Join Network',
+                'data':apple_data.hex()}
+
+    def parse_apple_type_0x10(self, apple_data):
+        actionCode  = apple_data[0]& 0x0f
+        actionCodeText = self.NEARBY_ACTION_CODES.get(actionCode,'??')
+        return {'type': 'Nearby Message',
+                'Location Sharing' : apple_data[0]>>4,
+                'Action Code' : actionCode,
+                'Action Code Text' : actionCodeText}
+
+
+class ClassificationCache():
+    """Bounded LRU cache of classification results, keyed on the raw
+    (adv_data, manuf_data) bytes. One cache may be shared by several
+    Classifier engines (e.g. the scanner and a batch job)."""
+    def __init__(self, capacity=4096):
+        assert capacity > 0
+        self.capacity  = capacity
+        self.entries   = OrderedDict()
+        self.lock      = threading.Lock()
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                val = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        with self.lock:
+            self.entries[key] = val
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'size':len(self.entries), 'capacity':self.capacity,
+                'hits':self.hits, 'misses':self.misses,
+                'evictions':self.evictions, 'hit_rate':self.hit_rate}
+
+VendorToken = namedtuple('VendorToken', ['vendor', 'company_id', 'subtype', 'ad_type', 'tokens'])
+
+class VendorRegistry():
+    """Pluggable table of vendor patterns, matched against raw
+    advertisement bytes. A pattern is an AD type (manufacturer-specific
+    data by default), the 16-bit little-endian ID that starts the
+    structure (the company ID; for service data, the UUID) and
+    optionally a sub-type, which is looked for among the type/length
+    records that follow the ID, as in Apple's manufacturer data.
+
+    compile() folds every registered pattern into one nested dict:
+
+        ad_type -> company_id -> (tokens matching any data,
+                                  {subtype -> tokens})
+
+    so match() walks the AD structures once and does two lookups per
+    structure, however many vendors are registered."""
+    def __init__(self):
+        self.patterns = []
+        self.table    = None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def register(self, vendor, company_id, subtype=None, ad_type=0xff, tokens=()):
+        token = VendorToken(vendor, company_id, subtype, ad_type, tuple(tokens))
+        self.patterns.append(token)
+        self.table = None
+        return token
+
+    def compile(self):
+        table = {}
+        for token in self.patterns:
+            (any_data, by_subtype) = table.setdefault(token.ad_type, {}).setdefault(token.company_id, ([], {}))
+            if token.subtype is None:
+                any_data.append(token)
+            else:
+                by_subtype.setdefault(token.subtype, []).append(token)
+        self.table = table
+        return table
+
+    def _match_structure(self, by_id, buf, start, end, found):
+        # buf[start:end] is the structure after its AD type byte
+        if end - start < 2:
+            return
+        entry = by_id.get(buf[start] | (buf[start+1] << 8))
+        if entry is None:
+            return
+        (any_data, by_subtype) = entry
+        found.extend(any_data)
+        if by_subtype:
+            pos = start + 2
+            while pos + 1 < end:
+                tokens = by_subtype.get(buf[pos])
+                if tokens:
+                    found.extend(tokens)
+                pos += 2 + buf[pos+1]
+
+    def match(self, adv_data=bytes(), manuf_data=bytes()):
+        """Return the VendorTokens matching an advertisement, in payload
+        order without duplicates. manuf_data is manufacturer-specific
+        data without its length and AD type, as CoreBluetooth gives it."""
+        table = self.table if self.table is not None else self.compile()
+        found = []
+        buf = as_view(adv_data)
+        (pos, end) = (0, len(buf))
+        while pos + 1 < end:
+            ad_len = buf[pos]
+            stop   = min(pos + 1 + ad_len, end)
+            by_id  = table.get(buf[pos+1]) if ad_len else None
+            if by_id is not None:
+                self._match_structure(by_id, buf, pos+2, stop, found)
+            pos = pos + 1 + ad_len
+        if manuf_data and 0xff in table:
+            buf = as_view(manuf_data)
+            self._match_structure(table[0xff], buf, 0, len(buf), found)
+        return list(dict.fromkeys(found))
+
+    def vendors(self, adv_data=bytes(), manuf_data=bytes()):
+        """Return the names of the vendors matching an advertisement."""
+        return list(dict.fromkeys(token.vendor for token in self.match(adv_data, manuf_data)))
+
+
+DEFAULT_VENDORS = VendorRegistry()
+DEFAULT_VENDORS.register('Apple', 0x004c, tokens=['apple'])
+DEFAULT_VENDORS.register('Apple', 0x004c, subtype=0x0c, tokens=['handoff'])
+DEFAULT_VENDORS.register('Apple', 0x004c, subtype=0x10, tokens=['nearby'])
+DEFAULT_VENDORS.register('Microsoft', 0x0006, tokens=['msdata'])
+
+
+DEFAULT_CLASSIFIER = Classifier()
+
+def classify_many(iterable_of_bytes, classifier=None):
+    """Classify a stream of advertisements with a single engine,
+    yielding one result dict per advertisement."""
+    return (classifier or DEFAULT_CLASSIFIER).classify_many(iterable_of_bytes)
+
+
+class BTLEAdvClassifier():
+    COMPANY_ID_MAP   = Classifier.COMPANY_ID_MAP
+    APPLE_DATA_TYPES = Classifier.APPLE_DATA_TYPES
+
+    def __init__(self, adv_data = bytes(), manuf_data=bytes(), classifier=None):
+        self.d = (classifier or DEFAULT_CLASSIFIER).classify(adv_data, manuf_data)
+
+    def __repr__(self):
+        return f"BTLEAdvClassifier<{self.d}>"
+
+    def json(self,indent=None):
+        """The same text as json.dumps(self.dict(),indent=indent)."""
+        if indent is None:
+            return JSON_ENCODER.encode(self.d)
+        return json.dumps(self.d,indent=indent,default=json_default)
+
+    def dict(self):
+        return self.d
+
+class BTLEAdvResult():
+    """Compact, lazily decoded classification result. Holds a reference
+    to the raw advertisement and the (type,start,end) offset of each AD
+    structure in it; individual fields are decoded on first access and
+    cached. Field access uses the same keys as BTLEAdvClassifier.dict(),
+    e.g. result[FLAGS] or result.get(MANUFACTURER_SPECIFIC). As in
+    Classifier.decode(), a structure too short for its type is listed
+    under result[UNKNOWN] with those of types the classifier has no
+    decoder for. dict() and json() decode everything, exactly as
+    Classifier.decode() does.
+    """
+    __slots__ = ('_classifier', '_buf', '_spans', '_manuf', '_cache')
+
+    def __init__(self, classifier, buf, spans, manuf=None):
+        self._classifier = classifier
+        self._buf    = buf
+        self._spans  = spans     # flattened (ad_type, start, end) triples
+        self._manuf  = manuf
+        self._cache  = None
+
+    def __repr__(self):
+        return f"BTLEAdvResult<{self.hex}>"
+
+    def _key_of(self, ad_type):
+        return self._classifier.ad_type_parsers.get(ad_type, (UNKNOWN,))[0]
+
+    def _parse_span(self, i):
+        """Decode the structure at self._spans[i], or return ABSENT if
+        its type has no decoder or it is too short for its type."""
+        spans = self._spans
+        entry = self._classifier.ad_type_parsers.get(spans[i])
+        if entry is None:
+            return ABSENT
+        try:
+            return entry[1](as_view(self._buf)[spans[i+1]:spans[i+2]])
+        except MALFORMED:
+            return ABSENT
+
+    def _parse_manuf(self):
+        try:
+            return self._classifier.ad_type_parsers[0xff][1](as_view(self._manuf))
+        except MALFORMED:
+            return ABSENT
+
+    def _decode(self, key):
+        classifier = self._classifier
+        if key==HEX:
+            return as_view(self._buf).hex()
+        if key==MANUFACTURER_SPECIFIC and self._manuf:
+            val = self._parse_manuf()
+            if val is not ABSENT:
+                return val
+            # malformed; a manufacturer structure in the payload still counts
+        if key==UNKNOWN:
+            spans = self._spans
+            unknown = [classifier.parse_unknown(spans[i], as_view(self._buf)[spans[i+1]:spans[i+2]])
+                       for i in range(0, len(spans), 3) if self._parse_span(i) is ABSENT]
+            if self._manuf and self._parse_manuf() is ABSENT:
+                unknown.append(classifier.parse_unknown(0xff, as_view(self._manuf)))
+            if not unknown:
+                raise KeyError(key)
+            return unknown
+        # The last well-formed structure wins, as in dict()
+        spans = self._spans
+        for i in range(len(spans)-3, -1, -3):
+            if self._key_of(spans[i])==key:
+                val = self._parse_span(i)
+                if val is not ABSENT:
+                    return val
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if self._cache is None:
+            self._cache = {}
+        elif key in self._cache:
+            val = self._cache[key]
+            if val is ABSENT:
+                raise KeyError(key)
+            return val
+        try:
+            val = self._decode(key)
+        except KeyError:
+            self._cache[key] = ABSENT
+            raise
+        self._cache[key] = val
+        return val
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """Result keys, in the order dict() would produce them. A
+        structure too short for its type counts as UNKNOWN, so this
+        tries to decode each structure once."""
+        keys  = [HEX]
+        spans = self._spans
+        for i in range(0, len(spans), 3):
+            key = self._key_of(spans[i])
+            if key in keys and UNKNOWN in keys:
+                continue
+            if key!=UNKNOWN and self._parse_span(i) is ABSENT:
+                key = UNKNOWN
+            if key not in keys:
+                keys.append(key)
+        if self._manuf:
+            key = MANUFACTURER_SPECIFIC if self._parse_manuf() is not ABSENT else UNKNOWN
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    @property
+    def hex(self):
+        return self[HEX]
+
+    @property
+    def flags(self):
+        return self.get(FLAGS)
+
+    @property
+    def service_data(self):
+        return self.get(SERVICE_DATA)
+
+    @property
+    def manufacturer_specific(self):
+        return self.get(MANUFACTURER_SPECIFIC)
+
+    def _manuf_view(self):
+        """The manufacturer data dict() decodes: manuf, or the last
+        manufacturer structure long enough to hold a company ID."""
+        if self._manuf:
+            view = as_view(self._manuf)
+            return view if len(view) >= 2 else None
+        spans = self._spans
+        for i in range(len(spans)-3, -1, -3):
+            if self._key_of(spans[i])==MANUFACTURER_SPECIFIC and spans[i+2] - spans[i+1] >= 2:
+                return as_view(self._buf)[spans[i+1]:spans[i+2]]
+        return None
+
+    @property
+    def company_id(self):
+        """The manufacturer company ID, without decoding the rest of the
+        manufacturer data. None if there is none."""
+        data = self._manuf_view()
+        if data is None:
+            return None
+        return word16be(data)
+
+    @property
+    def company_name(self):
+        """The manufacturer's name, as in the classification, or None."""
+        company_id = self.company_id
+        if company_id is None:
+            return None
+        return self._classifier.COMPANY_ID_MAP.get(company_id) or company_name(company_id,'??')
+
+    def apple_types(self):
+        """List of the Apple record types present, without decoding them."""
+        data = self._manuf_view()
+        if data is None or self.company_id!=0x004c:
+            return []
+        with AppleTypeLengthRuns(data, 2) as tr:
+            return [apple_type for (apple_type, apple_data) in tr.get_type_data()]
+
+    def apple_record(self, apple_type):
+        """Decode and return the first Apple record of apple_type, or None."""
+        data = self._manuf_view()
+        if data is None or self.company_id!=0x004c:
+            return None
+        parser = self._classifier.apple_type_parsers.get(apple_type)
+        with AppleTypeLengthRuns(data, 2) as tr:
+            for (t, apple_data) in tr.get_type_data():
+                if t==apple_type:
+                    record = None
+                    if parser:
+                        try:
+                            record = parser(apple_data)
+                        except IndexError:
+                            pass        # truncated record
+                    if record is None:
+                        record = self._classifier.parse_apple_unknown(apple_type, apple_data)
+                    return record
+        return None
+
+    def dict(self):
+        return self._classifier.decode(self._buf, self._manuf or bytes())
+
+    def json(self,indent=None):
+        """The same text as json.dumps(self.dict(),indent=indent)."""
+        if indent is None:
+            return JSON_ENCODER.encode(self.dict())
+        return json.dumps(self.dict(),indent=indent,default=json_default)
+
+HEX_EXAMPLES = ["02011a0aff4c0010050b1c6d9072", 
+                "02011a1aff4c000c0e00750f812422021c3e213d190f3310050b1c6d9072"]
+
+def benchmark(count, repeat=5, cache=None, baseline=None):
+    """Time the per-object path against the batch path, best of
+    `repeat` runs. Returns {name: ads/sec}. If a cache is given, the
+    batch path uses it. baseline is the path of another version of this
+    file (e.g. from 'git show REV:btleclassifier.py'); its
+    BTLEAdvClassifier(...).dict() is timed as 'baseline'."""
+    import time
+    payloads = [codecs.decode(hexstr,"hex") for hexstr in HEX_EXAMPLES] * (count // len(HEX_EXAMPLES))
+    classifier = Classifier(cache=cache)
+    candidates = {'per-object': lambda: [BTLEAdvClassifier(adv_data).dict() for adv_data in payloads],
+                  'batch':      lambda: list(classifier.classify_many(payloads))}
+    if baseline:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('btleclassifier_baseline', baseline)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        candidates = {'baseline': lambda: [module.BTLEAdvClassifier(adv_data).dict() for adv_data in payloads],
+                      **candidates}
+    best = {name: float('inf') for name in candidates}
+    for _ in range(repeat):
+        for (name, fn) in candidates.items():
+            t0 = time.perf_counter()
+            fn()
+            best[name] = min(best[name], time.perf_counter() - t0)
+    return {name: len(payloads)/seconds for (name, seconds) in best.items()}
 
 if __name__ == "__main__":
-    HEX_EXAMPLES = ["02011a0aff4c0010050b1c6d9072", 
-                    "02011a1aff4c000c0e00750f812422021c3e213d190f3310050b1c6d9072"]
+    import argparse
+    parser = argparse.ArgumentParser(description='Classify the example advertisements')
+    parser.add_argument("--bench", type=int, metavar='N',
+                        help="Time N classifications per-object and batched")
+    parser.add_argument("--cache", type=int, metavar='N',
+                        help="With --bench, give the batch path an N-entry cache")
+    parser.add_argument("--baseline", metavar='FILE',
+                        help="With --bench, also time BTLEAdvClassifier from this older copy of btleclassifier.py")
+    args = parser.parse_args()
+
+    if args.bench:
+        cache = ClassificationCache(args.cache) if args.cache else None
+        for (name, rate) in benchmark(args.bench, cache=cache, baseline=args.baseline).items():
+            print(f"{name+':':11} {rate:,.0f} ads/sec")
+        if cache:
+            print(f"cache:      {cache.stats()}")
+        exit(0)
+
     for hexstr in HEX_EXAMPLES:
         print(hexstr)
         obj = BTLEAdvClassifier( codecs.decode(hexstr,"hex") )
         print(obj.json(indent=5))
+        print("vendors:", DEFAULT_VENDORS.vendors(codecs.decode(hexstr,"hex")))
         print("-"*64)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: companies.py
+"""
+Bluetooth SIG company identifiers, for naming the company in
+manufacturer-specific data.
+
+The assigned numbers are in company_identifiers.txt, one per line as
+the 16-bit ID in hex, a tab and the name. Nothing is read until a name
+is first asked for; then the file is loaded once into a 65536-entry
+list indexed by company ID (None where unassigned), so a lookup is one
+bounds check and one index with nothing allocated:
+
+    company_name(0x004c)        # 'Apple, Inc.'
+    company_name(0x7fff)        # None
+
+Loading takes a few milliseconds and well under a megabyte. Users who
+only need numeric IDs never pay for it. When the SIG assigns more
+numbers, regenerate the file from its company_identifiers.yaml
+(https://bitbucket.org/bluetooth-SIG/public, assigned_numbers/
+company_identifiers) with 'python companies.py --update FILE'.
+"""
+
+import os
+import re
+import threading
+
+COMPANY_IDENTIFIERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'company_identifiers.txt')
+ID_COUNT = 1<<16
+
+NAMES = None                # company ID -> name or None, once loaded
+LOAD_LOCK = threading.Lock()
+
+def read_table(path=COMPANY_IDENTIFIERS_FILE):
+    """Return [(company ID, name)] from a company identifiers file."""
+    table = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            (cid, name) = line.rstrip('\n').split('\t', 1)
+            table.append((int(cid, 16), name))
+    return table
+
+def load(path=COMPANY_IDENTIFIERS_FILE):
+    """Load the table, if it is not already, and return the list of names."""
+    global NAMES
+    with LOAD_LOCK:
+        if NAMES is None:
+            names = [None] * ID_COUNT
+            for (cid, name) in read_table(path):
+                names[cid] = name
+            NAMES = names
+    return NAMES
+
+def company_name(company_id, default=None):
+    """Return the assigned name of a 16-bit company ID, or default."""
+    names = NAMES or load()
+    name  = names[company_id] if 0 <= company_id < ID_COUNT else None
+    return default if name is None else name
+
+def loaded():
+    return NAMES is not None
+
+
+YAML_ENTRY = re.compile(r"value:\s*(0x[0-9A-Fa-f]+)\s*\n\s*name:\s*(.*)")
+
+def parse_sig_yaml(text):
+    """Return [(company ID, name)] from the SIG's company_identifiers.yaml."""
+    table = []
+    for (value, name) in YAML_ENTRY.findall(text):
+        name = name.strip()
+        if len(name) >= 2 and name[0]==name[-1]=="'":
+            name = name[1:-1].replace("''", "'")
+        elif len(name) >= 2 and name[0]==name[-1]=='"':
+            name = name[1:-1].replace('\\"', '"')
+        table.append((int(value, 16), name))
+    return sorted(table)
+
+def write_table(table, path=COMPANY_IDENTIFIERS_FILE):
+    with open(path, encoding='utf-8') as f:
+        header = [line for line in f if line.startswith('#')]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(header)
+        for (cid, name) in table:
+            f.write(f"0x{cid:04X}\t{name}\n")
+
+
+def benchmark(count=1000000):
+    """Time loading the table and count lookups. Returns (load seconds,
+    lookups/sec)."""
+    import time
+    global NAMES
+    NAMES = None
+    t0 = time.perf_counter()
+    load()
+    load_time = time.perf_counter() - t0
+    ids = [(i * 7919) & 0x0fff for i in range(1000)]
+    t0 = time.perf_counter()
+    for _ in range(count // len(ids)):
+        for cid in ids:
+            company_name(cid)
+    return (load_time, count / (time.perf_counter() - t0))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Look up Bluetooth SIG company identifiers')
+    parser.add_argument("ids", nargs='*', help="company IDs, e.g. 0x004c or 76")
+    parser.add_argument("--update", metavar='YAML', help="rewrite the table from the SIG's company_identifiers.yaml")
+    parser.add_argument("--bench", action='store_true', help="time loading and lookups")
+    args = parser.parse_args()
+
+    if args.update:
+        with open(args.update, encoding='utf-8') as f:
+            table = parse_sig_yaml(f.read())
+        write_table(table)
+        print(f"{len(table)} company identifiers written to {COMPANY_IDENTIFIERS_FILE}")
+    if args.bench:
+        (load_time, rate) = benchmark()
+        print(f"load:   {load_time*1000:.1f} ms")
+        print(f"lookup: {rate:,.0f} lookups/sec")
+    for text in args.ids:
+        cid = int(text, 0)
+        print(f"0x{cid:04x} {company_name(cid, '??')}")
@@ -3,4 +3,12 @@ class Constants:
     kCBAdvDataChannel = 'kCBAdvDataChannel'
     kCBAdvDataIsConnectable = 'kCBAdvDataIsConnectable'
     kCBAdvDataManufacturerData = 'kCBAdvDataManufacturerData'
+    kCBAdvDataServiceData = 'kCBAdvDataServiceData'
+    kCBAdvDataServiceUUIDs = 'kCBAdvDataServiceUUIDs'
+    kCBAdvDataTxPowerLevel = 'kCBAdvDataTxPowerLevel'
+    CBCentralManagerScanOptionAllowDuplicatesKey = 'kCBScanOptionAllowDuplicates'
 C = Constants()
+
+# Omron 2JCIE-BL01 environment sensor: Latest Data service and characteristic
+WX2_SERVICE = '0C4C3000-7700-46F4-AA96-D5E974E32A54'
+WX2_CHARACTERISTIC_DATA = '0C4C3001-7700-46F4-AA96-D5E974E32A54'
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: continuity.py
+"""
+Link Apple Continuity advertisements across MAC address rotation.
+
+Follows the observations in ref/popets-2019-0036.pdf and
+ref/popets-2019-0057.pdf: a device keeps advertising the same Wi-Fi
+Settings iCloud ID, its Handoff sequence number keeps counting up
+across a rotation, and its Nearby status (action code, location
+sharing) usually does not change at the moment the address does.
+
+Every signal is kept in a hash index, so matching a new address to an
+identity is a handful of dict lookups rather than a scan over all
+devices:
+
+  by_address  address -> identity
+  by_icloud   iCloud ID -> identity
+  by_seq      Handoff sequence-number bucket -> identities whose last
+              sequence number falls in that bucket
+  by_nearby   (action code, location sharing) -> identities
+
+A new address is linked to the identity whose last sequence number is
+closest below its own (within seq_window, modulo 2**16), or failing
+that to the only recently seen identity with the same Nearby status.
+Links are only made to identities seen within max_gap seconds. If an
+earlier address of an identity advertises again after a link, the link
+was wrong: the newer address is split off into an identity of its own.
+"""
+
+from collections import namedtuple
+
+from btleclassifier import MANUFACTURER_SPECIFIC
+
+LinkEvent = namedtuple('LinkEvent', ['timestamp', 'identity', 'address', 'previous_address', 'reason'])
+
+ICLOUD  = 'icloud'
+HANDOFF = 'handoff'
+NEARBY  = 'nearby'
+SPLIT   = 'split'
+
+SEQ_MODULUS = 1<<16
+
+def continuity_fields(d):
+    """Return (handoff sequence number, iCloud ID, nearby status) from a
+    classification dict; each is None if absent."""
+    seq = icloud = nearby = None
+    manuf = d.get(MANUFACTURER_SPECIFIC)
+    if manuf:
+        for record in manuf.get('records', ()):
+            rtype = record['type']
+            if rtype=='Handoff Message':
+                seq = record['Sequence Number']
+            elif rtype=='Wi-Fi Settings':
+                icloud = record['iCloud ID']
+            elif rtype=='Nearby Message':
+                nearby = (record['Action Code'], record['Location Sharing'])
+    return (seq, icloud, nearby)
+
+
+class Identity():
+    __slots__ = ('id', 'address', 'addresses', 'first_seen', 'last_seen', 'seq', 'icloud', 'nearby')
+
+    def __init__(self, id, address, timestamp):
+        self.id         = id
+        self.address    = address
+        self.addresses  = [address]
+        self.first_seen = timestamp
+        self.last_seen  = timestamp
+        self.seq        = None
+        self.icloud     = None
+        self.nearby     = None
+
+    def __repr__(self):
+        return f"Identity<{self.id} {self.addresses}>"
+
+
+class LinkingEngine():
+    def __init__(self, seq_window=32, max_gap=30.0, ttl=600.0, sweep_interval=10.0):
+        self.seq_window = seq_window
+        self.seq_shift  = max(seq_window - 1, 1).bit_length()   # bucket size >= seq_window
+        self.max_gap    = max_gap
+        self.ttl        = ttl
+        self.sweep_interval = sweep_interval
+        self.next_sweep = None
+        self.next_id    = 0
+        self.identities = {}
+        self.by_address = {}
+        self.by_icloud  = {}
+        self.by_seq     = {}
+        self.by_nearby  = {}
+        self.count_links = {ICLOUD:0, HANDOFF:0, NEARBY:0}
+        self.count_splits = 0
+
+    def __len__(self):
+        return len(self.identities)
+
+    def _recent(self, ident, timestamp, address):
+        return ident.address!=address and timestamp - ident.last_seen <= self.max_gap
+
+    def match_seq(self, seq, nearby, timestamp, address):
+        """Identity whose last sequence number is closest below seq,
+        preferring identities with the same Nearby status."""
+        best = None
+        best_key = (True, self.seq_window)
+        low = (seq - self.seq_window) % SEQ_MODULUS
+        for bucket in {seq >> self.seq_shift, low >> self.seq_shift}:
+            for ident in self.by_seq.get(bucket, ()):
+                delta = (seq - ident.seq) % SEQ_MODULUS
+                if 0 < delta <= self.seq_window and self._recent(ident, timestamp, address):
+                    key = (nearby is not None and ident.nearby!=nearby, delta)
+                    if best is None or key < best_key:
+                        (best, best_key) = (ident, key)
+        return best
+
+    def match_nearby(self, nearby, timestamp, address):
+        """The only recently seen identity with this Nearby status."""
+        found = None
+        for ident in self.by_nearby.get(nearby, ()):
+            if self._recent(ident, timestamp, address):
+                if found is not None:
+                    return None
+                found = ident
+        return found
+
+    def _index(self, index, key, ident):
+        index.setdefault(key, set()).add(ident)
+
+    def _unindex(self, index, key, ident):
+        members = index.get(key)
+        if members is not None:
+            members.discard(ident)
+            if not members:
+                del index[key]
+
+    def observe(self, timestamp, address, d):
+        """Process one classified advertisement. Returns a LinkEvent if
+        the address was linked to (or split from) an existing identity,
+        otherwise None."""
+        if self.next_sweep is None or timestamp >= self.next_sweep:
+            self.sweep(timestamp)
+        (seq, icloud, nearby) = continuity_fields(d)
+        event = None
+        ident = self.by_address.get(address)
+        if ident is not None and ident.address!=address:
+            # An earlier address of this identity is still advertising,
+            # so its latest link was wrong.
+            event = self.split(ident, timestamp)
+        if ident is None:
+            reason = None
+            if icloud is not None and icloud in self.by_icloud:
+                (ident, reason) = (self.by_icloud[icloud], ICLOUD)
+            if ident is None and seq is not None:
+                (ident, reason) = (self.match_seq(seq, nearby, timestamp, address), HANDOFF)
+            if ident is None and nearby is not None:
+                (ident, reason) = (self.match_nearby(nearby, timestamp, address), NEARBY)
+            if ident is None:
+                ident = Identity(self.next_id, address, timestamp)
+                self.next_id += 1
+                self.identities[ident.id] = ident
+            else:
+                event = LinkEvent(timestamp, ident.id, address, ident.address, reason)
+                self.count_links[reason] += 1
+                ident.addresses.append(address)
+            self.by_address[address] = ident
+
+        ident.address   = address
+        ident.last_seen = timestamp
+        if seq is not None:
+            if ident.seq is not None:
+                self._unindex(self.by_seq, ident.seq >> self.seq_shift, ident)
+            ident.seq = seq
+            self._index(self.by_seq, seq >> self.seq_shift, ident)
+        if nearby is not None and nearby!=ident.nearby:
+            if ident.nearby is not None:
+                self._unindex(self.by_nearby, ident.nearby, ident)
+            ident.nearby = nearby
+            self._index(self.by_nearby, nearby, ident)
+        if icloud is not None and icloud!=ident.icloud:
+            ident.icloud = icloud
+            self.by_icloud[icloud] = ident
+        return event
+
+    def split(self, ident, timestamp):
+        """Detach ident's current address, and the state it brought, into
+        a new identity. Returns a LinkEvent with reason 'split'."""
+        address = ident.address
+        other = Identity(self.next_id, address, ident.last_seen)
+        self.next_id += 1
+        self.identities[other.id] = other
+        ident.addresses.remove(address)
+        self.by_address[address] = other
+        ident.address = ident.addresses[-1]
+        if ident.seq is not None:
+            self._unindex(self.by_seq, ident.seq >> self.seq_shift, ident)
+            self._index(self.by_seq, ident.seq >> self.seq_shift, other)
+        if ident.nearby is not None:
+            self._unindex(self.by_nearby, ident.nearby, ident)
+            self._index(self.by_nearby, ident.nearby, other)
+        if ident.icloud is not None and self.by_icloud.get(ident.icloud) is ident:
+            self.by_icloud[ident.icloud] = other
+        (other.seq, other.nearby, other.icloud) = (ident.seq, ident.nearby, ident.icloud)
+        (ident.seq, ident.nearby, ident.icloud) = (None, None, None)
+        self.count_splits += 1
+        return LinkEvent(timestamp, other.id, address, ident.address, SPLIT)
+
+    def sweep(self, timestamp):
+        """Forget identities not seen for ttl seconds."""
+        self.next_sweep = timestamp + self.sweep_interval
+        cutoff  = timestamp - self.ttl
+        expired = [ident for ident in self.identities.values() if ident.last_seen < cutoff]
+        for ident in expired:
+            del self.identities[ident.id]
+            for address in ident.addresses:
+                if self.by_address.get(address) is ident:
+                    del self.by_address[address]
+            if ident.seq is not None:
+                self._unindex(self.by_seq, ident.seq >> self.seq_shift, ident)
+            if ident.nearby is not None:
+                self._unindex(self.by_nearby, ident.nearby, ident)
+            if ident.icloud is not None and self.by_icloud.get(ident.icloud) is ident:
+                del self.by_icloud[ident.icloud]
+        return len(expired)
+
+    def link_stream(self, observations):
+        """Generator of LinkEvents from (timestamp, address, dict) triples."""
+        observe = self.observe
+        for (timestamp, address, d) in observations:
+            event = observe(timestamp, address, d)
+            if event is not None:
+                yield event
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import sys
+    from hcireplay import replay
+
+    parser = argparse.ArgumentParser(description='Link rotating Apple addresses in a btsnoop or pcap capture')
+    parser.add_argument("capture", help="btsnoop or pcap file")
+    parser.add_argument("--seq-window", type=int, default=32)
+    parser.add_argument("--max-gap", type=float, default=30.0)
+    args = parser.parse_args()
+
+    engine = LinkingEngine(seq_window=args.seq_window, max_gap=args.max_gap)
+    count  = 0
+    t0 = time.perf_counter()
+    def observations():
+        global count
+        for (report, d) in replay(args.capture):
+            count += 1
+            yield (report.timestamp, report.address, d)
+    for event in engine.link_stream(observations()):
+        print(f"{event.timestamp:.3f} identity {event.identity}: "
+              f"{event.previous_address} -> {event.address} ({event.reason})")
+    elapsed = time.perf_counter() - t0
+    print(f"{count} advertisements, {len(engine)} identities, links {engine.count_links}, "
+          f"{count/elapsed if elapsed else 0:,.0f} ads/sec", file=sys.stderr)
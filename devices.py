@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: devices.py
+"""
+Per-device state for the scanner, keyed by peripheral.identifier().
+
+State lives in parallel typed arrays indexed by a slot number rather
+than in a dict or object per device, so a registry of 20k+ devices is a
+few dozen bytes per device plus its identifier. RSSI statistics are
+kept over a rolling window of the last `window` readings: the mean is
+maintained incrementally, min and max are computed when a device is
+read. Devices not seen for `ttl` seconds are evicted and their slots
+reused; on_evict, if set, is called with the list of freed slots (a
+ProximityTracker sharing the slots sets it).
+"""
+
+import time
+from array import array
+from collections import namedtuple
+
+DeviceStats = namedtuple('DeviceStats', ['identifier', 'first_seen', 'last_seen', 'count',
+                                         'last_payload', 'rssi_min', 'rssi_max', 'rssi_mean'])
+
+class DeviceRegistry():
+    def __init__(self, ttl=300.0, window=16, capacity=1024, evict_interval=1.0):
+        assert 0 < window < 256
+        self.ttl        = ttl
+        self.window     = window
+        self.evict_interval = evict_interval
+        self.slots      = {}        # identifier -> slot
+        self.free       = []        # unused slots
+        self.identifiers = []       # slot -> identifier (None if free)
+        self.last_payload = []      # slot -> bytes
+        self.first_seen = array('d')
+        self.last_seen  = array('d')
+        self.count      = array('I')
+        self.rssi_sum   = array('i')
+        self.rssi_pos   = array('B')  # next write position in the ring
+        self.rssi_len   = array('B')  # number of valid readings in the ring
+        self.rssi_ring  = array('b')  # window readings per slot
+        self.count_evicted = 0
+        self.next_evict = 0.0
+        self.on_evict   = None
+        self._grow(capacity)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, identifier):
+        return identifier in self.slots
+
+    def _grow(self, n):
+        base = len(self.identifiers)
+        self.identifiers.extend([None]*n)
+        self.last_payload.extend([None]*n)
+        for column in (self.first_seen, self.last_seen):
+            column.extend([0.0]*n)
+        for column in (self.count, self.rssi_sum, self.rssi_pos, self.rssi_len):
+            column.extend([0]*n)
+        self.rssi_ring.extend(bytes(n*self.window))
+        self.free.extend(range(base+n-1, base-1, -1))
+
+    def _allocate(self, identifier, now):
+        if not self.free:
+            self._grow(max(len(self.identifiers), 16))
+        slot = self.free.pop()
+        self.slots[identifier] = slot
+        self.identifiers[slot] = identifier
+        self.first_seen[slot]  = now
+        self.count[slot]       = 0
+        self.rssi_sum[slot]    = 0
+        self.rssi_pos[slot]    = 0
+        self.rssi_len[slot]    = 0
+        return slot
+
+    def update(self, identifier, rssi, payload=None, now=None):
+        """Record one advertisement. Returns the device's slot."""
+        if now is None:
+            now = time.time()
+        if now >= self.next_evict:
+            self.evict(now)
+        slot = self.slots.get(identifier)
+        if slot is None:
+            slot = self._allocate(identifier, now)
+        self.last_seen[slot] = now
+        self.count[slot]    += 1
+        if payload is not None:
+            self.last_payload[slot] = payload
+        if rssi is not None:
+            rssi   = max(-128, min(127, int(rssi)))
+            pos    = self.rssi_pos[slot]
+            offset = slot*self.window + pos
+            if self.rssi_len[slot]==self.window:
+                self.rssi_sum[slot] -= self.rssi_ring[offset]
+            else:
+                self.rssi_len[slot] += 1
+            self.rssi_ring[offset] = rssi
+            self.rssi_sum[slot]   += rssi
+            self.rssi_pos[slot]    = (pos + 1) % self.window
+        return slot
+
+    def evict(self, now=None):
+        """Drop devices idle for longer than ttl. Returns their identifiers."""
+        if now is None:
+            now = time.time()
+        self.next_evict = now + self.evict_interval
+        cutoff    = now - self.ttl
+        last_seen = self.last_seen
+        evicted   = [identifier for (identifier, slot) in self.slots.items() if last_seen[slot] < cutoff]
+        freed     = []
+        for identifier in evicted:
+            slot = self.slots.pop(identifier)
+            self.identifiers[slot]  = None
+            self.last_payload[slot] = None
+            self.free.append(slot)
+            freed.append(slot)
+        self.count_evicted += len(evicted)
+        if freed and self.on_evict is not None:
+            self.on_evict(freed)
+        return evicted
+
+    def stats(self, slot):
+        """Return the DeviceStats for a slot."""
+        n = self.rssi_len[slot]
+        if n:
+            start    = slot*self.window
+            readings = self.rssi_ring[start:start+n]
+            (rssi_min, rssi_max, rssi_mean) = (min(readings), max(readings), self.rssi_sum[slot]/n)
+        else:
+            (rssi_min, rssi_max, rssi_mean) = (None, None, None)
+        return DeviceStats(self.identifiers[slot], self.first_seen[slot], self.last_seen[slot],
+                           self.count[slot], self.last_payload[slot], rssi_min, rssi_max, rssi_mean)
+
+    def get(self, identifier):
+        slot = self.slots.get(identifier)
+        return None if slot is None else self.stats(slot)
+
+    def __iter__(self):
+        """Iterate DeviceStats for every live device."""
+        for slot in list(self.slots.values()):
+            yield self.stats(slot)
+
+    def snapshot(self):
+        return list(self)
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: gattpool.py
+"""
+Polling many GATT peripherals through a bounded pool of connections.
+
+The scanner used to connect to one peripheral, discover its services and
+read one characteristic. GATTPool does that for any number of devices
+offering a service (e.g. a room full of Omron 2JCIE-BL01 sensors):
+
+  connections  at most max_connections at once (the radio and the
+               sensors' batteries both care). When devices are waiting
+               for a slot, connected devices that have just been read
+               are disconnected to make room, longest-until-due first.
+  discovery    per device, the discovered service and characteristic
+               objects are kept while it stays connected, so a
+               connection is discovered once and then read repeatedly.
+               Across reconnects only the one service and characteristic
+               are rediscovered, and devices found not to have them are
+               remembered and not connected to again.
+  budget       reads (or, with notify=True, subscriptions) are issued
+               from a token bucket of budget per second; each device is
+               due every poll_interval seconds and due devices are served
+               oldest first.
+  backoff      failed or dropped connections and timeouts retry after
+               backoff_initial seconds, doubling up to backoff_max, with
+               jitter so a room of sensors does not retry in step.
+
+The pool is the peripheral delegate; the central manager's delegate
+forwards its connect callbacks with did_connect(), did_fail() and
+did_disconnect() and offers devices with add(). The timer comes from the
+scan backend (scanbackend.py), so the same pool runs on CoreBluetooth and
+against simulated sensors:
+
+    python gattpool.py --devices 200 --max-connections 8 --budget 50 --duration 20
+"""
+
+import random
+import time
+
+IDLE        = 'idle'            # not connected; due for a read at .due
+CONNECTING  = 'connecting'
+DISCOVERING = 'discovering'
+READY       = 'ready'           # connected, characteristic known
+BACKOFF     = 'backoff'         # not connected; retry at .due
+UNSUPPORTED = 'unsupported'     # does not have the service
+STATES      = (IDLE, CONNECTING, DISCOVERING, READY, BACKOFF, UNSUPPORTED)
+
+def value_bytes(value):
+    """bytes from a characteristic value (NSData, or bytes when simulated)."""
+    return value.bytes().tobytes() if hasattr(value, 'bytes') else bytes(value)
+
+
+class GATTDevice():
+    __slots__ = ('identifier', 'peripheral', 'state', 'since', 'due', 'failures',
+                 'characteristic', 'pending', 'release', 'reads', 'uses')
+
+    def __init__(self, identifier, peripheral):
+        self.identifier = identifier
+        self.peripheral = peripheral
+        self.state      = IDLE
+        self.since      = 0.0       # when state was entered
+        self.due        = 0.0       # next read (IDLE, READY) or retry (BACKOFF)
+        self.failures   = 0         # since the last value
+        self.characteristic = None  # while connected
+        self.pending    = None      # when the outstanding read was issued
+        self.release    = False     # we asked for the disconnect
+        self.reads      = 0
+        self.uses       = 0         # reads issued on this connection
+
+    def __repr__(self):
+        return f"GATTDevice<{self.identifier} {self.state}>"
+
+
+class GATTPool():
+    def __init__(self, backend, service, characteristic, on_value=None, max_connections=4,
+                 poll_interval=10.0, budget=None, notify=False, connect_timeout=10.0, gatt_timeout=5.0,
+                 backoff_initial=1.0, backoff_max=60.0, tick=0.1, seed=None):
+        assert max_connections > 0 and poll_interval > 0
+        self.backend  = backend
+        self.service  = service.upper()
+        self.characteristic = characteristic.upper()
+        self.on_value = on_value
+        self.max_connections = max_connections
+        self.poll_interval   = poll_interval
+        self.budget   = budget          # reads/second, None for unlimited
+        self.tokens   = float(max(1.0, budget)) if budget else 0.0
+        self.notify   = notify
+        self.connect_timeout = connect_timeout
+        self.gatt_timeout    = gatt_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max     = backoff_max
+        self.tick_seconds    = tick
+        self.rnd      = random.Random(seed)
+        self.manager  = None
+        self.devices  = {}              # identifier -> GATTDevice
+        self.last_tick = None
+        self.started  = None
+        self.stopped  = False
+        self.count_connects    = 0
+        self.count_connected   = 0
+        self.count_failures    = 0      # failed connections, lost links and timeouts
+        self.count_timeouts    = 0
+        self.count_released    = 0      # disconnected to free a slot
+        self.count_discoveries = 0      # service discoveries
+        self.count_reused      = 0      # reads on an already discovered characteristic
+        self.count_reads       = 0      # reads and subscriptions issued
+        self.count_values      = 0
+        self.count_throttled   = 0      # ticks on which the budget held reads back
+        self.max_active        = 0
+
+    # The central manager side
+
+    def start(self, manager):
+        """Begin polling. Call once the manager is powered on."""
+        self.manager = manager
+        self.started = self.last_tick = time.monotonic()
+        self.backend.call_later(self.tick_seconds, self.tick)
+
+    def add(self, peripheral):
+        """Offer a peripheral advertising the service. Returns its GATTDevice."""
+        identifier = str(peripheral.identifier())
+        device = self.devices.get(identifier)
+        if device is None:
+            device = self.devices[identifier] = GATTDevice(identifier, peripheral)
+        else:
+            device.peripheral = peripheral
+        return device
+
+    def stop(self):
+        """Disconnect everything and stop ticking."""
+        self.stopped = True
+        for device in self.devices.values():
+            if device.state in (CONNECTING, DISCOVERING, READY):
+                self.disconnect(device)
+
+    def did_connect(self, peripheral):
+        device = self.device(peripheral)
+        if device is None or device.state != CONNECTING:
+            return
+        self.count_connected += 1
+        peripheral.setDelegate_(self)
+        self.enter(device, DISCOVERING)
+        services = peripheral.services()
+        service  = self.find(services, self.service)
+        if service is not None and self.find(service.characteristics(), self.characteristic) is not None:
+            # CoreBluetooth kept what was discovered last time
+            self.peripheral_didDiscoverCharacteristicsForService_error_(peripheral, service, None)
+            return
+        self.count_discoveries += 1
+        peripheral.discoverServices_(self.backend.uuids([self.service]))
+
+    def did_fail(self, peripheral, error=None):
+        device = self.device(peripheral)
+        if device is not None and device.state==CONNECTING:
+            self.failed(device, f"connect failed: {error}")
+
+    def did_disconnect(self, peripheral, error=None):
+        device = self.device(peripheral)
+        if device is None or device.state in (IDLE, BACKOFF, UNSUPPORTED):
+            return
+        device.characteristic = None
+        device.pending = None
+        if device.release and error is None:
+            device.release = False
+            self.enter(device, IDLE)
+        else:
+            self.failed(device, f"disconnected: {error}")
+
+    # The peripheral delegate
+
+    def peripheral_didDiscoverServices_(self, peripheral, error):
+        device = self.device(peripheral)
+        if device is None or device.state != DISCOVERING:
+            return
+        service = self.find(peripheral.services(), self.service)
+        if service is None:
+            self.unsupported(device)
+            return
+        peripheral.discoverCharacteristics_forService_(self.backend.uuids([self.characteristic]), service)
+
+    def peripheral_didDiscoverCharacteristicsForService_error_(self, peripheral, service, error):
+        device = self.device(peripheral)
+        if device is None or device.state != DISCOVERING:
+            return
+        characteristic = self.find(service.characteristics(), self.characteristic)
+        if characteristic is None:
+            self.unsupported(device)
+            return
+        device.characteristic = characteristic
+        device.uses = 0
+        self.enter(device, READY)
+        device.due = min(device.due, time.monotonic())
+
+    def peripheral_didUpdateValueForCharacteristic_error_(self, peripheral, characteristic, error):
+        device = self.device(peripheral)
+        if device is None or device.state != READY:
+            return
+        device.pending = None
+        if error is not None:
+            self.failed(device, f"read failed: {error}")
+            return
+        now = time.monotonic()
+        device.failures = 0
+        device.reads += 1
+        if not self.notify:
+            device.due = now + self.poll_interval
+        self.count_values += 1
+        if self.on_value is not None:
+            self.on_value(device.identifier, value_bytes(characteristic.value()), time.time())
+
+    def peripheral_didUpdateNotificationStateForCharacteristic_error_(self, peripheral, characteristic, error):
+        device = self.device(peripheral)
+        if device is not None and device.state==READY and error is not None:
+            self.failed(device, f"subscribe failed: {error}")
+
+    # Scheduling
+
+    def tick(self):
+        if self.stopped:
+            return
+        now = time.monotonic()
+        if self.budget:
+            self.tokens = min(max(1.0, self.budget), self.tokens + (now - self.last_tick) * self.budget)
+        self.last_tick = now
+        active  = 0
+        ready   = []
+        waiting = []
+        for device in self.devices.values():
+            state = device.state
+            if state==CONNECTING:
+                if now - device.since > self.connect_timeout:
+                    self.timed_out(device)
+                else:
+                    active += 1
+            elif state==DISCOVERING:
+                if now - device.since > self.gatt_timeout:
+                    self.timed_out(device)
+                else:
+                    active += 1
+            elif state==READY:
+                if device.pending is not None and now - device.pending > self.gatt_timeout:
+                    self.timed_out(device)
+                else:
+                    active += 1
+                    ready.append(device)
+            elif state==BACKOFF:
+                if device.due <= now:
+                    self.enter(device, IDLE)
+                    waiting.append(device)
+            elif state==IDLE and device.due <= now:
+                waiting.append(device)
+        self.read_due(ready, now)
+        waiting.sort(key=lambda device: device.due)
+        free = self.max_connections - active
+        if len(waiting) > free:
+            self.make_room(ready, len(waiting) - free, now)
+        for device in waiting[:max(0, free)]:
+            self.connect(device)
+            active += 1
+        self.max_active = max(self.max_active, active)
+        self.backend.call_later(self.tick_seconds, self.tick)
+
+    def read_due(self, ready, now):
+        """Read (or subscribe to) the due connected devices, oldest first,
+        as far as the budget allows."""
+        due = sorted((device for device in ready
+                      if device.pending is None and device.due <= now and not device.release),
+                     key=lambda device: device.due)
+        for device in due:
+            if self.budget:
+                if self.tokens < 1.0:
+                    self.count_throttled += 1
+                    return
+                self.tokens -= 1.0
+            self.read(device, now)
+
+    def read(self, device, now):
+        self.count_reads += 1
+        if device.uses:
+            self.count_reused += 1
+        device.uses += 1
+        if self.notify:
+            # values now arrive on their own; only subscribe again if the link drops
+            device.due = float('inf')
+            device.peripheral.setNotifyValue_forCharacteristic_(True, device.characteristic)
+        else:
+            device.pending = now
+            device.peripheral.readValueForCharacteristic_(device.characteristic)
+
+    def make_room(self, ready, wanted, now):
+        """Disconnect up to wanted connected devices that are idle and not
+        due soon, to let waiting devices in."""
+        if self.notify:
+            candidates = [device for device in ready if device.reads and not device.release]
+            # subscribed devices are never due; release the longest held first
+            candidates.sort(key=lambda device: device.since)
+        else:
+            candidates = [device for device in ready
+                          if device.pending is None and device.due > now and not device.release]
+            candidates.sort(key=lambda device: -device.due)
+        for device in candidates[:wanted]:
+            if self.notify:
+                device.due = now + self.poll_interval
+            self.count_released += 1
+            self.disconnect(device)
+
+    def connect(self, device):
+        self.count_connects += 1
+        self.enter(device, CONNECTING)
+        self.manager.connectPeripheral_options_(device.peripheral, None)
+
+    def disconnect(self, device):
+        device.release = True
+        self.manager.cancelPeripheralConnection_(device.peripheral)
+
+    def timed_out(self, device):
+        self.count_timeouts += 1
+        self.manager.cancelPeripheralConnection_(device.peripheral)
+        self.failed(device, "timed out")
+
+    def failed(self, device, reason):
+        """Back off before reconnecting: backoff_initial doubling per
+        consecutive failure up to backoff_max, less up to half as jitter."""
+        self.count_failures += 1
+        device.failures += 1
+        device.characteristic = None
+        device.pending = None
+        device.release = False
+        delay = min(self.backoff_max, self.backoff_initial * 2 ** (device.failures - 1))
+        self.enter(device, BACKOFF)
+        device.due = time.monotonic() + delay * self.rnd.uniform(0.5, 1.0)
+
+    def unsupported(self, device):
+        self.enter(device, UNSUPPORTED)
+        self.disconnect(device)
+
+    def enter(self, device, state):
+        device.state = state
+        device.since = time.monotonic()
+
+    # Helpers
+
+    def device(self, peripheral):
+        return self.devices.get(str(peripheral.identifier()))
+
+    @staticmethod
+    def find(items, uuid):
+        for item in items or ():
+            if str(item.UUID().UUIDString()).upper()==uuid:
+                return item
+        return None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        states  = {state:0 for state in STATES}
+        for device in self.devices.values():
+            states[device.state] += 1
+        return {'devices':len(self.devices),
+                'states':{state:count for (state, count) in states.items() if count},
+                'max_connections':self.max_connections,
+                'max_active':self.max_active,
+                'connects':self.count_connects,
+                'connected':self.count_connected,
+                'failures':self.count_failures,
+                'timeouts':self.count_timeouts,
+                'released':self.count_released,
+                'discoveries':self.count_discoveries,
+                'reads':self.count_reads,
+                'reads_on_cached':self.count_reused,
+                'values':self.count_values,
+                'values_per_second':self.count_values / elapsed if elapsed else None,
+                'throttled':self.count_throttled,
+                'polled':sum(1 for device in self.devices.values() if device.reads)}
+
+
+class PoolDelegate():
+    """Minimal central delegate for trying a pool: scans for the
+    service and hands every device found to the pool."""
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    def centralManagerDidUpdateState_(self, manager):
+        manager.scanForPeripheralsWithServices_options_(self.pool.backend.uuids([self.pool.service]), None)
+        self.pool.start(manager)
+
+    def centralManager_didDiscoverPeripheral_advertisementData_RSSI_(self, manager, peripheral, data, rssi):
+        self.pool.add(peripheral)
+
+    def centralManager_didConnectPeripheral_(self, manager, peripheral):
+        self.pool.did_connect(peripheral)
+
+    def centralManager_didFailToConnectPeripheral_error_(self, manager, peripheral, error):
+        self.pool.did_fail(peripheral, error)
+
+    def centralManager_didDisconnectPeripheral_error_(self, manager, peripheral, error):
+        self.pool.did_disconnect(peripheral, error)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from constants import WX2_SERVICE,WX2_CHARACTERISTIC_DATA
+    from omron import FrameBuffer
+    from scanbackend import SimulatedBackend
+    parser = argparse.ArgumentParser(description='Poll simulated 2JCIE-BL01 sensors through a GATT connection pool')
+    parser.add_argument("--devices", type=int, default=200, help="simulated sensors")
+    parser.add_argument("--max-connections", type=int, default=8)
+    parser.add_argument("--budget", type=float, help="reads/second across all devices (default: unlimited)")
+    parser.add_argument("--poll-interval", type=float, default=10.0, help="seconds between reads of a device")
+    parser.add_argument("--notify", action='store_true', help="subscribe to notifications instead of reading")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--connect-latency", type=float, default=0.2, help="mean seconds to connect")
+    parser.add_argument("--gatt-latency", type=float, default=0.03, help="mean seconds per GATT request")
+    parser.add_argument("--connect-fail", type=float, default=0.05, help="chance a connection fails")
+    parser.add_argument("--disconnect-rate", type=float, default=0.005, help="chance a link drops per value")
+    parser.add_argument("--radio-limit", type=int, help="connections the simulated radio allows")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch", type=int, default=1000,
+                        help="decode readings this many at a time (see omron.py)")
+    args = parser.parse_args()
+
+    def summarize(columns):
+        print(f"{len(columns['row'])} readings from {len(set(columns['identifier']))} sensors: "
+              f"temperature {columns['temperature'].mean():.2f} degC, "
+              f"humidity {columns['humidity'].mean():.2f} %RH, "
+              f"battery min {columns['battery'].min():.3f} V")
+    frames = FrameBuffer(summarize, args.batch)
+
+    delegate = PoolDelegate()
+    backend  = SimulatedBackend(delegate, devices=0, sensors=args.devices, rate=args.devices * 2.0,
+                                duration=args.duration, seed=args.seed,
+                                connect_latency=args.connect_latency, gatt_latency=args.gatt_latency,
+                                connect_fail=args.connect_fail, disconnect_rate=args.disconnect_rate,
+                                max_radio_connections=args.radio_limit)
+    delegate.pool = GATTPool(backend, WX2_SERVICE, WX2_CHARACTERISTIC_DATA,
+                             on_value=frames.add,
+                             max_connections=args.max_connections, poll_interval=args.poll_interval,
+                             budget=args.budget, notify=args.notify, seed=args.seed)
+    backend.run()
+    delegate.pool.stop()
+    frames.flush()
+    print(json.dumps(delegate.pool.stats(), indent=2))
+    print(json.dumps(backend.stats(), indent=2))
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: hcireplay.py
+"""
+Offline replay of Bluetooth captures through the classifier, for
+machines without CoreBluetooth.
+
+Supported inputs:
+  btsnoop   datalink 1001 (HCI UART/H4) and 1002 (HCI un-encapsulated)
+  pcap      LINKTYPE_BLUETOOTH_HCI_H4 (187), LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR (201),
+            LINKTYPE_BLUETOOTH_LE_LL (251), LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR (256)
+
+From HCI captures the LE Advertising Report (0x02) and LE Extended
+Advertising Report (0x0D) meta events are extracted; from link-layer
+captures the ADV_IND, ADV_NONCONN_IND, ADV_SCAN_IND and SCAN_RSP PDUs.
+
+Files are memory-mapped and walked in place. The payload of each
+AdvReport is a memoryview into the map, valid until the reader is
+closed.
+
+btsnoop is the Frontline/Android variant of the RFC 1761 snoop format.
+pcap linktypes: https://www.tcpdump.org/linktypes.html
+"""
+
+import mmap
+import struct
+import sys
+import time
+from collections import namedtuple
+
+from advfilter import AdvFilter
+from advjson import ResultEncoder
+from btleclassifier import Classifier,DEFAULT_CLASSIFIER
+
+AdvReport = namedtuple('AdvReport', ['timestamp', 'address', 'rssi', 'payload'])
+
+BTSNOOP_MAGIC  = b'btsnoop\0'
+BTSNOOP_HEADER = struct.Struct('>8sII')         # magic, version, datalink
+BTSNOOP_RECORD = struct.Struct('>IIIIq')        # orig_len, incl_len, flags, drops, timestamp
+BTSNOOP_H4     = 1001
+BTSNOOP_HCI    = 1002
+BTSNOOP_EPOCH_DELTA = 0x00dcddb30f2f8000        # microseconds from 0 AD to 1970
+
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+LINKTYPE_BLUETOOTH_HCI_H4           = 187
+LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR = 201
+LINKTYPE_BLUETOOTH_LE_LL            = 251
+LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR  = 256
+
+H4_EVENT             = 0x04
+HCI_LE_META_EVENT    = 0x3e
+LE_ADVERTISING_REPORT          = 0x02
+LE_EXTENDED_ADVERTISING_REPORT = 0x0d
+EXT_REPORT_HEADER    = struct.Struct('<HB6sBBBbbHB6sB')
+
+LL_ADV_ACCESS_ADDRESS = 0x8e89bed6
+LL_ADV_PDUS_WITH_DATA = {0x00, 0x02, 0x04, 0x06}   # ADV_IND, ADV_NONCONN_IND, SCAN_RSP, ADV_SCAN_IND
+LE_LL_PHDR           = struct.Struct('<BbbBIH')     # channel, signal, noise, offenses, ref AA, flags
+LE_LL_SIGNAL_VALID   = 0x0002
+
+def format_address(addr):
+    """Format a little-endian 6-byte BD_ADDR as AA:BB:CC:DD:EE:FF"""
+    return ":".join("%02X" % ch for ch in reversed(bytes(addr)))
+
+
+class CaptureReader():
+    """Context manager over a memory-mapped btsnoop or pcap file.
+    records() yields (timestamp, flags, packet) and reports() yields
+    AdvReport."""
+    def __init__(self, path):
+        self.path = path
+        self.f    = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"{path}: empty file")
+        self.buf = memoryview(self.mm)
+        self.count_records = 0
+        self._parse_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.buf.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # Payload views are still held by the caller; the map is
+            # released when they are garbage collected.
+            pass
+        self.f.close()
+
+    def _parse_header(self):
+        buf = self.buf
+        if bytes(buf[0:8])==BTSNOOP_MAGIC:
+            (magic, version, datalink) = BTSNOOP_HEADER.unpack_from(buf, 0)
+            if datalink not in (BTSNOOP_H4, BTSNOOP_HCI):
+                raise ValueError(f"{self.path}: unsupported btsnoop datalink {datalink}")
+            self.format   = 'btsnoop'
+            self.linktype = datalink
+            self.data_start = BTSNOOP_HEADER.size
+        elif bytes(buf[0:4]) in PCAP_MAGICS:
+            (endian, self.ts_scale) = PCAP_MAGICS[bytes(buf[0:4])]
+            self.pcap_record = struct.Struct(endian + 'IIII')
+            self.linktype = struct.unpack_from(endian + 'I', buf, 20)[0]
+            if self.linktype not in (LINKTYPE_BLUETOOTH_HCI_H4, LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR,
+                                     LINKTYPE_BLUETOOTH_LE_LL, LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR):
+                raise ValueError(f"{self.path}: unsupported pcap linktype {self.linktype}")
+            self.format   = 'pcap'
+            self.data_start = 24
+        else:
+            raise ValueError(f"{self.path}: not a btsnoop or pcap file")
+
+    def records(self, start=None, end=None):
+        """Yield (timestamp, flags, packet) for each captured packet.
+        flags is the btsnoop record flags, or 0 for pcap. start and end
+        are byte offsets of record boundaries, as from chunk_offsets()."""
+        buf = self.buf
+        pos = self.data_start if start is None else start
+        end = len(buf) if end is None else end
+        if self.format=='btsnoop':
+            rec = BTSNOOP_RECORD
+            while pos + rec.size <= end:
+                (orig_len, incl_len, flags, drops, ts) = rec.unpack_from(buf, pos)
+                pos += rec.size
+                self.count_records += 1
+                yield ((ts - BTSNOOP_EPOCH_DELTA) / 1e6, flags, buf[pos:pos+incl_len])
+                pos += incl_len
+        else:
+            rec = self.pcap_record
+            scale = self.ts_scale
+            while pos + rec.size <= end:
+                (ts_sec, ts_frac, incl_len, orig_len) = rec.unpack_from(buf, pos)
+                pos += rec.size
+                self.count_records += 1
+                yield (ts_sec + ts_frac * scale, 0, buf[pos:pos+incl_len])
+                pos += incl_len
+
+    def chunk_offsets(self, records_per_chunk):
+        """Yield (start,end) byte ranges each holding up to
+        records_per_chunk records, by walking only the record headers."""
+        buf = self.buf
+        if self.format=='btsnoop':
+            (rec, len_field) = (BTSNOOP_RECORD, 4)
+        else:
+            (rec, len_field) = (self.pcap_record, 8)
+        len_struct = struct.Struct(rec.format[0] + 'I')
+        pos   = chunk_start = self.data_start
+        count = 0
+        while pos + rec.size <= len(buf):
+            pos += rec.size + len_struct.unpack_from(buf, pos + len_field)[0]
+            count += 1
+            if count==records_per_chunk:
+                yield (chunk_start, pos)
+                chunk_start = pos
+                count = 0
+        if count:
+            yield (chunk_start, pos)
+
+    def reports(self, start=None, end=None):
+        """Yield an AdvReport for every advertisement in the capture, or
+        in the byte range [start,end)."""
+        linktype = self.linktype
+        for (ts, flags, pkt) in self.records(start, end):
+            if linktype==BTSNOOP_HCI:
+                # packet type is carried in the record flags; bit 1 set means command/event
+                if flags & 0x03 != 0x03:
+                    continue
+                yield from hci_event_reports(ts, pkt)
+            elif linktype in (BTSNOOP_H4, LINKTYPE_BLUETOOTH_HCI_H4):
+                if len(pkt) and pkt[0]==H4_EVENT:
+                    yield from hci_event_reports(ts, pkt[1:])
+            elif linktype==LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR:
+                if len(pkt) > 4 and pkt[4]==H4_EVENT:
+                    yield from hci_event_reports(ts, pkt[5:])
+            elif linktype==LINKTYPE_BLUETOOTH_LE_LL:
+                yield from ll_reports(ts, None, pkt)
+            elif linktype==LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR:
+                if len(pkt) < LE_LL_PHDR.size:
+                    continue
+                (channel, signal, noise, offenses, ref_aa, phdr_flags) = LE_LL_PHDR.unpack_from(pkt, 0)
+                rssi = signal if phdr_flags & LE_LL_SIGNAL_VALID else None
+                yield from ll_reports(ts, rssi, pkt[LE_LL_PHDR.size:])
+
+
+def hci_event_reports(ts, evt):
+    """Yield AdvReports from one HCI event packet (without the H4 type byte)."""
+    if len(evt) < 3 or evt[0]!=HCI_LE_META_EVENT:
+        return
+    end = min(len(evt), 2 + evt[1])
+    subevent = evt[2]
+    if subevent==LE_ADVERTISING_REPORT:
+        # Reports are laid out one after another, as BlueZ and the
+        # controllers in the field do it.
+        pos = 4
+        for _ in range(evt[3] if end > 3 else 0):
+            if pos + 9 > end:
+                return
+            addr     = evt[pos+2:pos+8]
+            data_len = evt[pos+8]
+            data     = evt[pos+9:pos+9+data_len]
+            pos     += 9 + data_len
+            if pos >= end:
+                return
+            rssi     = struct.unpack_from('b', evt, pos)[0]
+            pos     += 1
+            yield AdvReport(ts, format_address(addr), rssi, data)
+    elif subevent==LE_EXTENDED_ADVERTISING_REPORT:
+        pos = 4
+        for _ in range(evt[3] if end > 3 else 0):
+            if pos + EXT_REPORT_HEADER.size > end:
+                return
+            fields = EXT_REPORT_HEADER.unpack_from(evt, pos)
+            (addr, rssi, data_len) = (fields[2], fields[7], fields[11])
+            pos += EXT_REPORT_HEADER.size
+            data = evt[pos:min(pos+data_len, end)]
+            pos += data_len
+            yield AdvReport(ts, format_address(addr), rssi, data)
+
+
+def ll_reports(ts, rssi, pkt):
+    """Yield the AdvReport, if any, in one LE link-layer packet (starting
+    at the access address)."""
+    if len(pkt) < 12 or struct.unpack_from('<I', pkt, 0)[0]!=LL_ADV_ACCESS_ADDRESS:
+        return
+    pdu_type = pkt[4] & 0x0f
+    length   = pkt[5]
+    if pdu_type not in LL_ADV_PDUS_WITH_DATA or length < 6:
+        return
+    # access address (4) + header (2) + AdvA (6) + AdvData; the 3-byte CRC follows
+    end = min(6 + length, len(pkt))
+    yield AdvReport(ts, format_address(pkt[6:12]), rssi, pkt[12:end])
+
+
+def read_reports(path):
+    """Generator of AdvReports from a capture file."""
+    with CaptureReader(path) as reader:
+        yield from reader.reports()
+
+
+def replay(path, classifier=None, adv_filter=None):
+    """Generator of (AdvReport, classification dict) for every
+    advertisement in a capture file. If adv_filter (an
+    advfilter.AdvFilter) is given, advertisements it rejects are
+    skipped without being classified."""
+    classify = (classifier or DEFAULT_CLASSIFIER).classify
+    with CaptureReader(path) as reader:
+        for report in reader.reports():
+            if adv_filter is None or adv_filter.match(report.payload, rssi=report.rssi, address=report.address):
+                yield (report, classify(report.payload))
+
+
+def json_default(o):
+    """json.dumps() default= hook for the bytes in service data."""
+    return bytes(o).hex()
+
+
+def report_record(report, d):
+    """Combine a report and its classification into one output dict."""
+    rec = {'timestamp':report.timestamp, 'address':report.address, 'rssi':report.rssi}
+    rec.update(d)
+    return rec
+
+
+class BtsnoopWriter():
+    """Write LE Advertising Report events to a btsnoop (H4) file. Used to
+    produce synthetic captures for testing and benchmarking."""
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(BTSNOOP_HEADER.pack(BTSNOOP_MAGIC, 1, BTSNOOP_H4))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def write_report(self, timestamp, address, rssi, payload):
+        addr = bytes.fromhex(address.replace(':',''))[::-1]
+        params = (bytes([LE_ADVERTISING_REPORT, 1, 0x00, 0x01]) + addr +
+                  bytes([len(payload)]) + bytes(payload) + struct.pack('b', rssi))
+        pkt = bytes([H4_EVENT, HCI_LE_META_EVENT, len(params)]) + params
+        ts  = int(timestamp * 1e6) + BTSNOOP_EPOCH_DELTA
+        self.f.write(BTSNOOP_RECORD.pack(len(pkt), len(pkt), 0x03, 0, ts))
+        self.f.write(pkt)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay a btsnoop or pcap capture through the classifier')
+    parser.add_argument("capture", help="btsnoop or pcap file")
+    parser.add_argument("--quiet", action='store_true', help="Classify but do not print the records")
+    parser.add_argument("--limit", type=int, help="Stop after this many advertisements")
+    parser.add_argument("--filter", help="Only classify advertisements matching this expression (see advfilter.py)")
+    args = parser.parse_args()
+
+    adv_filter = AdvFilter(args.filter) if args.filter else None
+    dumps = ResultEncoder().dumps
+    count = 0
+    t0 = time.perf_counter()
+    for (report, d) in replay(args.capture, Classifier(), adv_filter):
+        count += 1
+        if not args.quiet:
+            print(dumps(report_record(report, d)))
+        if count==args.limit:
+            break
+    elapsed = time.perf_counter() - t0
+    print(f"{count} records in {elapsed:.3f}s: {count/elapsed if elapsed else 0:,.0f} records/sec",
+          file=sys.stderr)
+    if adv_filter:
+        print(f"filter: {adv_filter.stats()}", file=sys.stderr)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: instrumentation.py
+"""
+Opt-in counters and latency histograms for the classifier and scanner.
+
+Nothing here is on the hot path unless a Metrics object is passed in:
+Classifier(metrics=m) swaps timed wrappers into its dispatch tables when
+it is built, so an engine without metrics runs exactly the code it ran
+before. Counter updates are not locked; under the GIL they can at worst
+lose an increment when several threads share one Metrics.
+
+Histograms use power-of-two nanosecond buckets: bucket i counts
+durations in [2**(i-1), 2**i) ns.
+"""
+
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+HISTOGRAM_BUCKETS = 40      # up to 2**39 ns, about 9 minutes
+
+class Histogram():
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count   = 0
+        self.total   = 0.0
+        self.min     = None
+        self.max     = None
+        self.buckets = [0]*HISTOGRAM_BUCKETS
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds*1e9).bit_length(), HISTOGRAM_BUCKETS-1)] += 1
+
+    def percentile(self, p):
+        """Upper bound, in seconds, of the bucket holding the p-th percentile."""
+        if not self.count:
+            return None
+        target = p/100 * self.count
+        running = 0
+        for (i, n) in enumerate(self.buckets):
+            running += n
+            if running >= target:
+                return (1<<i) / 1e9
+        return self.max
+
+    def snapshot(self):
+        return {'count':self.count,
+                'mean':self.total/self.count if self.count else None,
+                'min':self.min, 'max':self.max,
+                'p50':self.percentile(50), 'p90':self.percentile(90), 'p99':self.percentile(99),
+                'buckets':{f"<{1<<i}ns":n for (i, n) in enumerate(self.buckets) if n}}
+
+
+class Metrics():
+    def __init__(self):
+        self.counters   = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.started    = time.time()
+
+    def incr(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[name].record(time.perf_counter() - t0)
+
+    def timed(self, fn, name, counter=None):
+        """Wrap fn so every call is timed into histogram name and, if
+        given, counted in counter."""
+        histogram = self.histograms[name]
+        counters  = self.counters
+        perf_counter = time.perf_counter
+        def wrapper(*args):
+            t0 = perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                histogram.record(perf_counter() - t0)
+                if counter is not None:
+                    counters[counter] += 1
+        wrapper.__wrapped__ = fn
+        return wrapper
+
+    def snapshot(self):
+        """Return the current counters and histogram summaries as a dict."""
+        return {'time':time.time(),
+                'uptime':time.time() - self.started,
+                'counters':dict(self.counters),
+                'histograms':{name:h.snapshot() for (name, h) in list(self.histograms.items()) if h.count}}
+
+    def reset(self):
+        # Reset in place: timed() wrappers hold on to their histograms.
+        for name in self.counters:
+            self.counters[name] = 0
+        for histogram in self.histograms.values():
+            histogram.__init__()
+        self.started = time.time()
+
+
+class MetricsDumper():
+    """Write a JSON snapshot of metrics to a file (or stderr) every
+    interval seconds from a daemon thread."""
+    def __init__(self, metrics, interval=10.0, path=None):
+        self.metrics  = metrics
+        self.interval = interval
+        self.path     = path
+        self.stopped  = threading.Event()
+        self.thread   = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def dump(self):
+        line = json.dumps(self.metrics.snapshot())
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(line + "\n")
+        else:
+            print(line, file=sys.stderr)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.dump()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: omron.py
+"""
+Decoding of Omron 2JCIE-BL01 environment sensor readings.
+
+The sensor's Latest Data characteristic (WX2_CHARACTERISTIC_DATA in
+constants.py), read or notified, is a 19-byte little-endian frame:
+
+  row          uint8    ring-buffer row number
+  temperature  int16    0.01 degC
+  humidity     uint16   0.01 %RH
+  light        uint16   1 lx
+  uv           uint16   0.01 (UV index)
+  pressure     uint16   0.1 hPa
+  noise        uint16   0.01 dB
+  discomfort   uint16   0.01 (discomfort index)
+  heatstroke   int16    0.01 degC
+  battery      uint16   1 mV
+
+decode_frame() unpacks one frame with a precompiled struct.Struct and
+returns the scaled values. decode_batch() decodes many buffered frames
+at once into NumPy column arrays (pip install numpy), which is how
+notification streams from many sensors should be ingested:
+
+    columns = decode_batch(frames)
+    columns['temperature'].mean()
+
+FrameBuffer collects (identifier, timestamp, frame) from the GATT pool
+(gattpool.py) and hands decoded batches to a callback. 'python omron.py
+--bench N' compares the two decoders.
+"""
+
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# (name, struct format, divisor, unit)
+FIELDS = (
+    ('row',         'B', 1,    ''),
+    ('temperature', 'h', 100,  'degC'),
+    ('humidity',    'H', 100,  '%RH'),
+    ('light',       'H', 1,    'lx'),
+    ('uv',          'H', 100,  'UVI'),
+    ('pressure',    'H', 10,   'hPa'),
+    ('noise',       'H', 100,  'dB'),
+    ('discomfort',  'H', 100,  'DI'),
+    ('heatstroke',  'h', 100,  'degC'),
+    ('battery',     'H', 1000, 'V'),
+)
+
+LATEST_DATA = struct.Struct('<' + ''.join(fmt for (name, fmt, divisor, unit) in FIELDS))
+FRAME_SIZE  = LATEST_DATA.size
+
+def decode_frame(value):
+    """Return {field: scaled value} for one frame. Bytes past the frame
+    are ignored; a short frame raises struct.error."""
+    raw = LATEST_DATA.unpack_from(value)
+    reading = {'row':raw[0]}
+    for (i, (name, fmt, divisor, unit)) in enumerate(FIELDS[1:], 1):
+        reading[name] = raw[i] / divisor
+    return reading
+
+def describe(reading):
+    """One line of text for a decoded frame."""
+    return " ".join(f"{name}={reading[name]:g}{unit}" for (name, fmt, divisor, unit) in FIELDS[1:])
+
+
+def frame_dtype():
+    return numpy.dtype([(name, '<' + fmt.replace('B', 'u1').replace('h', 'i2').replace('H', 'u2'))
+                        for (name, fmt, divisor, unit) in FIELDS])
+
+def decode_batch(frames):
+    """Decode a sequence of frames into {field: numpy array}, scaled as
+    in decode_frame() ('row' stays an integer array). Frames shorter
+    than FRAME_SIZE are skipped; 'index' holds the position in frames
+    of each row decoded."""
+    if numpy is None:
+        raise ValueError("decode_batch() needs numpy")
+    good = [i for (i, frame) in enumerate(frames) if len(frame) >= FRAME_SIZE]
+    data = b"".join([frames[i][:FRAME_SIZE] for i in good])
+    records = numpy.frombuffer(data, dtype=frame_dtype())
+    columns = {'index':numpy.array(good, dtype=numpy.int64), 'row':records['row'].copy()}
+    for (name, fmt, divisor, unit) in FIELDS[1:]:
+        columns[name] = records[name] / divisor
+    return columns
+
+
+class FrameBuffer():
+    """Collects frames from many sensors and decodes them a batch at a
+    time. on_batch(columns) gets decode_batch()'s columns plus
+    'identifier' (a list) and 'timestamp' (an array) for each row."""
+    def __init__(self, on_batch, batch_size=1000):
+        self.on_batch   = on_batch
+        self.batch_size = batch_size
+        self.identifiers = []
+        self.timestamps  = []
+        self.frames      = []
+        self.count_frames  = 0
+        self.count_decoded = 0
+        self.count_batches = 0
+
+    def add(self, identifier, value, timestamp=None):
+        """Buffer one frame; the signature matches GATTPool's on_value."""
+        self.identifiers.append(identifier)
+        self.timestamps.append(time.time() if timestamp is None else timestamp)
+        self.frames.append(value)
+        self.count_frames += 1
+        if len(self.frames) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.frames:
+            return
+        columns = decode_batch(self.frames)
+        index   = columns['index']
+        columns['identifier'] = [self.identifiers[i] for i in index]
+        columns['timestamp']  = numpy.array(self.timestamps, dtype=numpy.float64)[index]
+        (self.identifiers, self.timestamps, self.frames) = ([], [], [])
+        self.count_decoded += len(index)
+        self.count_batches += 1
+        self.on_batch(columns)
+
+    def stats(self):
+        return {'frames':self.count_frames,
+                'decoded':self.count_decoded,
+                'batches':self.count_batches,
+                'buffered':len(self.frames)}
+
+
+def benchmark(count, repeat=5, seed=0):
+    """Decode count random frames with decode_frame() in a loop and with
+    decode_batch(), best of repeat runs. Returns {name: frames/sec}."""
+    import random
+    rnd = random.Random(seed)
+    frames = [LATEST_DATA.pack(i & 0xff, rnd.randint(-1000, 4000), rnd.randint(0, 10000), rnd.randint(0, 2000),
+                               rnd.randint(0, 1100), rnd.randint(9000, 11000), rnd.randint(3000, 9000),
+                               rnd.randint(4000, 9000), rnd.randint(-1000, 4000), rnd.randint(2000, 3300))
+              for i in range(count)]
+    candidates = {'decode_frame': lambda: [decode_frame(frame) for frame in frames]}
+    if numpy is not None:
+        candidates['decode_batch'] = lambda: decode_batch(frames)
+    results = {}
+    for (name, fn) in candidates.items():
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+        results[name] = count / best
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Decode 2JCIE-BL01 Latest Data frames (hex, one per line on stdin)')
+    parser.add_argument("--bench", type=int, metavar='N', help="Time decoding N frames one at a time and as a batch")
+    args = parser.parse_args()
+
+    if args.bench:
+        for (name, rate) in benchmark(args.bench).items():
+            print(f"{name:14} {rate:>14,.0f} frames/sec")
+        exit(0)
+
+    for line in sys.stdin:
+        if line.strip():
+            try:
+                print(describe(decode_frame(bytes.fromhex(line.strip()))))
+            except (ValueError, struct.error) as e:
+                print(f"{line.strip()}: {e}", file=sys.stderr)
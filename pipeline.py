@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: pipeline.py
+"""
+Decouple the CoreBluetooth delegate from classification and output.
+
+The delegate callback only takes an AdvSnapshot (identifier, name,
+RSSI, raw manufacturer bytes, monotonic timestamp) and puts it on a
+BoundedQueue. An asyncio consumer, normally running in its own thread,
+drains the queue in batches, classifies and emits the records. When the
+queue is full it either drops the oldest queued snapshot or the new one,
+and counts the drops.
+
+FakeDelegate drives the same path without CoreBluetooth, so the
+pipeline can be load-tested on any platform:
+
+    python pipeline.py --count 200000 --rate 50000 --policy drop-newest
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import deque,namedtuple
+
+from advdelta import DeltaDecoder
+from advjson import dumps
+from btleclassifier import Classifier,DEFAULT_CLASSIFIER
+from constants import C
+from instrumentation import Metrics
+from sinks import COMPRESSORS,NDJSONSink
+
+AdvSnapshot = namedtuple('AdvSnapshot', ['identifier', 'name', 'rssi', 'raw', 'timestamp'])
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+POLICIES    = (DROP_OLDEST, DROP_NEWEST)
+
+def snapshot_advertisement(peripheral, data, rssi):
+    """Copy what we need out of a didDiscoverPeripheral callback. This is
+    all the work done on the CoreBluetooth thread."""
+    raw = data.get(C.kCBAdvDataManufacturerData)
+    return AdvSnapshot(str(peripheral.identifier()),
+                       peripheral.name(),
+                       int(rssi),
+                       bytes(raw) if raw is not None else None,
+                       time.monotonic())
+
+
+class BoundedQueue():
+    """Thread-safe bounded queue with a non-blocking put() for the
+    producer and an awaitable get_batch() for a single asyncio consumer."""
+    def __init__(self, maxsize=10000, policy=DROP_OLDEST):
+        assert maxsize > 0
+        assert policy in POLICIES
+        self.maxsize = maxsize
+        self.policy  = policy
+        self.items   = deque()
+        self.lock    = threading.Lock()
+        self.count_put     = 0
+        self.count_dropped = 0
+        self.closed  = False
+        self.loop    = None
+        self.event   = None
+        self.waiting = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def bind(self, loop):
+        """Attach to the consumer's event loop."""
+        self.loop  = loop
+        self.event = asyncio.Event()
+
+    def put(self, item):
+        """Add item, applying the drop policy if full. Returns False if
+        item itself was dropped."""
+        with self.lock:
+            self.count_put += 1
+            if len(self.items) >= self.maxsize:
+                self.count_dropped += 1
+                if self.policy==DROP_NEWEST:
+                    return False
+                self.items.popleft()
+            self.items.append(item)
+            wake = self.waiting
+            self.waiting = False
+        if wake:
+            self.loop.call_soon_threadsafe(self.event.set)
+        return True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            wake = self.waiting
+            self.waiting = False
+        if wake:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def drain(self, maxitems):
+        with self.lock:
+            n = min(maxitems, len(self.items))
+            return [self.items.popleft() for _ in range(n)]
+
+    async def get_batch(self, maxitems):
+        """Wait for and return up to maxitems items. Returns an empty
+        list once the queue is closed and empty."""
+        while True:
+            batch = self.drain(maxitems)
+            if batch:
+                return batch
+            with self.lock:
+                if self.items:
+                    continue
+                if self.closed:
+                    return []
+                self.event.clear()
+                self.waiting = True
+            await self.event.wait()
+
+
+def print_record(record):
+    print(dumps(record, indent=5))
+
+
+class AdvPipeline():
+    """Snapshot queue plus an asyncio classify-and-emit stage. emit is
+    called with one record dict per advertisement. If a DeviceRegistry
+    is given, the consumer stage keeps it up to date. With an
+    advdelta.DeltaDecoder, emit gets change events instead, and nothing
+    for an advertisement identical to the device's last one."""
+    def __init__(self, emit=print_record, classifier=None, maxsize=10000,
+                 policy=DROP_OLDEST, batch_size=256, devices=None, metrics=None, delta=None):
+        self.emit       = emit
+        self.delta      = delta
+        self.metrics    = metrics
+        self.classifier = classifier or DEFAULT_CLASSIFIER
+        self.devices    = devices
+        self.queue      = BoundedQueue(maxsize, policy)
+        self.batch_size = batch_size
+        self.count_emitted = 0
+        self.max_lag    = 0.0
+        self.thread     = None
+
+    def submit(self, snapshot):
+        """Called from the delegate. Never blocks."""
+        return self.queue.put(snapshot)
+
+    def process(self, snapshot):
+        """Return the record to emit for snapshot, or None."""
+        if self.devices is not None:
+            self.devices.update(snapshot.identifier, snapshot.rssi, snapshot.raw)
+        if self.delta is not None:
+            record = self.delta.update(snapshot.identifier, manuf_data=snapshot.raw, rssi=snapshot.rssi)
+            if record is not None:
+                record['lag'] = time.monotonic() - snapshot.timestamp
+            return record
+        record = {'identifier':snapshot.identifier,
+                  'name':snapshot.name,
+                  'rssi':snapshot.rssi,
+                  'timestamp':time.time(),
+                  'lag':time.monotonic() - snapshot.timestamp}
+        if snapshot.raw is not None:
+            record.update(self.classifier.classify(manuf_data=snapshot.raw))
+        return record
+
+    async def run(self):
+        """Consume until close() is called and the queue is empty."""
+        self.queue.bind(asyncio.get_running_loop())
+        while True:
+            batch = await self.queue.get_batch(self.batch_size)
+            if not batch:
+                break
+            if self.metrics is None:
+                for snapshot in batch:
+                    record = self.process(snapshot)
+                    if record is not None:
+                        self.max_lag = max(self.max_lag, record['lag'])
+                        self.emit(record)
+                        self.count_emitted += 1
+            else:
+                self.process_instrumented(batch)
+            # let other tasks on this loop run between batches
+            await asyncio.sleep(0)
+
+    def process_instrumented(self, batch):
+        """The loop in run(), also recording the queue lag, the output
+        time and the time from callback to output."""
+        metrics = self.metrics
+        metrics.incr('queue_batches')
+        for snapshot in batch:
+            record = self.process(snapshot)
+            if record is None:
+                metrics.incr('heartbeats')
+                continue
+            metrics.observe('queue_lag', record['lag'])
+            self.max_lag = max(self.max_lag, record['lag'])
+            with metrics.timer('output'):
+                self.emit(record)
+            self.count_emitted += 1
+            metrics.observe('callback_to_output', time.monotonic() - snapshot.timestamp)
+        metrics.incr('queue_dropped', self.queue.count_dropped - metrics.counters['queue_dropped'])
+
+    def start_thread(self):
+        """Run the consumer on its own event loop in a daemon thread, so
+        the CoreBluetooth run loop can keep the main thread."""
+        ready = threading.Event()
+        async def main():
+            task = asyncio.ensure_future(self.run())
+            ready.set()
+            await task
+        self.thread = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self.thread
+
+    def close(self, wait=True):
+        """Stop accepting work; the consumer finishes the queued items."""
+        self.queue.close()
+        if wait and self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        stats = {'submitted':self.queue.count_put,
+                 'queued':len(self.queue),
+                 'dropped':self.queue.count_dropped,
+                 'emitted':self.count_emitted,
+                 'policy':self.queue.policy,
+                 'max_lag':self.max_lag}
+        if self.delta is not None:
+            stats['delta'] = self.delta.stats()
+        return stats
+
+
+class PipelineDelegate():
+    """CoreBluetooth central manager delegate that only snapshots."""
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.count_advertisements = 0
+
+    def centralManager_didDiscoverPeripheral_advertisementData_RSSI_(self, manager, peripheral, data, rssi):
+        self.count_advertisements += 1
+        self.pipeline.submit(snapshot_advertisement(peripheral, data, rssi))
+
+
+class FakePeripheral():
+    """Stands in for a CBPeripheral."""
+    def __init__(self, identifier, name=None):
+        self._identifier = identifier
+        self._name = name
+
+    def identifier(self):
+        return self._identifier
+
+    def name(self):
+        return self._name
+
+
+MANUF_EXAMPLES = ["4c0010050b1c6d9072",
+                  "4c000c0e00750f812422021c3e213d190f3310050b1c6d9072",
+                  "060001092002a5f7c3e4a1b2"]
+
+class FakeDelegate():
+    """Calls a delegate's didDiscoverPeripheral method the way
+    CoreBluetooth would, from its own thread, at a given rate."""
+    def __init__(self, delegate, payloads=None, devices=100):
+        self.delegate = delegate
+        self.payloads = [bytes.fromhex(h) for h in (payloads or MANUF_EXAMPLES)]
+        self.peripherals = [FakePeripheral(f"00000000-0000-0000-0000-{i:012X}") for i in range(devices)]
+
+    def run(self, count, rate=None):
+        """Deliver count advertisements, at rate per second if given."""
+        callback = self.delegate.centralManager_didDiscoverPeripheral_advertisementData_RSSI_
+        t0 = time.monotonic()
+        for i in range(count):
+            if rate:
+                delay = t0 + i/rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            data = {C.kCBAdvDataManufacturerData: self.payloads[i % len(self.payloads)]}
+            callback(None, self.peripherals[i % len(self.peripherals)], data, -40 - i % 50)
+
+    def start_thread(self, count, rate=None):
+        thread = threading.Thread(target=self.run, args=(count, rate), daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Load-test the advertisement pipeline with a fake delegate')
+    parser.add_argument("--count", type=int, default=100000, help="advertisements to deliver")
+    parser.add_argument("--rate", type=float, help="advertisements/second (default: as fast as possible)")
+    parser.add_argument("--devices", type=int, default=100, help="number of fake peripherals")
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--policy", choices=POLICIES, default=DROP_OLDEST)
+    parser.add_argument("--print", action='store_true', help="print the records")
+    parser.add_argument("--output", help="write the records as NDJSON to this file ('-' for stdout)")
+    parser.add_argument("--rotate-bytes", type=int, help="with --output, start a new file after this many bytes")
+    parser.add_argument("--compress", choices=sorted(COMPRESSORS), help="with --output, compress the files")
+    parser.add_argument("--metrics", action='store_true', help="instrument the pipeline and print the metrics")
+    parser.add_argument("--changes", action='store_true', help="emit only change events (see advdelta.py)")
+    args = parser.parse_args()
+
+    metrics = Metrics() if args.metrics else None
+    sink = None
+    if args.output:
+        sink = NDJSONSink(args.output, rotate_bytes=args.rotate_bytes, compress=args.compress, metrics=metrics)
+        emit = sink.emit
+    else:
+        emit = print_record if args.print else (lambda record: None)
+    classifier = Classifier(metrics=metrics)
+    pipeline = AdvPipeline(emit=emit, classifier=classifier, maxsize=args.queue_size,
+                           policy=args.policy, metrics=metrics,
+                           delta=DeltaDecoder(classifier) if args.changes else None)
+    pipeline.start_thread()
+    t0 = time.perf_counter()
+    FakeDelegate(PipelineDelegate(pipeline), devices=args.devices).start_thread(args.count, args.rate).join()
+    t1 = time.perf_counter()
+    pipeline.close()
+    if sink is not None:
+        sink.close()
+    t2 = time.perf_counter()
+    print(f"delivered {args.count} in {t1-t0:.3f}s ({args.count/(t1-t0):,.0f}/sec); "
+          f"drained in {t2-t0:.3f}s")
+    print(pipeline.stats())
+    if sink is not None:
+        print(sink.stats())
+    if metrics is not None:
+        print(json.dumps(metrics.snapshot(), indent=2))
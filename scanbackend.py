@@ -0,0 +1,565 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: scanbackend.py
+"""
+Scan backends: where the scanner's advertisements come from.
+
+A backend drives a central manager delegate (scanner.MyBLE, or anything
+with the same CoreBluetooth-style methods): it calls
+centralManagerDidUpdateState_(manager) once the radio is ready, and
+centralManager_didDiscoverPeripheral_advertisementData_RSSI_(manager,
+peripheral, data, rssi) for every advertisement, where data is keyed by
+the constants in constants.py. run() blocks until stop() is called.
+call_later(delay, fn) runs fn on the callback thread after delay
+seconds, and uuids(strings) makes the service UUID objects the
+manager's scanForPeripheralsWithServices_options_ takes.
+
+  corebluetooth  the real radio, through PyObjC. Foundation is only
+                 imported when this backend is created, so everything
+                 else works without macOS.
+  simulated      an in-process population of virtual devices
+                 advertising at a configured total rate, with RSSI noise
+                 and drift and payload churn (Handoff sequence numbers,
+                 Nearby action codes), or a replay of a corpus. It
+                 honors the service filter and
+                 CBCentralManagerScanOptionAllowDuplicatesKey: without
+                 duplicates, a device is reported once per scan unless
+                 its payload changes. sensors adds devices that look
+                 like Omron 2JCIE-BL01 environment sensors and accept
+                 GATT connections, with configurable latency, failed
+                 connections and dropped links (see gattpool.py).
+
+The simulated backend delivers callbacks on the thread that called
+run(), as CoreBluetooth does on the main run loop, so a slow delegate
+slows it down. stats() reports the rate it actually achieved; driving
+the scanner at rate=None (as fast as possible) measures the highest
+rate the whole scan path can sustain:
+
+    python scanner.py --backend simulated --sim-devices 1000 --count 200000 --quiet --pipeline \
+        --allow-duplicates
+"""
+
+import heapq
+import random
+import struct
+import time
+
+import advcorpus
+from constants import C,WX2_SERVICE,WX2_CHARACTERISTIC_DATA
+from omron import LATEST_DATA
+from pipeline import FakePeripheral
+
+# kind of virtual device -> relative weight. None advertises without
+# manufacturer data.
+DEVICE_MIX = {
+    'apple_handoff': 25,
+    'apple_nearby':  35,
+    'apple_hotspot':  3,
+    'apple_wifi':     5,
+    'apple_ibeacon':  7,
+    'microsoft':     15,
+    None:            10,
+}
+
+NEARBY_ACTION_CODES = (1, 3, 7, 10, 11, 13, 14)
+CHANNELS = (37, 38, 39)
+SERVICE_FRACTION = 0.3          # of virtual devices advertising a 16-bit service UUID
+TX_POWER_FRACTION = 0.3         # of virtual devices advertising their TX power
+PROPERTY_READ   = 0x02
+PROPERTY_NOTIFY = 0x10
+
+class ScanBackend():
+    """Base class. Subclasses implement run() and stop()."""
+    name = None
+
+    def __init__(self, delegate):
+        self.delegate = delegate
+
+    def run(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def call_later(self, delay, fn):
+        raise NotImplementedError
+
+    def uuids(self, strings):
+        raise NotImplementedError
+
+    def stats(self):
+        return {'backend':self.name}
+
+
+class CoreBluetoothBackend(ScanBackend):
+    name = 'corebluetooth'
+
+    def __init__(self, delegate):
+        super().__init__(delegate)
+        try:
+            from Foundation import CBCentralManager,CBUUID
+            from PyObjCTools import AppHelper
+        except ImportError as e:
+            raise ImportError(f"the corebluetooth backend needs macOS and PyObjC ({e}); "
+                              "try the simulated backend") from e
+        self.app_helper = AppHelper
+        self.cbuuid     = CBUUID
+        self.manager    = CBCentralManager.alloc()
+
+    def run(self):
+        self.manager.initWithDelegate_queue_options_(self.delegate, None, None)
+        try:
+            self.app_helper.runConsoleEventLoop()
+        except (KeyboardInterrupt, SystemExit) as e:
+            print(e)
+
+    def stop(self):
+        self.app_helper.stopEventLoop()
+
+    def call_later(self, delay, fn):
+        self.app_helper.callLater(delay, fn)
+
+    def uuids(self, strings):
+        return [self.cbuuid.UUIDWithString_(s) for s in strings]
+
+
+class SimulatedUUID():
+    """Stands in for a CBUUID."""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text.upper()
+
+    def __repr__(self):
+        return self.text
+
+    def UUIDString(self):
+        return self.text
+
+
+class SimulatedManager():
+    """Stands in for a CBCentralManager: records what the delegate asks
+    to scan for, and connects to SimulatedPeripherals. Each scan call
+    starts a new session, which resets duplicate suppression."""
+    def __init__(self, backend):
+        self.backend  = backend
+        self.scanning = False
+        self.services = None        # set of UUID strings, or None for all
+        self.allow_duplicates = False
+        self.session  = 0
+        self.connected = set()
+        self.count_scans = 0
+        self.count_connects = 0
+        self.count_failed   = 0
+        self.count_dropped  = 0
+        self.max_connected  = 0
+
+    def scanForPeripheralsWithServices_options_(self, services, options):
+        self.scanning = True
+        self.services = {uuid.UUIDString() for uuid in services} if services else None
+        self.allow_duplicates = bool((options or {}).get(C.CBCentralManagerScanOptionAllowDuplicatesKey))
+        self.session += 1
+        self.count_scans += 1
+
+    def stopScan(self):
+        self.scanning = False
+
+    def connectPeripheral_options_(self, peripheral, options):
+        backend = self.backend
+        peripheral.attempt += 1
+        attempt = peripheral.attempt
+        self.count_connects += 1
+        def done():
+            if peripheral.attempt != attempt:
+                return      # cancelled
+            limit = backend.max_radio_connections
+            if (limit is not None and len(self.connected) >= limit) or backend.rnd.random() < backend.connect_fail:
+                self.count_failed += 1
+                backend.delegate.centralManager_didFailToConnectPeripheral_error_(self, peripheral,
+                                                                                  'connection failed')
+                return
+            peripheral.connected = True
+            self.connected.add(peripheral)
+            self.max_connected = max(self.max_connected, len(self.connected))
+            backend.delegate.centralManager_didConnectPeripheral_(self, peripheral)
+        backend.call_later(backend.latency(backend.connect_latency), done)
+
+    def cancelPeripheralConnection_(self, peripheral):
+        peripheral.attempt += 1
+        def done():
+            self.disconnect(peripheral)
+            self.backend.delegate.centralManager_didDisconnectPeripheral_error_(self, peripheral, None)
+        self.backend.call_later(self.backend.latency(self.backend.gatt_latency), done)
+
+    def disconnect(self, peripheral):
+        self.connected.discard(peripheral)
+        peripheral.reset()
+
+    def drop(self, peripheral):
+        """The link to peripheral is lost."""
+        self.count_dropped += 1
+        self.disconnect(peripheral)
+        self.backend.delegate.centralManager_didDisconnectPeripheral_error_(self, peripheral, 'connection lost')
+
+
+class SimulatedCharacteristic():
+    """Stands in for a CBCharacteristic. read() makes its next value."""
+    def __init__(self, uuid, properties, read):
+        self.uuid   = SimulatedUUID(uuid)
+        self.props  = properties
+        self.read   = read
+        self.data   = None
+        self.notifying = False
+
+    def UUID(self):
+        return self.uuid
+
+    def properties(self):
+        return self.props
+
+    def value(self):
+        return self.data
+
+    def isNotifying(self):
+        return self.notifying
+
+
+class SimulatedService():
+    """Stands in for a CBService."""
+    def __init__(self, uuid, characteristics):
+        self.uuid = SimulatedUUID(uuid)
+        self.all_characteristics = characteristics
+        self.discovered = None
+
+    def UUID(self):
+        return self.uuid
+
+    def characteristics(self):
+        return self.discovered
+
+
+class SimulatedPeripheral(FakePeripheral):
+    """A peripheral with GATT services. Every request is answered on
+    the backend's timer after its GATT latency, if still connected."""
+    def __init__(self, identifier, name, backend, services):
+        super().__init__(identifier, name)
+        self.backend   = backend
+        self.all_services = services
+        self.discovered = None
+        self.delegate  = None
+        self.connected = False
+        self.attempt   = 0
+
+    def reset(self):
+        self.connected  = False
+        self.discovered = None
+        for service in self.all_services:
+            service.discovered = None
+            for characteristic in service.all_characteristics:
+                characteristic.notifying = False
+
+    def later(self, fn):
+        backend = self.backend
+        attempt = self.attempt
+        def run():
+            if self.connected and self.attempt==attempt:
+                fn()
+        backend.call_later(backend.latency(backend.gatt_latency), run)
+
+    def setDelegate_(self, delegate):
+        self.delegate = delegate
+
+    def services(self):
+        return self.discovered
+
+    def discoverServices_(self, uuids):
+        wanted = {uuid.UUIDString() for uuid in uuids} if uuids else None
+        def done():
+            self.discovered = [s for s in self.all_services if wanted is None or s.uuid.text in wanted]
+            self.delegate.peripheral_didDiscoverServices_(self, None)
+        self.later(done)
+
+    def discoverCharacteristics_forService_(self, uuids, service):
+        wanted = {uuid.UUIDString() for uuid in uuids} if uuids else None
+        def done():
+            service.discovered = [c for c in service.all_characteristics if wanted is None or c.uuid.text in wanted]
+            self.delegate.peripheral_didDiscoverCharacteristicsForService_error_(self, service, None)
+        self.later(done)
+
+    def deliver(self, characteristic):
+        if self.backend.rnd.random() < self.backend.disconnect_rate:
+            self.backend.manager.drop(self)
+            return
+        characteristic.data = characteristic.read()
+        self.delegate.peripheral_didUpdateValueForCharacteristic_error_(self, characteristic, None)
+
+    def readValueForCharacteristic_(self, characteristic):
+        self.later(lambda: self.deliver(characteristic))
+
+    def setNotifyValue_forCharacteristic_(self, enabled, characteristic):
+        def notify():
+            if characteristic.notifying:
+                self.deliver(characteristic)
+                self.backend.call_later(self.backend.notify_interval, lambda: self.connected and notify())
+        def done():
+            characteristic.notifying = bool(enabled)
+            self.delegate.peripheral_didUpdateNotificationStateForCharacteristic_error_(self, characteristic, None)
+            if enabled:
+                self.backend.call_later(self.backend.notify_interval, lambda: self.connected and notify())
+        self.later(done)
+
+
+def sensor_reading(rnd, row):
+    """A 2JCIE-BL01 Latest Data value: row, temperature (0.01 degC),
+    humidity (0.01 %RH), light (lx), UV index (0.01), pressure (0.1 hPa),
+    noise (0.01 dB), discomfort index (0.01), heatstroke (0.01 degC),
+    battery (mV)."""
+    return LATEST_DATA.pack(row & 0xff,
+                       int(rnd.gauss(2300, 150)), int(rnd.uniform(3000, 6000)), int(rnd.uniform(0, 800)),
+                       int(rnd.uniform(0, 300)), int(rnd.gauss(10130, 30)), int(rnd.uniform(3500, 6000)),
+                       int(rnd.uniform(6000, 7500)), int(rnd.gauss(2000, 200)), int(rnd.uniform(2700, 3000)))
+
+
+class VirtualDevice():
+    __slots__ = ('peripheral', 'kind', 'payload', 'rssi_mean', 'connectable', 'services', 'tx_power',
+                 'reported_session', 'reported_payload')
+
+    def __init__(self, peripheral, kind, payload, rssi_mean, connectable, services, tx_power=None):
+        self.peripheral  = peripheral
+        self.kind        = kind
+        self.payload     = payload
+        self.rssi_mean   = rssi_mean
+        self.connectable = connectable
+        self.services    = services     # list of SimulatedUUID
+        self.tx_power    = tx_power     # dBm, or None if not advertised
+        self.reported_session = None
+        self.reported_payload = None
+
+
+def manufacturer_data(adv_data):
+    """Return the data of the last manufacturer-specific (0xff) AD
+    structure in adv_data, as CoreBluetooth reports it, or None."""
+    found = None
+    pos = 0
+    end = len(adv_data)
+    while pos + 1 < end:
+        stop = pos + 1 + adv_data[pos]
+        if adv_data[pos] and adv_data[pos+1]==0xff:
+            found = adv_data[pos+2:min(stop, end)]
+        pos = stop
+    return found
+
+def churn(payload, rnd):
+    """Return payload as its device might send it next: a new Handoff
+    sequence number, Nearby action code, or (for anything else) last
+    byte."""
+    if len(payload) < 3:
+        return payload
+    data = bytearray(payload)
+    if data[0:2]==b'\x4c\x00':
+        pos = 2
+        while pos + 1 < len(data):
+            (apple_type, length) = (data[pos], data[pos+1])
+            if apple_type==0x0c and length >= 3 and pos + 5 <= len(data):
+                seq = (struct.unpack_from('<H', data, pos+3)[0] + 1) & 0xffff
+                struct.pack_into('<H', data, pos+3, seq)
+            elif apple_type==0x10 and length >= 1 and pos + 2 < len(data):
+                data[pos+2] = (data[pos+2] & 0xf0) | rnd.choice(NEARBY_ACTION_CODES)
+            pos += 2 + length
+    else:
+        data[-1] = rnd.getrandbits(8)
+    return bytes(data)
+
+
+class SimulatedBackend(ScanBackend):
+    """devices virtual devices advertising rate times a second in total
+    (rate=None: as fast as the delegate takes them). Each advertisement
+    changes its device's payload with probability churn. If corpus (a
+    list of advertisement payloads, e.g. from advcorpus or a hex file)
+    is given, it is replayed round-robin across the devices instead.
+    Stops after count advertisements (sent, whether or not the scan
+    reported them) or duration seconds, if given.
+
+    The sensors added after the devices accept connections.
+    connect_latency and gatt_latency are mean seconds per connection and
+    per GATT request; connect_fail is the chance a connection fails,
+    disconnect_rate the chance the link drops on a read or
+    notification, and max_radio_connections the limit the radio puts
+    on concurrent connections."""
+    name = 'simulated'
+
+    def __init__(self, delegate, devices=100, rate=None, churn=0.05, corpus=None,
+                 count=None, duration=None, seed=0, sensors=0, connect_latency=0.2, gatt_latency=0.03,
+                 connect_fail=0.05, disconnect_rate=0.005, max_radio_connections=None, notify_interval=1.0):
+        super().__init__(delegate)
+        assert devices + sensors > 0
+        self.connect_latency = connect_latency
+        self.gatt_latency    = gatt_latency
+        self.connect_fail    = connect_fail
+        self.disconnect_rate = disconnect_rate
+        self.max_radio_connections = max_radio_connections
+        self.notify_interval = notify_interval
+        self.rate     = rate
+        self.churn    = churn
+        self.count    = count
+        self.duration = duration
+        self.rnd      = random.Random(seed)
+        self.manager  = SimulatedManager(self)
+        self.corpus   = [manufacturer_data(adv) for adv in corpus] if corpus else None
+        self.devices  = [self.make_device(i) for i in range(devices)]
+        self.devices += [self.make_sensor(devices + i) for i in range(sensors)]
+        self.stopped  = False
+        self.timers   = []          # heap of (when, n, fn)
+        self.count_timers     = 0
+        self.count_advertised = 0
+        self.count_delivered  = 0
+        self.max_behind = 0.0       # furthest behind schedule, in seconds
+        self.started  = None
+        self.finished = None
+
+    def make_device(self, i):
+        rnd  = self.rnd
+        kind = rnd.choices(list(DEVICE_MIX), list(DEVICE_MIX.values()))[0]
+        payload = None
+        if kind is not None:
+            generator = advcorpus.CorpusGenerator(rnd.getrandbits(32))
+            payload   = getattr(generator, kind)()[2:]      # strip the AD length and type
+        name = f"sim-{i}" if rnd.random() < 0.3 else None
+        services = []
+        if rnd.random() < SERVICE_FRACTION:
+            services = [SimulatedUUID(f"{rnd.choice(advcorpus.SERVICE_UUIDS):04X}")]
+        peripheral = FakePeripheral(f"{rnd.getrandbits(32):08X}-0000-4000-8000-{i:012X}", name)
+        tx_power = rnd.randint(-12, 8) if rnd.random() < TX_POWER_FRACTION else None
+        return VirtualDevice(peripheral, kind, payload, rnd.uniform(-95, -40), rnd.random() < 0.5, services,
+                             tx_power)
+
+    def make_sensor(self, i):
+        rnd  = self.rnd
+        rows = iter(range(1<<30))
+        data = SimulatedCharacteristic(WX2_CHARACTERISTIC_DATA, PROPERTY_READ | PROPERTY_NOTIFY,
+                                       lambda: sensor_reading(rnd, next(rows)))
+        peripheral = SimulatedPeripheral(f"{rnd.getrandbits(32):08X}-0000-4000-8000-{i:012X}", 'EP', self,
+                                         [SimulatedService(WX2_SERVICE, [data])])
+        return VirtualDevice(peripheral, 'sensor', None, rnd.uniform(-90, -50), True,
+                             [SimulatedUUID(WX2_SERVICE)])
+
+    def latency(self, mean):
+        return self.rnd.uniform(0.5, 1.5) * mean
+
+    def advertise(self, i):
+        """Send the i-th advertisement. Returns True if the scan
+        reported it to the delegate."""
+        rnd     = self.rnd
+        manager = self.manager
+        device  = self.devices[i % len(self.devices)]
+        if self.corpus is not None:
+            payload = self.corpus[i % len(self.corpus)]
+        else:
+            if device.payload is not None and rnd.random() < self.churn:
+                device.payload = churn(device.payload, rnd)
+            payload = device.payload
+        if not manager.scanning:
+            return False
+        if manager.services is not None and not any(uuid.text in manager.services for uuid in device.services):
+            return False
+        if not manager.allow_duplicates:
+            if device.reported_session==manager.session and device.reported_payload==payload:
+                return False
+            (device.reported_session, device.reported_payload) = (manager.session, payload)
+        device.rssi_mean = min(-30.0, max(-100.0, device.rssi_mean + rnd.gauss(0, 0.2)))
+        rssi = max(-127, min(20, int(round(device.rssi_mean + rnd.gauss(0, 3)))))
+        data = {C.kCBAdvDataChannel: CHANNELS[i % 3],
+                C.kCBAdvDataIsConnectable: device.connectable}
+        if payload is not None:
+            data[C.kCBAdvDataManufacturerData] = payload
+        if device.services:
+            data[C.kCBAdvDataServiceUUIDs] = device.services
+        if device.tx_power is not None:
+            data[C.kCBAdvDataTxPowerLevel] = device.tx_power
+        self.count_delivered += 1
+        self.delegate.centralManager_didDiscoverPeripheral_advertisementData_RSSI_(
+            manager, device.peripheral, data, rssi)
+        return True
+
+    def done(self, now):
+        return (self.stopped or
+                (self.count is not None and self.count_advertised >= self.count) or
+                (self.duration is not None and now - self.started >= self.duration))
+
+    def call_later(self, delay, fn):
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.count_timers, fn))
+        self.count_timers += 1
+
+    def uuids(self, strings):
+        return [SimulatedUUID(s) for s in strings]
+
+    def run_timers(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+
+    def sleep_until(self, when):
+        if self.timers:
+            when = min(when, self.timers[0][0])
+        delay = when - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self):
+        self.started = time.monotonic()
+        self.delegate.centralManagerDidUpdateState_(self.manager)
+        while True:
+            now = time.monotonic()
+            self.run_timers(now)
+            if self.done(now):
+                break
+            if self.rate:
+                # send whatever is due (in slices, so timers stay on
+                # time), then sleep until the next one
+                due = int((now - self.started) * self.rate) - self.count_advertised
+                if due <= 0:
+                    self.sleep_until(self.started + (self.count_advertised + 1) / self.rate)
+                    continue
+                self.max_behind = max(self.max_behind, (due - 1) / self.rate)
+                due = min(due, 1000)
+            elif self.manager.scanning:
+                due = 1000
+            else:
+                self.sleep_until(now + 0.001)
+                continue
+            for _ in range(due):
+                self.advertise(self.count_advertised)
+                self.count_advertised += 1
+                if self.stopped:
+                    break
+        self.finished = time.monotonic()
+
+    def stop(self):
+        self.stopped = True
+        self.manager.stopScan()
+
+    def stats(self):
+        elapsed = ((self.finished or time.monotonic()) - self.started) if self.started else 0.0
+        return {'backend':self.name,
+                'devices':len(self.devices),
+                'target_rate':self.rate,
+                'advertised':self.count_advertised,
+                'delivered':self.count_delivered,
+                'scans':self.manager.count_scans,
+                'elapsed':elapsed,
+                'rate':self.count_delivered / elapsed if elapsed else None,
+                'max_behind':self.max_behind,
+                'connects':self.manager.count_connects,
+                'connect_failures':self.manager.count_failed,
+                'links_dropped':self.manager.count_dropped,
+                'max_connected':self.manager.max_connected}
+
+
+BACKENDS = {
+    CoreBluetoothBackend.name: CoreBluetoothBackend,
+    SimulatedBackend.name:     SimulatedBackend,
+}
+
+def make_backend(name, delegate, **kwargs):
+    if name not in BACKENDS:
+        raise ValueError(f"backend must be one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](delegate, **kwargs)
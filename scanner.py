@@ -1,39 +1,164 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Originally from https://github.com/masato-ka/python-corebluetooth-sample.git
+#
+# The delegate (MyBLE) only depends on PyObjC through the CoreBluetooth
+# scan backend; with --backend simulated the scanner runs anywhere (see
+# scanbackend.py).
 
 import struct
+import time
+from contextlib import nullcontext
 
-from Foundation import CBCentralManager,CBUUID
-from PyObjCTools import AppHelper
+from advarchive import AdvArchiveWriter
+from advdelta import DeltaDecoder,describe
+from advstore import SQLiteStore
+from advfilter import AdvFilter
+from advjson import dumps
+from btleclassifier import Classifier,ClassificationCache
 
-from btleclassifier import BTLEAdvClassifier
-
-from constants import C
+from constants import C,WX2_SERVICE,WX2_CHARACTERISTIC_DATA
+from devices import DeviceRegistry
+from gattpool import GATTPool
+from instrumentation import Metrics,MetricsDumper
+from pipeline import AdvPipeline,POLICIES,snapshot_advertisement
+from proximity import MODES,ProximityTracker
+from scanbackend import BACKENDS,SimulatedBackend,make_backend
+from scanscheduler import ScanScheduler
+from sinks import COMPRESSORS,MultiSink,NDJSONSink,PrintSink
 import btleclassifier
+import omron
 import datetime
 
-wx2_service = CBUUID.UUIDWithString_(u'0C4C3000-7700-46F4-AA96-D5E974E32A54')
-wx2_characteristic_data = CBUUID.UUIDWithString_(u'0C4C3001-7700-46F4-AA96-D5E974E32A54')
 
 EXIT_COUNT = 10
 
+def service_uuids16(data):
+    """16-bit service UUIDs from the service data and service UUID list
+    CoreBluetooth reports."""
+    uuids = []
+    for uuid in list(data.get(C.kCBAdvDataServiceData, {}).keys()) + list(data.get(C.kCBAdvDataServiceUUIDs, [])):
+        text = str(uuid.UUIDString())
+        if len(text)==4:
+            uuids.append(int(text, 16))
+    return uuids
+
+def tx_power_level(data):
+    """The advertised TX power in dBm, or None."""
+    tx_power = data.get(C.kCBAdvDataTxPowerLevel)
+    return int(tx_power) if tx_power is not None else None
+
 class MyBLE(object):
-    def __init__(self,debug=False):
-        self.seen = set()
+    def __init__(self,debug=False,cache=None,pipeline=None,devices=None,metrics=None,adv_filter=None,
+                 sink=None,quiet=False,archive=None,delta=None,exit_count=EXIT_COUNT,allow_duplicates=False,
+                 classifier=None):
+        self.backend = None     # set once the scan backend is created
+        self.scheduler = None   # optional ScanScheduler, which then makes the scan calls
+        self.gatt = None        # optional GATTPool polling the sensors that advertise WX2_SERVICE
+        self.proximity = None   # optional ProximityTracker, ticked every proximity_interval seconds
+        self.proximity_interval = 1.0
+        self.exit_count = exit_count
+        self.allow_duplicates = allow_duplicates
+        self.devices = devices if devices is not None else DeviceRegistry()
+        self.delta = delta
+        self.adv_filter = adv_filter
+        self.sink = sink
+        self.quiet = quiet
+        self.archive = archive
         self.debug = debug
         self.count_advertisements = 0
+        self.stopped = False
+        self.cache = cache
+        self.metrics = metrics
+        self.classifier = classifier if classifier is not None else Classifier(cache=cache, metrics=metrics)
+        self.pipeline = pipeline
+
+    def timer(self, name):
+        return self.metrics.timer(name) if self.metrics is not None else nullcontext()
 
     def centralManagerDidUpdateState_(self, manager):
         if self.debug:
             print("centralManagerDidUpdateState_")
         self.manager = manager
-        manager.scanForPeripheralsWithServices_options_(None,None)
+        if self.gatt is not None:
+            self.gatt.start(manager)
+        if self.proximity is not None:
+            self.backend.call_later(self.proximity_interval, self.proximity_tick)
+        if self.scheduler is not None:
+            self.scheduler.start(manager)
+            return
+        options = {C.CBCentralManagerScanOptionAllowDuplicatesKey: True} if self.allow_duplicates else None
+        manager.scanForPeripheralsWithServices_options_(None,options)
 
     def centralManager_didDiscoverPeripheral_advertisementData_RSSI_(self, manager, peripheral, data, rssi):
         self.count_advertisements += 1
+        if self.scheduler is not None:
+            self.scheduler.callback()
+        with self.timer('callback'):
+            self.discovered(manager, peripheral, data, rssi)
+        if self.exit_count==self.count_advertisements:
+            self.stop()
+
+    def wanted(self, peripheral, data, rssi):
+        """Apply --filter to the raw manufacturer data and metadata,
+        before anything is copied or classified."""
+        adv_filter = self.adv_filter
+        manuf_data = data.get(C.kCBAdvDataManufacturerData)
+        return adv_filter.match(manuf_data=bytes(manuf_data) if manuf_data is not None else b'',
+                                rssi=int(rssi),
+                                address=str(peripheral.identifier()) if adv_filter.needs('address') else None,
+                                uuids=service_uuids16(data) if adv_filter.needs('uuid') else None)
+
+    def discovered(self, manager, peripheral, data, rssi):
+        if self.gatt is not None and any(str(uuid.UUIDString()).upper()==WX2_SERVICE
+                                         for uuid in data.get(C.kCBAdvDataServiceUUIDs, [])):
+            self.gatt.add(peripheral)
+        if self.adv_filter is not None and not self.wanted(peripheral, data, rssi):
+            return
+        if self.archive is not None:
+            manuf_data = data.get(C.kCBAdvDataManufacturerData)
+            self.archive.write(time.time(), str(peripheral.identifier()), int(rssi),
+                               manuf_data=bytes(manuf_data) if manuf_data is not None else None)
+        if self.pipeline is not None:
+            if self.proximity is not None:
+                # the pipeline thread owns the registry, so the tracker has its own slots
+                self.proximity.observe(str(peripheral.identifier()), int(rssi), tx_power_level(data))
+            # Only snapshot here; the pipeline thread classifies and prints.
+            self.pipeline.submit(snapshot_advertisement(peripheral, data, rssi))
+            return
         if self.debug:
             print('centralManager_didDiscoverPeripheral_advertisementData_RSSI_')
+        manuf_data = data.get(C.kCBAdvDataManufacturerData)
+        if manuf_data is not None:
+            manuf_data = bytes(manuf_data)
+        slot = self.devices.update(str(peripheral.identifier()), int(rssi), manuf_data)
+        if self.proximity is not None:
+            # the tracker shares the registry's slots
+            self.proximity.add((slot, int(rssi), tx_power_level(data)))
+        if self.delta is not None:
+            event = self.delta.update(str(peripheral.identifier()), manuf_data=manuf_data, rssi=int(rssi))
+            if event is None:
+                return
+            if self.sink is not None:
+                self.sink.emit(event)
+            if not self.quiet:
+                print(describe(event))
+            return
+        # classified once, for both the sink and the printout
+        classified = None
+        if manuf_data is not None and (self.sink is not None or not self.quiet):
+            classified = self.classifier.classify(manuf_data=manuf_data)
+        if self.sink is not None:
+            record = {'identifier':str(peripheral.identifier()),
+                      'name':peripheral.name(),
+                      'rssi':int(rssi),
+                      'timestamp':time.time()}
+            if classified is not None:
+                record.update(classified)
+            with self.timer('output'):
+                self.sink.emit(record)
+        if self.quiet:
+            return
         print("\n======== Advertisement {} t={} len={}  Channel={} rssi={} =======".format(
             self.count_advertisements,
             datetime.datetime.now().isoformat(),
@@ -56,8 +181,10 @@ class MyBLE(object):
                 elif prop==C.kCBAdvDataIsConnectable:
                     print("kCBAdvDataIsConnectable: ",data[C.kCBAdvDataIsConnectable])
                 elif prop==C.kCBAdvDataManufacturerData:
-                    obj = BTLEAdvClassifier( manuf_data = bytes( data[C.kCBAdvDataManufacturerData] ) )
-                    print(obj.json(indent=5))
+                    with self.timer('json'):
+                        text = dumps(classified, indent=5, compact=False)
+                    with self.timer('print'):
+                        print(text)
                 else:
                     try:
                         for (key,val) in dict(data[prop]).items():
@@ -68,83 +195,210 @@ class MyBLE(object):
         except Exception as e:
             print("exception: ",e)
 
-        if EXIT_COUNT==self.count_advertisements:
-            AppHelper.stopEventLoop()
+    def proximity_tick(self):
+        self.proximity.tick()
+        self.proximity.evict()
+        if not self.quiet:
+            print("nearest: " + ", ".join(f"{est.identifier} {est.distance:.1f}m ({est.rssi:.0f} dBm)"
+                                         for est in self.proximity.nearest(5)))
+        self.backend.call_later(self.proximity_interval, self.proximity_tick)
+
+    def stop(self):
+        """Drain and close everything and stop the backend. Only the first
+        call does anything."""
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.proximity is not None:
+            self.proximity.tick()
+            print("proximity: ",self.proximity.stats())
+        if self.gatt is not None:
+            self.gatt.stop()
+            print("gatt: ",self.gatt.stats())
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            print("scheduler: ",self.scheduler.stats())
+        if self.pipeline is not None:
+            self.pipeline.close()
+            print("pipeline: ",self.pipeline.stats())
+        if self.sink is not None:
+            self.sink.close()
+            print("sink: ",self.sink.stats())
+        if self.archive is not None:
+            self.archive.close()
+            print("archive: {} advertisements written to {}".format(self.archive.count_written, self.archive.path))
+        print("devices: {} tracked, {} evicted".format(len(self.devices), self.devices.count_evicted))
+        if self.delta is not None:
+            print("changes: ",self.delta.stats())
+        if self.cache is not None:
+            print("cache: ",self.cache.stats())
+        if self.metrics is not None:
+            print("metrics: ",self.metrics.snapshot())
+        if self.adv_filter is not None:
+            print("filter: ",self.adv_filter.stats())
+        if self.backend is not None:
+            self.backend.stop()
 
     def centralManager_didConnectPeripheral_(self, manager, peripheral):
         if self.debug:
             print("centralManager_didConnectPeripheral_")
-            print(repr(peripheral.UUID()))
-        peripheral.setDelegate_(self)
-        self.peripheral.discoverServices_([wx2_service])
-        
-    def peripheral_didDiscoverServices_(self, peripheral, services):
-        if self.debug:
-            print("peripheral_didDiscoverServices_")
-        self.service = self.peripheral.services()[0]
-        self.peripheral.discoverCharacteristics_forService_([wx2_characteristic_data], self.service)
-
-    def peripheral_didDiscoverCharacteristicsForService_error_(self, peripheral, service, error):
-        if self.debug:
-            print("peripheral_didDiscoverCharacteristicsForService_error_")
-        for characteristic in self.service.characteristics():
-            if characteristic.properties() == 18:
-                peripheral.readValueForCharacteristic_(characteristic)
-                break
+        if self.gatt is not None:
+            self.gatt.did_connect(peripheral)
 
-    def peripheral_didWriteValueForCharacteristic_error_(self, peripheral, characteristic, error):
+    def centralManager_didFailToConnectPeripheral_error_(self, manager, peripheral, error):
         if self.debug:
-            print("peripheral_didWriteValueForCharacteristic_error_")
-        print('In error handler')
-        print('ERROR:' + repr(error))
+            print("centralManager_didFailToConnectPeripheral_error_")
+        if self.gatt is not None:
+            self.gatt.did_fail(peripheral, error)
 
-    def peripheral_didUpdateNotificationStateForCharacteristic_error_(self, peripheral, characteristic, error):
+    def centralManager_didDisconnectPeripheral_error_(self, manager, peripheral, error):
         if self.debug:
-            print("Notification handler")
+            print("centralManager_didDisconnectPeripheral_error_")
+        if self.gatt is not None:
+            self.gatt.did_disconnect(peripheral, error)
 
-    def peripheral_didUpdateValueForCharacteristic_error_(self, peripheral, characteristic, error):
-        print(repr(characteristic.value().bytes().tobytes()))
-        value = characteristic.value().bytes().tobytes()
-
-        temp = decode_value(value[1:3],0.01)
-        print('temprature:' + str(temp))
-
-        humid = decode_value(value[3:5],0.01)
-        print('humidity:' + str(humid))
-
-        lum = decode_value(value[5:7])
-        print('lumix:' + str(lum))
-
-        uvi = decode_value(value[9:7], 0.01)
-        print('UV index:' + str(uvi))
-
-        atom = decode_value(value[9:11], 0.1)
-        print('Atom:' + str(atom))
-
-        noise = decode_value(value[11:13], 0.01)
-        print('Noise:' + str(noise))
-
-        disco = decode_value(value[13:15], 0.01)
-        print('Disco:' + str(disco))
-
-        heat = decode_value(value[15:17], 0.01)
-        print('Heat:' + str(heat))
-        
-        batt = decode_value(value[17:19],0.001)
-        print('Battery:' + str(batt))
+    def gatt_value(self, identifier, value, timestamp):
+        """A 2JCIE-BL01 reading from the GATT pool."""
+        try:
+            reading = omron.decode_frame(value)
+        except struct.error:
+            print(f"{identifier}: short sensor frame {value.hex()}")
+            return
+        if self.sink is not None:
+            record = {'identifier':identifier, 'timestamp':timestamp}
+            record.update(reading)
+            self.sink.emit(record)
+        if not self.quiet:
+            print(f"{identifier}: {omron.describe(reading)}")
 
 if "__main__" == __name__:
     import argparse
     parser = argparse.ArgumentParser(description='Monitor BLE')
     parser.add_argument("--debug", action='store_true', help="Run in debugger mode")
+    parser.add_argument("--cache", type=int, default=0, metavar='N',
+                        help="Cache the classification of up to N distinct advertisements")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="Classify and print on a separate thread, fed by a bounded queue")
+    parser.add_argument("--queue-size", type=int, default=10000,
+                        help="With --pipeline, the maximum number of queued advertisements")
+    parser.add_argument("--policy", choices=POLICIES, default=POLICIES[0],
+                        help="With --pipeline, what to drop when the queue is full")
+    parser.add_argument("--ttl", type=float, default=300.0,
+                        help="Forget devices not seen for this many seconds")
+    parser.add_argument("--metrics", action='store_true',
+                        help="Count AD/Apple types and time parsing, output and queue lag")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="With --metrics, dump a snapshot every this many seconds")
+    parser.add_argument("--metrics-file", help="With --metrics, append snapshots here instead of stderr")
+    parser.add_argument("--filter", help="Only process advertisements matching this expression, "
+                        "e.g. 'company==0x004c and apple_type in {0x0c,0x10} and rssi>-70' (see advfilter.py)")
+    parser.add_argument("--output", help="Write records as NDJSON to this file ('-' for stdout), "
+                        "through a buffer flushed by a background thread")
+    parser.add_argument("--rotate-bytes", type=int, help="With --output, start a new file after this many bytes (before compression)")
+    parser.add_argument("--rotate-seconds", type=float, help="With --output, start a new file after this many seconds")
+    parser.add_argument("--compress", choices=sorted(COMPRESSORS), help="With --output, compress the files")
+    parser.add_argument("--quiet", action='store_true', help="Do not print the human-readable output")
+    parser.add_argument("--archive", help="Append the raw advertisements to this binary archive (see advarchive.py)")
+    parser.add_argument("--db", help="Store records in this SQLite database (see advstore.py)")
+    parser.add_argument("--changes", action='store_true',
+                        help="Only output what changed in each device's advertisements (see advdelta.py)")
+    parser.add_argument("--count", type=int, default=EXIT_COUNT,
+                        help="Stop after this many advertisements (0: run until interrupted)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default='corebluetooth',
+                        help="Where advertisements come from (see scanbackend.py)")
+    parser.add_argument("--sim-devices", type=int, default=100, help="With --backend simulated, number of devices")
+    parser.add_argument("--sim-rate", type=float,
+                        help="With --backend simulated, advertisements/second (default: as fast as possible)")
+    parser.add_argument("--sim-churn", type=float, default=0.05,
+                        help="With --backend simulated, chance an advertisement changes its device's payload")
+    parser.add_argument("--sim-corpus", help="With --backend simulated, replay hex advertisements from this file")
+    parser.add_argument("--sim-duration", type=float, help="With --backend simulated, stop after this many seconds")
+    parser.add_argument("--sim-seed", type=int, default=0)
+    parser.add_argument("--sim-sensors", type=int, default=0,
+                        help="With --backend simulated, number of connectable 2JCIE-BL01 sensors")
+    parser.add_argument("--allow-duplicates", action='store_true',
+                        help="Report every advertisement, not just the first from each device")
+    parser.add_argument("--schedule", action='store_true',
+                        help="Alternate discovery bursts and quiet tracking windows (see scanscheduler.py)")
+    parser.add_argument("--scan-services", default='',
+                        help="With --schedule, comma-separated service UUIDs to track, e.g. 180F,FD6F")
+    parser.add_argument("--discovery-seconds", type=float, default=2.0, help="With --schedule, discovery burst length")
+    parser.add_argument("--tracking-seconds", type=float, default=10.0, help="With --schedule, tracking window length")
+    parser.add_argument("--idle-seconds", type=float, default=0.0, help="With --schedule, pause between cycles")
+    parser.add_argument("--max-rate", type=float, help="With --schedule, narrow discovery above this callbacks/second")
+    parser.add_argument("--min-rate", type=float, help="With --schedule, widen discovery below this callbacks/second")
+    parser.add_argument("--gatt", action='store_true',
+                        help="Connect to 2JCIE-BL01 sensors and poll their readings (see gattpool.py)")
+    parser.add_argument("--gatt-connections", type=int, default=4, help="With --gatt, concurrent connections")
+    parser.add_argument("--gatt-interval", type=float, default=10.0, help="With --gatt, seconds between readings")
+    parser.add_argument("--gatt-budget", type=float, help="With --gatt, maximum reads/second across all sensors")
+    parser.add_argument("--gatt-notify", action='store_true',
+                        help="With --gatt, subscribe to notifications instead of reading")
+    parser.add_argument("--proximity", choices=MODES,
+                        help="Smooth each device's RSSI with this filter and estimate its distance (see proximity.py)")
+    parser.add_argument("--proximity-interval", type=float, default=1.0,
+                        help="With --proximity, seconds between batch updates")
     args = parser.parse_args()
     
-    central_manager = CBCentralManager.alloc()
-    central_manager.initWithDelegate_queue_options_(MyBLE(debug=args.debug), None, None)
-    try:
-        AppHelper.runConsoleEventLoop()
-    except (KeyboardInterrupt, SystemExit) as e:
-        print(e)
-    except OC_PythonException as e:
-        print(e)
-        pass
+    cache = ClassificationCache(args.cache) if args.cache else None
+    devices = DeviceRegistry(ttl=args.ttl)
+    metrics = None
+    if args.metrics:
+        metrics = Metrics()
+        MetricsDumper(metrics, args.metrics_interval, args.metrics_file).start()
+    adv_filter = AdvFilter(args.filter) if args.filter else None
+    outputs = []
+    if args.output:
+        outputs.append(NDJSONSink(args.output, rotate_bytes=args.rotate_bytes, rotate_seconds=args.rotate_seconds,
+                                  compress=args.compress, metrics=metrics))
+    if args.db:
+        outputs.append(SQLiteStore(args.db, metrics=metrics))
+    sink = outputs[0] if len(outputs)==1 else MultiSink(*outputs) if outputs else None
+    archive = AdvArchiveWriter(args.archive) if args.archive else None
+    classifier = Classifier(cache=cache, metrics=metrics)
+    delta = DeltaDecoder(classifier, ttl=args.ttl) if args.changes else None
+    pipeline = None
+    if args.pipeline:
+        # The pipeline thread writes to the sinks; MyBLE.stop() closes
+        # the output sinks after the pipeline has drained.
+        sinks = ([] if args.quiet else [PrintSink()]) + outputs
+        pipeline = AdvPipeline(emit=MultiSink(*sinks).emit, classifier=classifier,
+                               maxsize=args.queue_size,
+                               policy=args.policy, devices=devices, metrics=metrics, delta=delta)
+        pipeline.start_thread()
+    ble = MyBLE(debug=args.debug, cache=cache, pipeline=pipeline,
+                devices=devices, metrics=metrics,
+                adv_filter=adv_filter,
+                sink=sink,
+                quiet=args.quiet,
+                archive=archive,
+                delta=delta,
+                exit_count=args.count,
+                allow_duplicates=args.allow_duplicates,
+                classifier=classifier)
+    if args.backend==SimulatedBackend.name:
+        corpus = None
+        if args.sim_corpus:
+            with open(args.sim_corpus) as f:
+                corpus = [bytes.fromhex(line) for line in f if line.strip()]
+        ble.backend = make_backend(args.backend, ble, devices=args.sim_devices, rate=args.sim_rate,
+                                   churn=args.sim_churn, corpus=corpus, duration=args.sim_duration,
+                                   seed=args.sim_seed, sensors=args.sim_sensors)
+    else:
+        ble.backend = make_backend(args.backend, ble)
+    if args.proximity:
+        ble.proximity = ProximityTracker(mode=args.proximity, ttl=args.ttl,
+                                         registry=None if pipeline is not None else devices)
+        ble.proximity_interval = args.proximity_interval
+    if args.gatt:
+        ble.gatt = GATTPool(ble.backend, WX2_SERVICE, WX2_CHARACTERISTIC_DATA, on_value=ble.gatt_value,
+                            max_connections=args.gatt_connections, poll_interval=args.gatt_interval,
+                            budget=args.gatt_budget, notify=args.gatt_notify)
+    if args.schedule:
+        ble.scheduler = ScanScheduler(ble.backend, [s for s in args.scan_services.split(',') if s],
+                                      args.discovery_seconds, args.tracking_seconds, args.idle_seconds,
+                                      max_rate=args.max_rate, min_rate=args.min_rate)
+    ble.backend.run()
+    ble.stop()              # Ctrl-C, or --sim-duration ran out first
+    if args.backend==SimulatedBackend.name:
+        print("backend: ",ble.backend.stats())
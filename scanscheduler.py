@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: scanscheduler.py
+"""
+Adaptive scan scheduling.
+
+Scanning everything with duplicates allowed gives the most data and the
+highest callback rate. ScanScheduler instead cycles through phases,
+reissuing the scan call at each switch:
+
+  discovery  a short burst: duplicates allowed, so every advertisement
+             is reported (all services when wide, else the targets)
+  tracking   a longer quiet window: the target services only (all, if
+             there are none), duplicates suppressed, so a device is
+             reported again only when its advertisement changes
+  idle       scanning stopped; skipped if idle_seconds is 0
+
+After each discovery burst the callback rate it saw is compared with
+max_rate and min_rate. Too many callbacks halve the next burst (down to
+min_discovery) and then narrow discovery to the target services; too few
+widen it back and then double the burst (up to max_discovery).
+
+The backend (scanbackend.py) provides the timer and the UUID objects,
+so the same scheduler drives CoreBluetooth and the simulated backend.
+stats() reports, per phase, the time spent, callbacks, callbacks/second
+and process CPU time. Try it against simulated devices with:
+
+    python scanscheduler.py --devices 2000 --rate 20000 --duration 20 --services 180F,FD6F
+"""
+
+import time
+from collections import namedtuple
+
+from constants import C
+
+DISCOVERY = 'discovery'
+TRACKING  = 'tracking'
+IDLE      = 'idle'
+PHASES    = (DISCOVERY, TRACKING, IDLE)
+
+Phase = namedtuple('Phase', ['name', 'seconds', 'services', 'allow_duplicates'])
+
+class PhaseStats():
+    __slots__ = ('windows', 'seconds', 'callbacks', 'cpu')
+
+    def __init__(self):
+        self.windows   = 0
+        self.seconds   = 0.0
+        self.callbacks = 0
+        self.cpu       = 0.0
+
+    def snapshot(self):
+        return {'windows':self.windows,
+                'seconds':self.seconds,
+                'callbacks':self.callbacks,
+                'callbacks_per_second':self.callbacks / self.seconds if self.seconds else None,
+                'cpu':self.cpu,
+                'cpu_percent':100 * self.cpu / self.seconds if self.seconds else None}
+
+
+class ScanScheduler():
+    def __init__(self, backend, services=(), discovery_seconds=2.0, tracking_seconds=10.0, idle_seconds=0.0,
+                 max_rate=None, min_rate=None, min_discovery=0.25, max_discovery=10.0):
+        assert discovery_seconds > 0 and tracking_seconds > 0 and idle_seconds >= 0
+        self.backend  = backend
+        self.services = [s.upper() for s in services]
+        self.discovery_seconds = discovery_seconds
+        self.tracking_seconds  = tracking_seconds
+        self.idle_seconds      = idle_seconds
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.min_discovery = min_discovery
+        self.max_discovery = max_discovery
+        self.wide     = True        # discovery scans all services
+        self.manager  = None
+        self.phase    = None
+        self.phase_started = None
+        self.phase_cpu = None
+        self.phase_callbacks = 0
+        self.stopped  = False
+        self.phase_stats = {name: PhaseStats() for name in PHASES}
+        self.adjustments = []       # (time, description)
+
+    def start(self, manager):
+        """Begin the cycle. Call from centralManagerDidUpdateState_."""
+        self.manager = manager
+        self.enter(DISCOVERY)
+
+    def callback(self):
+        """Count one discovered advertisement."""
+        self.phase_callbacks += 1
+
+    def make_phase(self, name):
+        if name==DISCOVERY:
+            services = None if self.wide or not self.services else self.services
+            return Phase(DISCOVERY, self.discovery_seconds, services, True)
+        if name==TRACKING:
+            return Phase(TRACKING, self.tracking_seconds, self.services or None, False)
+        return Phase(IDLE, self.idle_seconds, None, False)
+
+    def enter(self, name):
+        phase = self.make_phase(name)
+        manager = self.manager
+        manager.stopScan()
+        if phase.name != IDLE:
+            services = self.backend.uuids(phase.services) if phase.services else None
+            options  = {C.CBCentralManagerScanOptionAllowDuplicatesKey: phase.allow_duplicates}
+            manager.scanForPeripheralsWithServices_options_(services, options)
+        self.phase = phase
+        self.phase_started = time.monotonic()
+        self.phase_cpu = time.process_time()
+        self.phase_callbacks = 0
+        self.backend.call_later(phase.seconds, self.next_phase)
+
+    def end_phase(self):
+        """Account for the current phase. Returns its callback rate."""
+        elapsed = time.monotonic() - self.phase_started
+        stats = self.phase_stats[self.phase.name]
+        stats.windows   += 1
+        stats.seconds   += elapsed
+        stats.callbacks += self.phase_callbacks
+        stats.cpu       += time.process_time() - self.phase_cpu
+        return self.phase_callbacks / elapsed if elapsed else 0.0
+
+    def next_phase(self):
+        if self.stopped:
+            return
+        rate = self.end_phase()
+        if self.phase.name==DISCOVERY:
+            self.adapt(rate)
+            self.enter(TRACKING)
+        elif self.phase.name==TRACKING and self.idle_seconds:
+            self.enter(IDLE)
+        else:
+            self.enter(DISCOVERY)
+
+    def adapt(self, rate):
+        """Narrow or widen discovery for the callback rate just seen."""
+        change = None
+        if self.max_rate is not None and rate > self.max_rate:
+            if self.discovery_seconds > self.min_discovery:
+                self.discovery_seconds = max(self.min_discovery, self.discovery_seconds / 2)
+                change = f"{rate:.0f}/s > {self.max_rate}: discovery burst {self.discovery_seconds:g}s"
+            elif self.wide and self.services:
+                self.wide = False
+                change = f"{rate:.0f}/s > {self.max_rate}: discovery narrowed to {','.join(self.services)}"
+        elif self.min_rate is not None and rate < self.min_rate:
+            if not self.wide:
+                self.wide = True
+                change = f"{rate:.0f}/s < {self.min_rate}: discovery widened to all services"
+            elif self.discovery_seconds < self.max_discovery:
+                self.discovery_seconds = min(self.max_discovery, self.discovery_seconds * 2)
+                change = f"{rate:.0f}/s < {self.min_rate}: discovery burst {self.discovery_seconds:g}s"
+        if change:
+            self.adjustments.append((time.time(), change))
+
+    def stop(self):
+        """Stop switching phases, counting the one in progress."""
+        if not self.stopped and self.phase is not None:
+            self.end_phase()
+        self.stopped = True
+
+    def stats(self):
+        return {'phase':self.phase.name if self.phase else None,
+                'discovery_seconds':self.discovery_seconds,
+                'wide':self.wide,
+                'phases':{name: stats.snapshot() for (name, stats) in self.phase_stats.items() if stats.windows},
+                'adjustments':[change for (t, change) in self.adjustments]}
+
+
+class CountingDelegate():
+    """Minimal delegate for trying a scheduler: counts callbacks."""
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
+        self.count_advertisements = 0
+
+    def centralManagerDidUpdateState_(self, manager):
+        self.scheduler.start(manager)
+
+    def centralManager_didDiscoverPeripheral_advertisementData_RSSI_(self, manager, peripheral, data, rssi):
+        self.count_advertisements += 1
+        self.scheduler.callback()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from scanbackend import SimulatedBackend
+    parser = argparse.ArgumentParser(description='Run the scan scheduler against simulated devices')
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=20000, help="advertisements/second sent by all devices")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--services", default='', help="comma-separated 16-bit service UUIDs to track")
+    parser.add_argument("--discovery", type=float, default=2.0, help="discovery burst seconds")
+    parser.add_argument("--tracking", type=float, default=5.0, help="tracking window seconds")
+    parser.add_argument("--idle", type=float, default=0.0, help="idle seconds per cycle")
+    parser.add_argument("--max-rate", type=float, help="narrow discovery above this many callbacks/second")
+    parser.add_argument("--min-rate", type=float, help="widen discovery below this many callbacks/second")
+    args = parser.parse_args()
+
+    delegate = CountingDelegate()
+    backend  = SimulatedBackend(delegate, devices=args.devices, rate=args.rate, duration=args.duration)
+    delegate.scheduler = ScanScheduler(backend, [s for s in args.services.split(',') if s],
+                                       args.discovery, args.tracking, args.idle,
+                                       max_rate=args.max_rate, min_rate=args.min_rate)
+    backend.run()
+    delegate.scheduler.stop()
+    print(json.dumps(delegate.scheduler.stats(), indent=2))
+    print(json.dumps(backend.stats(), indent=2))
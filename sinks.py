@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: sinks.py
+"""
+Output sinks for classified records. A sink is called with one record
+dict per advertisement (sink.emit(record), or sink(record)) and must
+not block the caller for long; close() flushes it and stats() reports
+its counters.
+
+  PrintSink     the human-readable, indented JSON the scanner always printed
+  BufferedSink  base for sinks written in batches by a background thread
+  NDJSONSink    compact NDJSON through a BufferedSink, with optional
+                rotation and compression
+  MultiSink     sends each record to several sinks
+
+BufferedSink.emit() only appends to a bounded in-memory buffer. The
+writer thread wakes up when flush_records are waiting or flush_interval
+has passed and writes the whole batch at once. If the buffer is full, the
+record is dropped and counted rather than blocking the caller. The
+flush latency histogram measures from when the oldest record in a batch
+was buffered to when its batch was on disk.
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from advjson import ResultEncoder
+from instrumentation import Histogram
+
+# compression name -> (open function, file name extension)
+COMPRESSORS = {
+    'gzip': (gzip.open, '.gz'),
+    'bz2':  (bz2.open,  '.bz2'),
+    'xz':   (lzma.open, '.xz'),
+}
+
+class PrintSink():
+    """Print each record as indented JSON."""
+    def __init__(self, indent=5, file=None):
+        self.indent = indent
+        self.file   = file
+        self.dumps  = ResultEncoder(indent=indent).dumps
+        self.count_written = 0
+
+    def __call__(self, record):
+        self.emit(record)
+
+    def emit(self, record):
+        print(self.dumps(record), file=self.file or sys.stdout)
+        self.count_written += 1
+        return True
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {'written':self.count_written}
+
+
+class MultiSink():
+    """Send every record to each of several sinks."""
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def __call__(self, record):
+        self.emit(record)
+
+    def emit(self, record):
+        ok = True
+        for sink in self.sinks:
+            ok = sink.emit(record) and ok
+        return ok
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def stats(self):
+        return [sink.stats() for sink in self.sinks]
+
+
+class BufferedSink():
+    """Base for sinks written by a background thread: emit() appends to a
+    bounded buffer and the thread hands batches to write_batch(), which
+    subclasses implement. name prefixes the metrics (<name>_dropped,
+    <name>_flush_latency). Subclasses call start() once set up."""
+    def __init__(self, name, max_buffer=100000, flush_records=1000, flush_interval=1.0, metrics=None):
+        assert max_buffer > 0 and flush_records > 0
+        self.name           = name
+        self.max_buffer     = max_buffer
+        self.flush_records  = flush_records
+        self.flush_interval = flush_interval
+        self.metrics        = metrics
+        self.flush_latency  = metrics.histograms[f'{name}_flush_latency'] if metrics is not None else Histogram()
+        self.buffer   = deque()
+        self.oldest   = None        # monotonic time the oldest buffered record arrived
+        self.cond     = threading.Condition()
+        self.closed   = False
+        self.count_written = 0
+        self.count_dropped = 0
+        self.count_flushes = 0
+        self.count_errors  = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def __call__(self, record):
+        self.emit(record)
+
+    def emit(self, record):
+        """Buffer one record. Returns False if it was dropped."""
+        with self.cond:
+            if self.closed or len(self.buffer) >= self.max_buffer:
+                self.count_dropped += 1
+                if self.metrics is not None:
+                    self.metrics.incr(f'{self.name}_dropped')
+                return False
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.append(record)
+            if len(self.buffer) >= self.flush_records:
+                self.cond.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.closed and len(self.buffer) < self.flush_records:
+                    self.cond.wait(self.flush_interval)
+                (batch, oldest) = (self.buffer, self.oldest)
+                if batch:
+                    self.buffer = deque()
+                closing = self.closed
+            if batch:
+                try:
+                    self.write_batch(batch, oldest)
+                except Exception as e:      # e.g. a record that cannot be serialized
+                    self.failed(batch, f"{e.__class__.__name__}: {e}")
+            elif closing:
+                break
+        self.close_output()
+
+    def write_batch(self, batch, oldest):
+        raise NotImplementedError
+
+    def close_output(self):
+        """Called on the writer thread after the last batch."""
+        pass
+
+    def flushed(self, batch, oldest):
+        """Count a batch written by write_batch()."""
+        self.count_written += len(batch)
+        self.count_flushes += 1
+        self.flush_latency.record(time.monotonic() - oldest)
+
+    def failed(self, batch, error):
+        """Count a batch write_batch() could not write. run() also calls
+        this for any exception write_batch() lets escape, so one bad batch
+        never stops the writer thread."""
+        with self.cond:             # emit() counts drops from other threads
+            self.count_errors  += 1
+            self.count_dropped += len(batch)
+            if self.metrics is not None:
+                self.metrics.incr(f'{self.name}_dropped', len(batch))
+        print(f"{self.__class__.__name__}: {error}", file=sys.stderr)
+
+    def close(self):
+        """Write everything still buffered and close the output."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def stats(self):
+        return {'written':self.count_written,
+                'dropped':self.count_dropped,
+                'buffered':len(self.buffer),
+                'flushes':self.count_flushes,
+                'errors':self.count_errors,
+                'flush_latency':self.flush_latency.snapshot()}
+
+
+class NDJSONSink(BufferedSink):
+    """Buffered NDJSON writer. path may be '-' for stdout. If
+    rotate_bytes or rotate_seconds is set, output goes to a series of
+    files named <root>-<date>-<time>-<n><ext> next to path, switching
+    between batches; compress is one of COMPRESSORS. rotate_bytes counts
+    the UTF-8 bytes written, before compression. encoder is the
+    advjson.ResultEncoder used for the records."""
+    def __init__(self, path, max_buffer=100000, flush_records=1000, flush_interval=1.0,
+                 rotate_bytes=None, rotate_seconds=None, compress=None, metrics=None, encoder=None):
+        if compress is not None and compress not in COMPRESSORS:
+            raise ValueError(f"compress must be one of {', '.join(COMPRESSORS)}")
+        if path=='-' and (rotate_bytes or rotate_seconds or compress):
+            raise ValueError("cannot rotate or compress stdout")
+        super().__init__('sink', max_buffer, flush_records, flush_interval, metrics)
+        self.path           = path
+        self.rotate_bytes   = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress       = compress
+        self.encoder        = encoder or ResultEncoder()
+        self.file     = None
+        self.filename = None
+        self.file_bytes  = 0
+        self.file_opened = 0.0
+        self.count_files = 0
+        self.count_bytes = 0
+        self.start()
+
+    def write_batch(self, batch, oldest):
+        data = self.encoder.dumps_lines_bytes(batch)
+        try:
+            if self.file is None or self.should_rotate():
+                self.open_next()
+            self.file.write(data)
+            self.file.flush()
+        except OSError as e:
+            self.failed(batch, f"cannot write {self.filename}: {e}")
+            return
+        self.file_bytes  += len(data)
+        self.count_bytes += len(data)
+        self.flushed(batch, oldest)
+
+    def should_rotate(self):
+        return ((self.rotate_bytes and self.file_bytes >= self.rotate_bytes) or
+                (self.rotate_seconds and time.monotonic() - self.file_opened >= self.rotate_seconds))
+
+    def next_filename(self):
+        ext = COMPRESSORS[self.compress][1] if self.compress else ''
+        if not (self.rotate_bytes or self.rotate_seconds):
+            return self.path if self.path.endswith(ext) else self.path + ext
+        (root, suffix) = os.path.splitext(self.path)
+        return f"{root}-{time.strftime('%Y%m%d-%H%M%S')}-{self.count_files:04d}{suffix}{ext}"
+
+    def open_next(self):
+        self.close_file()
+        if self.path=='-':
+            sys.stdout.flush()
+            (self.file, self.filename) = (sys.stdout.buffer, '-')
+        else:
+            self.filename = self.next_filename()
+            opener = COMPRESSORS[self.compress][0] if self.compress else open
+            self.file = opener(self.filename, 'ab')
+        self.file_bytes  = 0
+        self.file_opened = time.monotonic()
+        self.count_files += 1
+
+    def close_file(self):
+        if self.file is not None and self.filename != '-':
+            self.file.close()
+        self.file = None
+
+    def close_output(self):
+        self.close_file()
+
+    def stats(self):
+        stats = {'path':self.path, 'file':self.filename, 'files':self.count_files, 'bytes':self.count_bytes}
+        stats.update(super().stats())
+        return stats
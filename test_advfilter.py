@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_advfilter.py
+"""Tests for advfilter.py. Run with 'python -m pytest test_advfilter.py'."""
+
+import pytest
+
+from advfilter import AdvFilter, FilterError
+
+# flags 0x06, then Apple manufacturer data with a 0x10 (Nearby Info) record
+APPLE_NEARBY = bytes.fromhex('020106') + bytes.fromhex('0aff4c001005011c000000')
+
+
+def test_match():
+    adv_filter = AdvFilter("company==0x004c and apple_type in {0x0c, 0x10} and rssi > -70")
+    assert adv_filter.match(APPLE_NEARBY, rssi=-50)
+    assert not adv_filter.match(APPLE_NEARBY, rssi=-80)
+    assert not adv_filter.match(APPLE_NEARBY)
+    assert adv_filter.stats()['passed'] == 1
+
+
+@pytest.mark.parametrize('expression', [
+    "apple_type in 0x0c",
+    "apple_type == 'x'",
+    "apple_type in {0x0c, 'x'}",
+    "uuid != 1.5",
+    "rssi > 'x'",
+    "rssi in -70",
+    "rssi == True",
+    "length >= None",
+    "company in {'apple'}",
+    "company == 76.0",
+    "address == 5",
+    "address in 'AA:BB'",
+    "ad_type > 1",
+    "rssi > foo",
+])
+def test_type_errors_at_compile_time(expression):
+    with pytest.raises(FilterError):
+        AdvFilter(expression)
+
+
+@pytest.mark.parametrize('expression', [
+    "rssi > -70.5",
+    "rssi == None",
+    "company != None",
+    "company in (0x004c, 0x0006)",
+    "address == 'AA:BB'",
+    "address in ['AA:BB', 'CC:DD']",
+    "uuid == 0xfe9f",
+    "not ad_type in {0x16}",
+])
+def test_well_typed(expression):
+    AdvFilter(expression).match(APPLE_NEARBY, rssi=-60, address='AA:BB')
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_btleclassifier.py
+"""Tests for btleclassifier.py. Run with 'python -m pytest test_btleclassifier.py'."""
+
+import pytest
+
+import advcorpus
+from btleclassifier import Classifier, FLAGS, HEX, UNKNOWN
+
+CLASSIFIER = Classifier()
+CORPUS = advcorpus.generate(20000)
+
+
+def test_lazy_result_matches_decode():
+    """Keys, key order and values of a lazy result match classify()."""
+    for adv_data in CORPUS:
+        expected = CLASSIFIER.classify(adv_data)
+        lazy = CLASSIFIER.classify_lazy(adv_data)
+        assert lazy.keys() == list(expected.keys()), adv_data.hex()
+        assert dict(lazy) == expected, adv_data.hex()
+
+
+@pytest.mark.parametrize('manuf_data', [b'\x4c', b'\x4c\x00', b'\x4c\x00\x10\x05\x01',
+                                        bytes.fromhex('4c0010050b1c6d9072')])
+def test_lazy_result_matches_decode_with_manufacturer_data(manuf_data):
+    for adv_data in CORPUS[:2000]:
+        expected = CLASSIFIER.classify(adv_data, manuf_data)
+        assert dict(CLASSIFIER.classify_lazy(adv_data, manuf_data)) == expected, adv_data.hex()
+
+
+def test_short_known_structure_is_unknown():
+    # flags, then a one-byte appearance (0x19) structure, which needs two
+    lazy = CLASSIFIER.classify_lazy(bytes.fromhex('0201060219db'))
+    assert lazy.keys() == [HEX, FLAGS, UNKNOWN]
+    assert lazy[UNKNOWN] == [{'type':0x19, 'hex':'db'}]